@@ -0,0 +1,54 @@
+import argparse
+import math
+import time
+
+import pyprob
+from pyprob import Model, InferenceEngine
+from pyprob.distributions import Normal, Uniform
+
+
+# Inference compilation throughput (traces/sec) with one particle at a time and with particles running in lockstep
+class GaussianWithUnknownMeanMarsaglia(Model):
+    def __init__(self, prior_mean=1, prior_stddev=math.sqrt(5), likelihood_stddev=math.sqrt(2)):
+        self.prior_mean = prior_mean
+        self.prior_stddev = prior_stddev
+        self.likelihood_stddev = likelihood_stddev
+        super().__init__('Gaussian with unknown mean (Marsaglia)')
+
+    def marsaglia(self, mean, stddev):
+        uniform = Uniform(-1, 1)
+        s = 1
+        while float(s) >= 1:
+            x = pyprob.sample(uniform)
+            y = pyprob.sample(uniform)
+            s = x*x + y*y
+        return mean + stddev * (x * math.sqrt(-2 * math.log(float(s)) / float(s)))
+
+    def forward(self, observation=[]):
+        mu = self.marsaglia(self.prior_mean, self.prior_stddev)
+        likelihood = Normal(mu, self.likelihood_stddev)
+        for o in observation:
+            pyprob.observe(likelihood, o)
+        return mu
+
+
+def traces_per_second(model, num_traces, lockstep_particles):
+    time_start = time.time()
+    model.posterior_traces(num_traces, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK, lockstep_particles=lockstep_particles, observation=[8, 9])
+    return num_traces / (time.time() - time_start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark inference compilation with and without lockstep particles')
+    parser.add_argument('--training_traces', type=int, default=2048)
+    parser.add_argument('--num_traces', type=int, default=2000)
+    parser.add_argument('--lockstep_particles', type=int, nargs='+', default=[8, 32, 128, 512])
+    opt = parser.parse_args()
+
+    model = GaussianWithUnknownMeanMarsaglia()
+    model.learn_inference_network(observation=[1, 1], num_traces=opt.training_traces)
+    pyprob.set_verbosity(0)
+    print('Particles | Traces/sec')
+    print('{} | {:,.2f}'.format('1'.rjust(9), traces_per_second(model, opt.num_traces, None)))
+    for lockstep_particles in opt.lockstep_particles:
+        print('{} | {:,.2f}'.format(str(lockstep_particles).rjust(9), traces_per_second(model, opt.num_traces, lockstep_particles)))
@@ -0,0 +1,55 @@
+import argparse
+import time
+import torch
+
+import pyprob
+from pyprob import Model
+from pyprob.distributions import Normal, Categorical
+from pyprob.nn import Batch, InferenceNetworkLSTM
+
+
+# Training throughput (traces/sec) of InferenceNetworkLSTM.loss for a range of batch sizes and trace lengths
+class LongTraces(Model):
+    def __init__(self, length):
+        self.length = length
+        super().__init__('Long traces ({})'.format(length))
+
+    def forward(self, observation=[]):
+        x = 0
+        for i in range(self.length):
+            if i % 2 == 0:
+                x = x + pyprob.sample(Normal(0, 1))
+            else:
+                x = x + pyprob.sample(Categorical([0.2, 0.3, 0.5]))
+        likelihood = Normal(x, 1)
+        for o in observation:
+            pyprob.observe(likelihood, o)
+        return x
+
+
+def benchmark(batch_size, length, iterations):
+    model = LongTraces(length)
+    batch = Batch(model._traces(batch_size, observation=[0, 0]))
+    inference_network = InferenceNetworkLSTM(model_name=model.name, lstm_dim=128, observe_embedding_dim=128, sample_embedding_dim=16, address_embedding_dim=128, valid_batch=batch)
+    inference_network.polymorph()
+    optimizer = torch.optim.Adam(inference_network.parameters(), lr=0.0001)
+    inference_network.loss(batch, optimizer)  # Warm-up
+    time_start = time.time()
+    for i in range(iterations):
+        inference_network.loss(batch, optimizer)
+    return batch_size * iterations / (time.time() - time_start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the training throughput of the LSTM inference network')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[64, 128, 256, 512, 1024])
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--iterations', type=int, default=3)
+    opt = parser.parse_args()
+
+    pyprob.set_verbosity(0)
+    print('Batch size | Trace length | Traces/sec')
+    for length in opt.lengths:
+        for batch_size in opt.batch_sizes:
+            traces_per_second = benchmark(batch_size, length, opt.iterations)
+            print('{} | {} | {:,.2f}'.format(str(batch_size).rjust(10), str(length).rjust(12), traces_per_second))
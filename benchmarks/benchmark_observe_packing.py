@@ -0,0 +1,53 @@
+import argparse
+import time
+import torch
+
+import pyprob
+from pyprob import Model, TrainingObservation
+from pyprob.distributions import Normal
+from pyprob.nn import Batch
+
+
+# Time to synthesize the training observations of a batch, packing trace by trace with Trace.pack_observes vs. once per sub-batch with ObserveColumns
+class ManyObserves(Model):
+    def __init__(self, observes):
+        self.observes = observes
+        super().__init__('Many observes ({})'.format(observes))
+
+    def forward(self, observation=[]):
+        x = pyprob.sample(Normal(0, 1))
+        likelihood = Normal(x, 1)
+        for o in observation:
+            pyprob.observe(likelihood, o)
+        return x
+
+
+def benchmark(batch_size, observes, iterations):
+    model = ManyObserves(observes)
+    batch = Batch(model._traces(batch_size, observation=[0] * observes))
+    time_start = time.time()
+    for i in range(iterations):
+        for sub_batch in batch.sub_batches:
+            torch.stack([trace.pack_observes(TrainingObservation.OBSERVE_DIST_SAMPLE) for trace in sub_batch])
+    time_traces = (time.time() - time_start) / iterations
+    time_start = time.time()
+    for i in range(iterations):
+        for sub_batch_observes in batch.sub_batches_observes:
+            sub_batch_observes.pack(TrainingObservation.OBSERVE_DIST_SAMPLE)
+    time_columns = (time.time() - time_start) / iterations
+    return time_traces, time_columns
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the synthesis of training observations')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[64, 256, 1024])
+    parser.add_argument('--observes', type=int, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--iterations', type=int, default=10)
+    opt = parser.parse_args()
+
+    pyprob.set_verbosity(0)
+    print('Batch size | Observes | Per trace (s) | Per sub-batch (s) | Speedup')
+    for observes in opt.observes:
+        for batch_size in opt.batch_sizes:
+            time_traces, time_columns = benchmark(batch_size, observes, opt.iterations)
+            print('{} | {} | {:13.5f} | {:17.5f} | {:7.2f}'.format(str(batch_size).rjust(10), str(observes).rjust(8), time_traces, time_columns, time_traces / time_columns))
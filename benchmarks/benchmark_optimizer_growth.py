@@ -0,0 +1,64 @@
+import argparse
+import time
+import torch
+
+import pyprob
+from pyprob import Model
+from pyprob.distributions import Normal, Categorical
+from pyprob.nn import Batch, InferenceNetworkLSTM, add_new_parameter_groups
+
+
+# Training loss vs. time on a branching model that keeps producing new addresses, comparing an optimizer that is recreated whenever new layers appear with one that keeps its state and gets the new parameters added
+class Branching(Model):
+    def __init__(self, branches):
+        self.branches = branches
+        super().__init__('Branching ({})'.format(branches))
+
+    def forward(self, observation=[]):
+        branch = int(pyprob.sample(Categorical([1. / self.branches] * self.branches)))
+        x = 0
+        for i in range(branch + 1):
+            x = x + pyprob.sample(Normal(branch, 1))
+        likelihood = Normal(x, 1)
+        for o in observation:
+            pyprob.observe(likelihood, o)
+        return x
+
+
+def train(model, preserve_state, batch_size, iterations, learning_rate):
+    pyprob.set_random_seed(123)
+    valid_batch = Batch(model._traces(batch_size, observation=[1, 1]))
+    inference_network = InferenceNetworkLSTM(model_name=model.name, lstm_dim=64, observe_embedding_dim=64, sample_embedding_dim=8, address_embedding_dim=32, valid_batch=valid_batch)
+    inference_network.polymorph()
+    inference_network.train()
+    optimizer = torch.optim.Adam(inference_network.parameters(), lr=learning_rate)
+    losses = []
+    time_start = time.time()
+    for iteration in range(iterations):
+        batch = Batch(model._traces(batch_size, observation=[1, 1]))
+        if inference_network.polymorph(batch):
+            if preserve_state:
+                add_new_parameter_groups(optimizer, inference_network._parameter_groups())
+            else:
+                optimizer = torch.optim.Adam(inference_network.parameters(), lr=learning_rate)
+        _, loss = inference_network.loss(batch, optimizer)
+        losses.append((time.time() - time_start, loss))
+    return losses
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark training loss vs. time with and without preserving the optimizer state on network growth')
+    parser.add_argument('--branches', type=int, default=50)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--iterations', type=int, default=200)
+    parser.add_argument('--learning_rate', type=float, default=0.001)
+    parser.add_argument('--report_interval', type=int, default=20)
+    opt = parser.parse_args()
+
+    pyprob.set_verbosity(0)
+    model = Branching(opt.branches)
+    losses_reset = train(model, False, opt.batch_size, opt.iterations, opt.learning_rate)
+    losses_preserve = train(model, True, opt.batch_size, opt.iterations, opt.learning_rate)
+    print('Iteration | Time (reset) | Loss (reset) | Time (preserve) | Loss (preserve)')
+    for i in range(opt.report_interval - 1, opt.iterations, opt.report_interval):
+        print('{} | {:12.2f} | {:+.5e} | {:15.2f} | {:+.5e}'.format(str(i + 1).rjust(9), losses_reset[i][0], losses_reset[i][1], losses_preserve[i][0], losses_preserve[i][1]))
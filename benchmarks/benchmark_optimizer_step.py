@@ -0,0 +1,41 @@
+import argparse
+import time
+import torch
+
+import pyprob
+from pyprob.nn import SparseStepOptimizer
+
+
+# Time per optimizer step for networks with many per-address layers of which only a few are used in each batch, stepping all the parameters or only the parameter groups that received gradients
+def benchmark(sparse, num_addresses, addresses_per_batch, dim, iterations):
+    layers = [torch.nn.Linear(dim, dim) for i in range(num_addresses)]
+    optimizer = torch.optim.Adam([{'params': layer.parameters()} for layer in layers], lr=0.0001)
+    if sparse:
+        optimizer = SparseStepOptimizer(optimizer)
+    x = torch.randn(1, dim)
+    duration = 0
+    for i in range(iterations + 1):
+        optimizer.zero_grad()
+        loss = sum([layers[j](x).sum() for j in torch.randint(num_addresses, (addresses_per_batch,)).tolist()])
+        loss.backward()
+        time_start = time.time()
+        optimizer.step()
+        if i > 0:  # The first step is a warm-up
+            duration += time.time() - time_start
+    return duration / iterations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark dense and sparse optimizer steps over per-address parameter groups')
+    parser.add_argument('--num_addresses', type=int, nargs='+', default=[100, 1000, 10000])
+    parser.add_argument('--addresses_per_batch', type=int, default=10)
+    parser.add_argument('--dim', type=int, default=128)
+    parser.add_argument('--iterations', type=int, default=10)
+    opt = parser.parse_args()
+
+    pyprob.set_verbosity(0)
+    print('Addresses | Step (dense) | Step (sparse) | Speedup')
+    for num_addresses in opt.num_addresses:
+        dense = benchmark(False, num_addresses, opt.addresses_per_batch, opt.dim, opt.iterations)
+        sparse = benchmark(True, num_addresses, opt.addresses_per_batch, opt.dim, opt.iterations)
+        print('{} | {:12.6f} | {:13.6f} | {:.2f}x'.format(str(num_addresses).rjust(9), dense, sparse, dense / sparse))
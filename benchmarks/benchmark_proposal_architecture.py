@@ -0,0 +1,57 @@
+import argparse
+import time
+import torch
+
+import pyprob
+from pyprob import Model, ProposalArchitecture
+from pyprob.distributions import Normal, Categorical
+from pyprob.nn import Batch, InferenceNetworkLSTM
+
+
+# Number of parameters and training throughput of InferenceNetworkLSTM with per-address and shared proposal layers, for models with increasing numbers of addresses
+class ManyAddresses(Model):
+    def __init__(self, length):
+        self.length = length
+        super().__init__('Many addresses ({})'.format(length))
+
+    def forward(self, observation=[]):
+        x = 0
+        for i in range(self.length):
+            if i % 2 == 0:
+                x = x + pyprob.sample(Normal(0, 1))
+            else:
+                x = x + pyprob.sample(Categorical([0.2, 0.3, 0.5]))
+        likelihood = Normal(x, 1)
+        for o in observation:
+            pyprob.observe(likelihood, o)
+        return x
+
+
+def benchmark(proposal_architecture, length, lstm_dim, batch_size, iterations):
+    model = ManyAddresses(length)
+    batch = Batch(model._traces(batch_size, observation=[0, 0]))
+    inference_network = InferenceNetworkLSTM(model_name=model.name, lstm_dim=lstm_dim, observe_embedding_dim=lstm_dim, sample_embedding_dim=16, address_embedding_dim=lstm_dim, proposal_architecture=proposal_architecture, valid_batch=batch)
+    inference_network.polymorph()
+    num_params = sum([p.nelement() for p in inference_network.parameters()])
+    optimizer = torch.optim.Adam(inference_network.parameters(), lr=0.0001)
+    inference_network.loss(batch, optimizer, pack_sub_batches=True)  # Warm-up
+    time_start = time.time()
+    for i in range(iterations):
+        inference_network.loss(batch, optimizer, pack_sub_batches=True)
+    return num_params, batch_size * iterations / (time.time() - time_start)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the size and training throughput of per-address and shared proposal layers')
+    parser.add_argument('--lengths', type=int, nargs='+', default=[10, 100, 1000])
+    parser.add_argument('--lstm_dim', type=int, default=512)
+    parser.add_argument('--batch_size', type=int, default=64)
+    parser.add_argument('--iterations', type=int, default=3)
+    opt = parser.parse_args()
+
+    pyprob.set_verbosity(0)
+    print('Addresses | Architecture | Parameters     | Traces/sec')
+    for length in opt.lengths:
+        for proposal_architecture in [ProposalArchitecture.PER_ADDRESS, ProposalArchitecture.SHARED_TRUNK]:
+            num_params, traces_per_second = benchmark(proposal_architecture, length, opt.lstm_dim, opt.batch_size, opt.iterations)
+            print('{} | {} | {} | {:,.2f}'.format(str(length).rjust(9), proposal_architecture.name.ljust(12), '{:,}'.format(num_params).rjust(14), traces_per_second))
@@ -0,0 +1,53 @@
+import argparse
+import time
+import torch
+
+import pyprob
+from pyprob import util
+from pyprob.distributions import Normal
+from pyprob.trace import Sample
+from pyprob.nn import ProposalNormal, proposal_layers_forward_grouped
+
+
+# Time of evaluating many proposal layers of the same type and shape with one call of proposal_layers_forward_grouped (which stacks the layer weights) vs. one call per layer, for training (forward and backward) and for inference (no autograd, stacked weights cached)
+def evaluate(proposal_layers, inputs, samples, values, grouped):
+    if grouped:
+        return proposal_layers_forward_grouped(proposal_layers, inputs, samples).log_prob(torch.cat(values)).sum()
+    else:
+        return sum([proposal_layer(x, s).log_prob(v).sum() for proposal_layer, x, s, v in zip(proposal_layers, inputs, samples, values)])
+
+
+def benchmark(num_layers, rows, input_dim, iterations, grouped, training):
+    proposal_layers = [ProposalNormal(input_dim, 1) for i in range(num_layers)]
+    inputs = [util.Tensor(rows, input_dim).normal_() for i in range(num_layers)]
+    samples = [[Sample(Normal(0, 1), util.Tensor([0]), '', '', 0)] * rows for i in range(num_layers)]
+    values = [util.Tensor(rows, 1).normal_() for i in range(num_layers)]
+    optimizer = torch.optim.SGD([p for proposal_layer in proposal_layers for p in proposal_layer.parameters()], lr=1e-6)
+    with torch.set_grad_enabled(training):
+        evaluate(proposal_layers, inputs, samples, values, grouped)  # Warm-up
+        time_start = time.time()
+        for i in range(iterations):
+            log_prob = evaluate(proposal_layers, inputs, samples, values, grouped)
+            if training:
+                optimizer.zero_grad()
+                (-log_prob).backward()
+                optimizer.step()
+    return (time.time() - time_start) / iterations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark grouped evaluation of proposal layers against per-layer evaluation')
+    parser.add_argument('--num_layers', type=int, nargs='+', default=[4, 16, 64, 256])
+    parser.add_argument('--rows', type=int, nargs='+', default=[1, 16])
+    parser.add_argument('--input_dim', type=int, default=128)
+    parser.add_argument('--iterations', type=int, default=20)
+    opt = parser.parse_args()
+
+    pyprob.set_verbosity(0)
+    print('Mode      | Layers | Rows/layer | Per layer (s) | Grouped (s) | Speedup')
+    for training in [True, False]:
+        for num_layers in opt.num_layers:
+            for rows in opt.rows:
+                time_per_layer = benchmark(num_layers, rows, opt.input_dim, opt.iterations, False, training)
+                time_grouped = benchmark(num_layers, rows, opt.input_dim, opt.iterations, True, training)
+                print('{} | {} | {} | {:13.5f} | {:11.5f} | {:7.2f}'.format(('training' if training else 'inference').ljust(9), str(num_layers).rjust(6), str(rows).rjust(10), time_per_layer, time_grouped, time_per_layer / time_grouped))
@@ -0,0 +1,53 @@
+import argparse
+import math
+import time
+import torch
+
+import pyprob
+from pyprob import Model, InferenceEngine
+from pyprob.distributions import Normal
+
+
+# Per-sample proposal latency of inference compilation, for the posterior sampling path and for the inference network alone
+class GaussianWithUnknownMean(Model):
+    def __init__(self, prior_mean=1, prior_stddev=math.sqrt(5), likelihood_stddev=math.sqrt(2)):
+        self.prior_mean = prior_mean
+        self.prior_stddev = prior_stddev
+        self.likelihood_stddev = likelihood_stddev
+        super().__init__('Gaussian with unknown mean')
+
+    def forward(self, observation=[]):
+        mu = pyprob.sample(Normal(self.prior_mean, self.prior_stddev))
+        likelihood = Normal(mu, self.likelihood_stddev)
+        for o in observation:
+            pyprob.observe(likelihood, o)
+        return mu
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the per-sample proposal latency of inference compilation')
+    parser.add_argument('--training_traces', type=int, default=1024)
+    parser.add_argument('--num_traces', type=int, default=2000)
+    parser.add_argument('--debug_mode', action='store_true')
+    opt = parser.parse_args()
+
+    model = GaussianWithUnknownMean()
+    model.learn_inference_network(observation=[1, 1], num_traces=opt.training_traces)
+    pyprob.set_verbosity(0)
+    pyprob.set_debug_mode(opt.debug_mode)
+
+    time_start = time.time()
+    traces = model.posterior_traces(opt.num_traces, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK, observation=[8, 9])
+    num_samples = sum([trace.length for trace in traces.values])
+    print('Posterior sampling: {:,.1f} us per proposal'.format(1e6 * (time.time() - time_start) / num_samples))
+
+    inference_network = model._inference_network
+    trace = traces.values[0]
+    inference_network.new_trace(pyprob.util.pack_observes_to_variable([8, 9]).unsqueeze(0))
+    for grad_enabled in [True, False]:
+        with torch.set_grad_enabled(grad_enabled):
+            time_start = time.time()
+            for i in range(opt.num_traces):
+                inference_network._state_new_trace = True
+                inference_network.forward_one_time_step(None, trace.samples[0]).sample()
+            print('Inference network (grad enabled: {}): {:,.1f} us per proposal'.format(grad_enabled, 1e6 * (time.time() - time_start) / opt.num_traces))
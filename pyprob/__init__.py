@@ -1,6 +1,6 @@
 __version__ = '0.10.0'
 
-from .util import ObserveEmbedding, SampleEmbedding, TraceMode, InferenceEngine, InferenceNetwork, PriorInflation, Optimizer, TrainingObservation, set_random_seed, set_cuda, set_verbosity
+from .util import ObserveEmbedding, SampleEmbedding, ProposalArchitecture, AddressEviction, TraceMode, InferenceEngine, InferenceNetwork, PriorInflation, Optimizer, TrainingObservation, set_random_seed, set_cuda, set_verbosity, set_debug_mode
 from .model import Model, ModelRemote
 from .state import sample, observe
 
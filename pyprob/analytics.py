@@ -93,7 +93,7 @@ def save_report(model, file_name, detailed_traces=2):
                 table.add_row(('Iterations', '{:,}'.format(inference_network._total_train_iterations)))
                 table.add_row(('Iterations / s', '{:,.2f}'.format(iter_per_sec)))
                 table.add_row(('Optimizer', inference_network._optimizer_type))
-                table.add_row(('Validation set size', inference_network._valid_batch.length))
+                table.add_row(('Validation set size', inference_network._valid_batch.length if inference_network._valid_batch is not None else 'N/A'))
         print('Analytics: Inference network.Training loss')
         with doc.create(Subsection('Training loss')):
             with doc.create(Tabularx('ll')) as table:
@@ -4,14 +4,8 @@ import torch.distributions
 import copy
 import collections
 import math
-import tarfile
-import tempfile
-import shutil
-import os
-import uuid
 import numpy as np
 import random
-from threading import Thread
 from termcolor import colored
 from functools import reduce
 
@@ -79,37 +73,25 @@ class Distribution(object):
     def expectation(self, func):
         raise NotImplementedError()
 
-    def save(self, file_name):
+    def save(self, file_name, background=False):
+        # With background=True, returns a future without waiting for the file to be written
         data = {}
         data['distribution'] = self
         data['pyprob_version'] = __version__
         data['torch_version'] = torch.__version__
 
-        def thread_save():
-            tmp_dir = tempfile.mkdtemp(suffix=str(uuid.uuid4()))
-            tmp_file_name = os.path.join(tmp_dir, 'pyprob_distribution')
-            torch.save(data, tmp_file_name)
-            tar = tarfile.open(file_name, 'w:gz', compresslevel=2)
-            tar.add(tmp_file_name, arcname='pyprob_distribution')
-            tar.close()
-            shutil.rmtree(tmp_dir)
-        t = Thread(target=thread_save)
-        t.start()
-        t.join()
+        future = util.save_tar_async(file_name, [('pyprob_distribution', data)])
+        if not background:
+            future.result()
+        return future
 
     @staticmethod
     def load(file_name):
         try:
-            tar = tarfile.open(file_name, 'r:gz')
-            tmp_dir = tempfile.mkdtemp(suffix=str(uuid.uuid4()))
-            tmp_file = os.path.join(tmp_dir, 'pyprob_distribution')
-            tar.extract('pyprob_distribution', tmp_dir)
-            tar.close()
             if util._cuda_enabled:
-                data = torch.load(tmp_file)
+                data = util.load_tar(file_name, 'pyprob_distribution')
             else:
-                data = torch.load(tmp_file, map_location=lambda storage, loc: storage)
-            shutil.rmtree(tmp_dir)
+                data = util.load_tar(file_name, 'pyprob_distribution', map_location=lambda storage, loc: storage)
         except:
             raise RuntimeError('Cannot load distribution.')
 
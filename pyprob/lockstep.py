@@ -0,0 +1,182 @@
+import threading
+import torch
+from collections import OrderedDict
+
+from . import state, util, TraceMode, InferenceEngine
+from .nn import _proposal_group_key, proposal_layers_forward_grouped
+
+
+class ProposalRow(object):
+    # One row of a batched proposal distribution, as seen by one particle
+    # Values are drawn for all the rows at once, with their log_probs; log_prob of another value than the one last drawn is evaluated with the batched distribution
+    def __init__(self, distribution, row, values=None, log_probs=None):
+        self.distribution = distribution
+        self.row = row
+        self._values = values
+        self._drawn_values = values
+        self._log_probs = log_probs
+
+    def __repr__(self):
+        return 'ProposalRow(row:{}, distribution:{})'.format(self.row, self.distribution)
+
+    def sample(self):
+        if self._values is None:
+            self._values = self.distribution.sample()
+            self._drawn_values = self._values
+            self._log_probs = self.distribution.log_prob(self._values)
+        value = self._values[self.row:self.row + 1]
+        self._values = None  # Further samples (of replaced addresses) draw new values
+        return value
+
+    def log_prob(self, value):
+        if self._drawn_values is None:
+            values = self.distribution.sample()
+        else:
+            if torch.equal(util.to_variable(value).view_as(self._drawn_values[self.row]), self._drawn_values[self.row]):
+                return self._log_probs[self.row]
+            values = self._drawn_values.clone()
+        values[self.row] = util.to_variable(value).view_as(values[self.row])
+        return self.distribution.log_prob(values)[self.row]
+
+
+class _ParticleCancelled(BaseException):
+    # Raised in the thread of a particle that the engine stops before its trace is finished; a BaseException, so that models catching Exception do not keep running
+    pass
+
+
+class Particle(object):
+    def __init__(self, engine, trace_state):
+        self.engine = engine
+        self.trace_state = trace_state
+        self.resume = threading.Semaphore(0)
+        self.new_trace = True
+        self.hidden_state = None
+        self.request = None
+        self.response = None
+        self.trace = None
+        self.exception = None
+        self.done = False
+        self.cancelled = False
+        self.thread = None
+
+    def propose(self, current_sample):
+        # Called by pyprob.sample in the thread of the particle, blocks until the engine has made the proposals for all the particles
+        self.request = current_sample
+        self.engine._main.release()
+        self.resume.acquire()
+        if self.cancelled:
+            raise _ParticleCancelled()
+        ret = self.response
+        self.request = None
+        self.response = None
+        return ret
+
+
+class LockstepEngine(object):
+    # Importance sampling with an inference network, running num_particles traces concurrently
+    # Each particle runs the model in its own thread until it needs a proposal. Once all the particles are waiting, the inference network makes all the proposals with one batched time step, and the proposal layers are evaluated once per group of addresses with the same layer type and shape
+    # Only one thread runs at any time, and the global trace state in pyprob.state is switched with the running particle
+    def __init__(self, model, inference_network, num_particles, observation_importance_exponent=1., args=(), kwargs={}):
+        self._model = model
+        self._inference_network = inference_network
+        self._num_particles = num_particles
+        self._observation_importance_exponent = observation_importance_exponent
+        self._args = args
+        self._kwargs = kwargs
+        self._main = threading.Semaphore(0)
+
+    def _particle_main(self, particle):
+        particle.resume.acquire()
+        try:
+            if particle.cancelled:
+                raise _ParticleCancelled()
+            state.begin_trace(self._model.forward, TraceMode.POSTERIOR, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK, inference_network=self._inference_network, observation_importance_exponent=self._observation_importance_exponent, lockstep_particle=particle)
+            result = self._model.forward(*self._args, **self._kwargs)
+            particle.trace = state.end_trace(result)
+        except BaseException as e:
+            particle.exception = e
+        particle.done = True
+        self._main.release()
+
+    def _switch_to(self, particle):
+        # Runs the particle until it requests a proposal or finishes
+        state.set_trace_state(particle.trace_state)
+        particle.resume.release()
+        self._main.acquire()
+        particle.trace_state = state.get_trace_state()
+
+    def _propose(self, particles):
+        valid = []
+        for particle in particles:
+            previous_sample = None if particle.new_trace else particle.trace_state['_current_trace_previous_sample']
+            particle.new_trace = False
+            if self._inference_network.can_propose(previous_sample, particle.request):
+                valid.append((particle, previous_sample))
+            else:
+                print('Warning: no proposal could be made, prior will be used')
+                particle.response = particle.request.distribution
+        if len(valid) == 0:
+            return
+
+        proposal_inputs, hidden_states = self._inference_network.forward_time_steps([particle.hidden_state for particle, _ in valid], [previous_sample for _, previous_sample in valid], [particle.request for particle, _ in valid])
+        groups = OrderedDict()
+        for i, (particle, hidden_state) in enumerate(zip([particle for particle, _ in valid], hidden_states)):
+            particle.hidden_state = hidden_state
+            address = particle.request.address
+            groups.setdefault(_proposal_group_key(self._inference_network._proposal_layers[address]), OrderedDict()).setdefault(address, []).append(i)
+
+        for addresses in groups.values():
+            proposal_layers = [self._inference_network._proposal_layers[address] for address in addresses]
+            inputs = [proposal_inputs.index_select(0, torch.tensor(indices, dtype=torch.long, device=proposal_inputs.device)) for indices in addresses.values()]
+            samples = [[valid[i][0].request for i in indices] for indices in addresses.values()]
+            if len(proposal_layers) == 1:
+                proposal_distribution = proposal_layers[0](inputs[0], samples[0])
+            elif all([proposal_layer is proposal_layers[0] for proposal_layer in proposal_layers]):
+                # Addresses sharing a proposal layer
+                proposal_distribution = proposal_layers[0](torch.cat(inputs), [sample for address_samples in samples for sample in address_samples])
+            else:
+                proposal_distribution = proposal_layers_forward_grouped(proposal_layers, inputs, samples)
+            values = proposal_distribution.sample()
+            log_probs = proposal_distribution.log_prob(values)
+            row = 0
+            for indices in addresses.values():
+                for i in indices:
+                    valid[i][0].response = ProposalRow(proposal_distribution, row, values, log_probs)
+                    row += 1
+
+    def run(self, num_traces):
+        main_trace_state = state.get_trace_state()
+        self._inference_network.new_trace(util.pack_observes_to_variable(self._kwargs['observation']).unsqueeze(0))
+        traces = []
+        particles = []
+        num_started = 0
+        try:
+            with torch.no_grad():
+                while len(traces) < num_traces:
+                    while (len(particles) < self._num_particles) and (num_started < num_traces):
+                        particle = Particle(self, main_trace_state)
+                        particle.thread = threading.Thread(target=self._particle_main, args=(particle,), daemon=True)
+                        particle.thread.start()
+                        particles.append(particle)
+                        num_started += 1
+                        self._switch_to(particle)
+                    for particle in particles:
+                        if particle.done:
+                            if particle.exception is not None:
+                                raise particle.exception
+                            traces.append(particle.trace)
+                    particles = [particle for particle in particles if not particle.done]
+                    if len(particles) > 0:
+                        self._propose(particles)
+                        for particle in particles:
+                            self._switch_to(particle)
+        finally:
+            # Particles still waiting for a proposal (e.g., after another particle raised an exception) are released and their threads joined
+            for particle in particles:
+                if not particle.done:
+                    particle.cancelled = True
+                    particle.resume.release()
+                    self._main.acquire()
+                particle.thread.join()
+            state.set_trace_state(main_trace_state)
+        return traces
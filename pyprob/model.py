@@ -1,20 +1,28 @@
 import torch
 import torch.nn as nn
+import torch.distributed
+import torch.optim as optim
 import time
 import sys
 import os
 import uuid
-from threading import Thread
+import copy
 from termcolor import colored
 import math
 import random
 import tarfile
 import tempfile
 import shutil
+import multiprocessing
+import io
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
 from .distributions import Empirical
-from . import state, util, __version__, TraceMode, InferenceEngine, InferenceNetwork, PriorInflation, Optimizer, TrainingObservation
-from .nn import ObserveEmbedding, SampleEmbedding, Batch, InferenceNetworkSimple, InferenceNetworkLSTM
+from .trace import TensorReference
+from . import state, util, __version__, TraceMode, InferenceEngine, InferenceNetwork, PriorInflation, Optimizer, TrainingObservation, ProposalArchitecture, AddressEviction
+from .nn import ObserveEmbedding, SampleEmbedding, Batch, InferenceNetworkSimple, InferenceNetworkLSTM, InferenceNetworkTorchScript, export_torchscript, quantize_dynamic, add_new_parameter_groups, SparseStepOptimizer
+from .lockstep import LockstepEngine
 from .remote import ModelServer
 from .analytics import save_report
 
@@ -26,15 +34,23 @@ class Model(nn.Module):
         self._inference_network = None
         self._trace_cache_path = None
         self._trace_cache = []
+        self._trace_cache_buckets = {}
         self._trace_cache_discarded_file_names = []
+        self._trace_cache_num_loaded_files = 0
+        self._trace_cache_num_unreadable_files = 0
+        self._trace_cache_tensors = {}
+        self._trace_cache_claim_files = False
+        self._trace_cache_claim_lease_seconds = 600
 
     def forward(self):
         raise NotImplementedError()
 
     def _trace_generator(self, trace_mode=TraceMode.PRIOR, prior_inflation=PriorInflation.DISABLED, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, inference_network=None, metropolis_hastings_trace=None, observation_importance_exponent=1., *args, **kwargs):
+        if inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK:
+            observes = util.pack_observes_to_variable(kwargs['observation']).unsqueeze(0)
         while True:
             if inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK:
-                self._inference_network.new_trace(util.pack_observes_to_variable(kwargs['observation']).unsqueeze(0))
+                self._inference_network.new_trace(observes)
             state.begin_trace(self.forward, trace_mode, prior_inflation, inference_engine, inference_network, metropolis_hastings_trace, observation_importance_exponent)
             result = self.forward(*args, **kwargs)
             trace = state.end_trace(result)
@@ -100,7 +116,7 @@ class Model(nn.Module):
     def posterior_distribution(self, *args, **kwargs):
         return self.posterior_traces(*args, **kwargs).map(lambda x: x.result)
 
-    def posterior_traces(self, num_traces=1000, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, burn_in=None, initial_trace=None, observation_importance_exponent=1., *args, **kwargs):
+    def posterior_traces(self, num_traces=1000, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, burn_in=None, initial_trace=None, observation_importance_exponent=1., lockstep_particles=None, *args, **kwargs):
         if (inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK) and (self._inference_network is None):
             raise RuntimeError('Cannot run inference with inference network because there is none available. Use learn_inference_network first.')
         if burn_in is not None:
@@ -116,7 +132,16 @@ class Model(nn.Module):
             name = 'Posterior, importance sampling (with proposal = prior), num_traces={:,}'.format(num_traces)
         elif inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK:
             self._inference_network.eval()
-            traces = self._traces(num_traces=num_traces, trace_mode=TraceMode.POSTERIOR, inference_engine=inference_engine, inference_network=self._inference_network, observation_importance_exponent=observation_importance_exponent, *args, **kwargs)
+            if (lockstep_particles is not None) and isinstance(self._inference_network, InferenceNetworkTorchScript):
+                raise ValueError('Lockstep inference is not supported with an exported (TorchScript) inference network.')
+            if (lockstep_particles is not None) and getattr(self._inference_network, '_quantized', False):
+                raise ValueError('Lockstep inference is not supported with a quantized inference network.')
+            if lockstep_particles is None:
+                with torch.no_grad():
+                    traces = self._traces(num_traces=num_traces, trace_mode=TraceMode.POSTERIOR, inference_engine=inference_engine, inference_network=self._inference_network, observation_importance_exponent=observation_importance_exponent, *args, **kwargs)
+            else:
+                # Runs lockstep_particles traces concurrently, with batched inference network evaluations
+                traces = LockstepEngine(self, self._inference_network, lockstep_particles, observation_importance_exponent, args, kwargs).run(num_traces)
             log_weights = [trace.log_importance_weight for trace in traces]
             name = 'Posterior, importance sampling (with learned proposal, training_traces={:,}), num_traces={:,}'.format(self._inference_network._total_train_traces, num_traces)
         else:  # inference_engine == InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS or inference_engine == InferenceEngine.RANDOM_WALK_METROPOLIS_HASTINGS
@@ -172,19 +197,30 @@ class Model(nn.Module):
             # ret.name += ' (effective sample size: {:,.2f})'.format(float(ret.effective_sample_size))
         return Empirical(traces, log_weights, name=name)
 
-    def learn_inference_network(self, inference_network=InferenceNetwork.LSTM, training_observation=TrainingObservation.OBSERVE_DIST_SAMPLE, prior_inflation=PriorInflation.DISABLED, observe_embedding=ObserveEmbedding.FULLY_CONNECTED, observe_reshape=None, observe_embedding_dim=128, sample_embedding=SampleEmbedding.FULLY_CONNECTED, lstm_dim=128, lstm_depth=2, sample_embedding_dim=16, address_embedding_dim=128, batch_size=64, valid_size=256, valid_interval=2048, optimizer_type=Optimizer.ADAM, learning_rate=0.0001, momentum=0.9, weight_decay=1e-5, num_traces=-1, use_trace_cache=False, auto_save=False, auto_save_file_name='pyprob_inference_network', *args, **kwargs):
+    def learn_inference_network(self, inference_network=InferenceNetwork.LSTM, training_observation=TrainingObservation.OBSERVE_DIST_SAMPLE, prior_inflation=PriorInflation.DISABLED, observe_embedding=ObserveEmbedding.FULLY_CONNECTED, observe_reshape=None, observe_embedding_dim=128, sample_embedding=SampleEmbedding.FULLY_CONNECTED, lstm_dim=128, lstm_depth=2, sample_embedding_dim=16, address_embedding_dim=128, batch_size=64, valid_size=256, valid_interval=2048, optimizer_type=Optimizer.ADAM, learning_rate=0.0001, momentum=0.9, weight_decay=1e-5, num_traces=-1, use_trace_cache=False, homogeneous_batches=False, pre_allocate_layers=False, pack_sub_batches=False, num_processes=1, hogwild=False, num_producers=0, producer_queue_size=8, proposal_architecture=ProposalArchitecture.PER_ADDRESS, max_addresses=None, address_eviction=AddressEviction.LEAST_RECENTLY_USED, address_spill_path=None, autotune=False, autotune_batch_sizes=None, autotune_num_threads=None, autotune_memory_limit=None, autotune_probe_seconds=2., auto_save=False, auto_save_file_name='pyprob_inference_network', *args, **kwargs):
         if use_trace_cache and self._trace_cache_path is None:
             print('Warning: There is no trace cache assigned, training with online trace generation.')
             use_trace_cache = False
 
-        if use_trace_cache:
-            print('Using trace cache to train...')
-
-            def new_batch_func(size=batch_size, discard_source=False):
-                if discard_source:
-                    self._trace_cache = []
+        if isinstance(self._inference_network, InferenceNetworkTorchScript):
+            raise RuntimeError('Cannot train an exported (TorchScript) inference network. Load the network saved with save_inference_network to continue training.')
+        if getattr(self._inference_network, '_quantized', False):
+            raise RuntimeError('Cannot train a quantized inference network. Restore the network returned by quantize_inference_network to continue training.')
+        if (max_addresses is not None) and (num_processes > 1):
+            raise ValueError('Address eviction (max_addresses) is not supported with num_processes > 1.')
+        if (max_addresses is not None) and (inference_network != InferenceNetwork.LSTM):
+            raise ValueError('Address eviction (max_addresses) is supported only with InferenceNetwork.LSTM.')
+        if autotune and (num_processes > 1):
+            raise ValueError('Autotuning is not supported with num_processes > 1.')
+
+        producers = []
+        status_func = None
+        # The producers are terminated however training ends, including errors while creating the network or autotuning after they have started
+        try:
+            if use_trace_cache:
+                print('Using trace cache to train...')
 
-                while len(self._trace_cache) < size:
+                def load_traces_from_cache(discard_source=False):
                     current_files = self._trace_cache_current_files()
                     if len(current_files) == 0:
                         cache_is_empty = True
@@ -197,51 +233,368 @@ class Model(nn.Module):
                                 if cache_was_empty:
                                     print('Resuming, new data appeared in trace cache (currently with {} files) at {}'.format(num_files, self._trace_cache_path))
                             else:
+                                if (self._trace_cache_num_loaded_files == 0) and (self._trace_cache_num_unreadable_files > 0):
+                                    # Waiting would never end if no file of the trace cache can be read
+                                    raise RuntimeError('Cannot load traces from any of the {} files read from trace cache at {}'.format(self._trace_cache_num_unreadable_files, self._trace_cache_path))
                                 if not cache_was_empty:
                                     print('Waiting for new data, empty (or fully discarded) trace cache at {}'.format(self._trace_cache_path))
                                     cache_was_empty = True
+                                if self._trace_cache_claim_files:
+                                    self.reclaim_trace_cache_leases()
                                 time.sleep(0.5)
 
-                    current_file = random.choice(current_files)
-                    if discard_source:
-                        self._trace_cache_discarded_file_names.append(current_file)
-                    new_traces = self._load_traces(current_file)
+                    if self._trace_cache_claim_files:
+                        current_file = self._claim_trace_cache_file(current_files)
+                        if current_file is None:  # All current files were claimed by other processes
+                            return []
+                        new_traces = self._load_traces(current_file)
+                        self._consume_trace_cache_file(current_file)
+                    else:
+                        current_file = random.choice(current_files)
+                        if discard_source:
+                            self._trace_cache_discarded_file_names.append(current_file)
+                        new_traces = self._load_traces(current_file)
                     if len(new_traces) == 0:  # When empty or corrupt file is read
                         self._trace_cache_discarded_file_names.append(current_file)
+                        self._trace_cache_num_unreadable_files += 1
                     else:
+                        self._trace_cache_num_loaded_files += 1
                         random.shuffle(new_traces)
-                        self._trace_cache += new_traces
+                    return new_traces
 
-                traces = self._trace_cache[0:size]
-                self._trace_cache[0:size] = []
-                return Batch(traces)
+                def new_batch_func(size=batch_size, discard_source=False):
+                    if discard_source:
+                        self._trace_cache = []
+
+                    if homogeneous_batches and not discard_source:
+                        # Assemble the batch from traces of a single trace type, so that it has only one sub-batch
+                        while True:
+                            trace_type, bucket = max(self._trace_cache_buckets.items(), key=lambda b: len(b[1]), default=(None, []))
+                            if (len(bucket) >= size) or (sum([len(b) for b in self._trace_cache_buckets.values()]) >= 4 * size):
+                                break
+                            for trace in load_traces_from_cache():
+                                self._trace_cache_buckets.setdefault(trace.trace_type(), []).append(trace)
+                        traces = bucket[0:size]
+                        bucket[0:size] = []
+                        if len(bucket) == 0:
+                            del self._trace_cache_buckets[trace_type]
+                        return Batch(traces)
+
+                    while len(self._trace_cache) < size:
+                        self._trace_cache += load_traces_from_cache(discard_source)
+
+                    traces = self._trace_cache[0:size]
+                    self._trace_cache[0:size] = []
+                    return Batch(traces)
+            elif num_producers > 0:
+                # Producer processes generate traces while the network trains, the bounded queue holds at most producer_queue_size chunks of batch_size traces
+                print('Using {} trace producers to train...'.format(num_producers))
+                # Processes are forked after torch's thread pools may have started, which relies on torch reinitializing them in the child; the producers use one thread each
+                util.wait_saves()
+                context = multiprocessing.get_context('fork')
+                queue = context.Queue(maxsize=producer_queue_size)
+                producer_busy_seconds = context.Value('d', 0.)
+                for i in range(num_producers):
+                    producer = context.Process(target=self._trace_producer, args=(queue, producer_busy_seconds, batch_size, random.randrange(2 ** 30) + i, prior_inflation, args, kwargs), daemon=True)
+                    producer.start()
+                    producers.append(producer)
+                producers_time_start = time.time()
+                consumer_wait_seconds = [0.]
+                trace_buffer = []
+
+                def new_batch_func(size=batch_size, discard_source=False):
+                    while len(trace_buffer) < size:
+                        time_start = time.time()
+                        data = queue.get()
+                        consumer_wait_seconds[0] += time.time() - time_start
+                        trace_buffer.extend(torch.load(io.BytesIO(data), weights_only=False))  # The producers send pickled traces
+                    traces = trace_buffer[0:size]
+                    trace_buffer[0:size] = []
+                    return Batch(traces)
+
+                def status_func():
+                    duration = time.time() - producers_time_start
+                    return 'Prod. {:.0%} Cons. {:.0%} Queue {}/{}'.format(producer_busy_seconds.value / (duration * num_producers), 1. - consumer_wait_seconds[0] / duration, queue.qsize(), producer_queue_size)
+            else:
+                def new_batch_func(size=batch_size, discard_source=False):
+                    traces = self._traces(size, trace_mode=TraceMode.PRIOR, prior_inflation=prior_inflation, *args, **kwargs)
+                    return Batch(traces)
+
+            if self._inference_network is None:
+                print('Creating new inference network...')
+                valid_batch = new_batch_func(valid_size, discard_source=True)
+                if inference_network == InferenceNetwork.SIMPLE:
+                    self._inference_network = InferenceNetworkSimple(model_name=self.name, observe_embedding=observe_embedding, observe_reshape=observe_reshape, observe_embedding_dim=observe_embedding_dim, valid_batch=valid_batch)
+                else:  # inference_network == InferenceNetwork.LSTM:
+                    self._inference_network = InferenceNetworkLSTM(model_name=self.name, lstm_dim=lstm_dim, lstm_depth=lstm_depth, observe_embedding=observe_embedding, observe_reshape=observe_reshape, observe_embedding_dim=observe_embedding_dim, sample_embedding=sample_embedding, sample_embedding_dim=sample_embedding_dim, address_embedding_dim=address_embedding_dim, proposal_architecture=proposal_architecture, max_addresses=max_addresses, address_eviction=address_eviction, address_spill_path=address_spill_path, valid_batch=valid_batch)
+
+                self._inference_network.polymorph()
+            else:
+                print('Continuing to train existing inference network...')
+                if self._inference_network._valid_batch is None:
+                    # Networks loaded without their validation batch
+                    print('Generating new validation batch...')
+                    self._inference_network._valid_batch = new_batch_func(valid_size, discard_source=True)
+                    if self._inference_network._on_cuda:
+                        self._inference_network._valid_batch.cuda(self._inference_network._cuda_device)
+                    self._inference_network.polymorph()
+
+            if use_trace_cache and pre_allocate_layers:
+                # Create the layers for all addresses in the trace cache before the first optimizer step, instead of discovering them batch by batch during training
+                print('Pre-allocating layers for all addresses in the trace cache...')
+                statistics = self.trace_cache_statistics()
+                example_traces = [t['example_trace'] for t in statistics['trace_types'].values() if t['length'] > 0]
+                self._inference_network.polymorph(Batch(example_traces), count_stats=False)
+
+            self._inference_network.train()
+            if autotune:
+                if autotune_batch_sizes is None:
+                    autotune_batch_sizes = sorted(set([max(1, batch_size // 4), max(1, batch_size // 2), batch_size, 2 * batch_size, 4 * batch_size]))
+                if autotune_num_threads is None:
+                    autotune_num_threads = sorted(set([2 ** i for i in range(int(math.log2(os.cpu_count() or 1)) + 1)] + [os.cpu_count() or 1]))
+                batch_size, num_threads, autotune_traces = self._autotune(new_batch_func, autotune_batch_sizes, autotune_num_threads, autotune_memory_limit, autotune_probe_seconds, training_observation, optimizer_type, learning_rate, momentum, weight_decay, pack_sub_batches)
+                torch.set_num_threads(num_threads)
+                untuned_batch_func = new_batch_func
+
+                def new_batch_func(size=batch_size, discard_source=False):
+                    # The traces drawn for autotuning are trained on first
+                    if len(autotune_traces) == 0:
+                        return untuned_batch_func(size, discard_source)
+                    traces = autotune_traces[0:size]
+                    autotune_traces[0:size] = []
+                    if len(traces) < size:
+                        traces += untuned_batch_func(size - len(traces), discard_source).batch
+                    return Batch(traces)
+
+            optimize_kwargs = dict(new_batch_func=new_batch_func, training_observation=training_observation, optimizer_type=optimizer_type, num_traces=num_traces, learning_rate=learning_rate, momentum=momentum, weight_decay=weight_decay, valid_interval=valid_interval, auto_save=auto_save, auto_save_file_name=auto_save_file_name, pack_sub_batches=pack_sub_batches, status_func=status_func)
+            if num_processes > 1:
+                self._optimize_parallel(num_processes, hogwild, optimize_kwargs)
+            else:
+                self._inference_network.optimize(**optimize_kwargs)
+        finally:
+            for producer in producers:
+                producer.terminate()
+                producer.join()
+
+    def _autotune(self, new_batch_func, batch_sizes, num_threads, memory_limit, probe_seconds, training_observation, optimizer_type, learning_rate, momentum, weight_decay, pack_sub_batches):
+        # Runs short timed training probes for all the combinations of batch sizes and torch thread counts, and returns the (batch_size, num_threads) with the highest throughput (traces/sec) among those keeping memory under memory_limit (bytes, default: 90% of physical memory), and the traces drawn for probing
+        # The probes train a copy of the inference network on a pool of traces drawn once, so that the parameters, statistics, and spill files of the network are left as they are; the pool is returned to be trained on first
+        if memory_limit is None:
+            memory_physical = util.memory_physical()
+            memory_limit = float('inf') if memory_physical is None else 0.9 * memory_physical
+        network = self._inference_network
+        memory_base = self._autotune_memory(network)
+        traces = list(new_batch_func(2 * max(batch_sizes)).batch)
+        random.shuffle(traces)  # Batch sorts its traces by length, probe batches mix trace types as training batches do
+        valid_batch = network._valid_batch
+        network._valid_batch = None  # Not copied
+        try:
+            probe_network = copy.deepcopy(network)
+        finally:
+            network._valid_batch = valid_batch
+        if hasattr(probe_network, '_evicted_addresses'):
+            # The layers of evicted addresses are created anew in the copy, which spills to a temporary directory of its own
+            probe_network._evicted_addresses = {}
+            probe_network._address_spill_path = None
+            probe_network._address_spill_dir = None
+        num_threads_initial = torch.get_num_threads()
+        best = None
+        print('Autotuning batch size and number of threads (memory limit: {})...'.format('none' if memory_limit == float('inf') else '{:,} MiB'.format(int(memory_limit / 2 ** 20))))
+        print('Threads | Batch size | Sub-batches | Traces/sec    | Memory increase (MiB)')
+        try:
+            for threads in sorted(num_threads):
+                torch.set_num_threads(threads)
+                for batch_size in sorted(batch_sizes):
+                    traces_per_sec, sub_batches, memory = self._autotune_probe(probe_network, traces, batch_size, memory_limit - memory_base if memory_base is not None else float('inf'), probe_seconds, training_observation, optimizer_type, learning_rate, momentum, weight_decay, pack_sub_batches)
+                    memory_str = 'n/a' if memory is None else '{:,}'.format(int(memory / 2 ** 20))
+                    if traces_per_sec is None:
+                        # Larger batches would exceed the limit as well
+                        print('{} | {} | {} | {} | {} (over limit)'.format(str(threads).rjust(7), str(batch_size).rjust(10), ''.rjust(11), ''.rjust(13), memory_str))
+                        break
+                    print('{} | {} | {:11.2f} | {:13,.2f} | {}'.format(str(threads).rjust(7), str(batch_size).rjust(10), sub_batches, traces_per_sec, memory_str))
+                    if (best is None) or (traces_per_sec > best[0]):
+                        best = (traces_per_sec, batch_size, threads)
+        finally:
+            torch.set_num_threads(num_threads_initial)
+        if best is None:
+            raise RuntimeError('Autotuning failed, all the probed configurations exceed the memory limit.')
+        print('Autotuning chose batch size: {:,}, threads: {} ({:,.2f} traces/sec)'.format(best[1], best[2], best[0]))
+        return best[1], best[2], traces
+
+    @staticmethod
+    def _autotune_memory(network, peak=False):
+        # Memory in use (or its peak since the last reset, on CUDA), or None if it cannot be measured
+        if network._on_cuda:
+            return torch.cuda.max_memory_allocated(network._cuda_device) if peak else torch.cuda.memory_allocated(network._cuda_device)
+        return util.memory_resident()
+
+    def _autotune_probe(self, network, traces, batch_size, memory_limit, probe_seconds, training_observation, optimizer_type, learning_rate, momentum, weight_decay, pack_sub_batches):
+        # Returns traces/sec, mean sub-batches per batch, and the memory increase over the start of the probe; traces/sec is None if the increase went over memory_limit
+        # The resident memory of a process rarely shrinks, so the increase of each probe is measured from its own start rather than compared with earlier probes
+        # Batches are taken in turn from traces. The first iteration is a warm-up and is not timed, it also creates the layers for the addresses seen first
+        if optimizer_type == Optimizer.ADAM:
+            optimizer = optim.Adam(network._parameter_groups(), lr=learning_rate, weight_decay=weight_decay)
+        else:  # optimizer_type == Optimizer.SGD:
+            optimizer = optim.SGD(network._parameter_groups(), lr=learning_rate, momentum=momentum, nesterov=True, weight_decay=weight_decay)
+        optimizer = SparseStepOptimizer(optimizer)
+        if network._on_cuda:
+            torch.cuda.reset_max_memory_allocated(network._cuda_device)
+        memory_start = self._autotune_memory(network)
+        memory_increase = None
+        num_traces = 0
+        num_sub_batches = 0
+        num_batches = 0
+        offset = 0
+        time_start = None
+        while True:
+            batch = Batch([traces[(offset + i) % len(traces)] for i in range(batch_size)])
+            offset = (offset + batch_size) % len(traces)
+            if network.polymorph(batch):
+                add_new_parameter_groups(optimizer, network._parameter_groups())
+            network.loss(batch, optimizer, training_observation, pack_sub_batches)
+            memory = self._autotune_memory(network, peak=True)
+            if (memory is not None) and (memory_start is not None):
+                memory_increase = max(0, memory - memory_start) if memory_increase is None else max(memory_increase, memory - memory_start)
+                if memory_increase > memory_limit:
+                    return None, None, memory_increase
+            if time_start is None:
+                time_start = time.time()
+                continue
+            num_traces += batch.length
+            num_sub_batches += len(batch.sub_batches)
+            num_batches += 1
+            duration = time.time() - time_start
+            if duration >= probe_seconds:
+                return num_traces / duration, num_sub_batches / num_batches, memory_increase
+
+    def _trace_producer(self, queue, busy_seconds, chunk_size, random_seed, prior_inflation, args, kwargs):
+        # Traces are sent serialized, as sharing the many small tensors of a trace between processes is slower than copying them
+        util.set_random_seed(random_seed)
+        torch.set_num_threads(1)
+        while True:
+            time_start = time.time()
+            traces = self._traces(chunk_size, trace_mode=TraceMode.PRIOR, prior_inflation=prior_inflation, *args, **kwargs)
+            buffer = io.BytesIO()
+            torch.save(traces, buffer)
+            with busy_seconds.get_lock():
+                busy_seconds.value += time.time() - time_start
+            queue.put(buffer.getvalue())  # Blocks while the queue is full
+
+    def _optimize_parallel(self, num_processes, hogwild, optimize_kwargs):
+        # Trains with one forked process per rank, each drawing its own batches
+        # Default: synchronous data-parallel training over the gloo backend
+        # Hogwild: the network is in shared memory and the processes update it without locks, only for InferenceNetworkSimple and with the layers fixed beforehand
+        if util._cuda_enabled:
+            raise RuntimeError('Parallel training is supported only on CPU.')
+        if hogwild:
+            if not isinstance(self._inference_network, InferenceNetworkSimple):
+                raise ValueError('Hogwild training is supported only for InferenceNetworkSimple.')
+            print('Training with {} processes (Hogwild)...'.format(num_processes))
+            self._inference_network.share_memory()
         else:
-            def new_batch_func(size=batch_size, discard_source=False):
-                traces = self._traces(size, trace_mode=TraceMode.PRIOR, prior_inflation=prior_inflation, *args, **kwargs)
-                return Batch(traces)
+            print('Training with {} processes...'.format(num_processes))
+        tmp_dir = tempfile.mkdtemp(suffix=str(uuid.uuid4()))
+        init_file_name = os.path.join(tmp_dir, 'pyprob_process_group')
+        result_file_name = os.path.join(tmp_dir, 'pyprob_inference_network')
+        # The batch function is a closure and cannot be pickled. Processes are forked after torch's thread pools may have started, which relies on torch reinitializing them in the child; each rank uses its share of the threads
+        util.wait_saves()
+        context = multiprocessing.get_context('fork')
+        trace_counter = context.Value('l', 0) if hogwild else None
+        total_train_traces = self._inference_network._total_train_traces
+        num_threads = max(1, torch.get_num_threads() // num_processes)
+        processes = [context.Process(target=self._optimize_rank, args=(rank, num_processes, init_file_name, result_file_name, trace_counter, num_threads, optimize_kwargs)) for rank in range(num_processes)]
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        try:
+            if any(p.exitcode != 0 for p in processes):
+                raise RuntimeError('Parallel training failed, exit codes: {}'.format([p.exitcode for p in processes]))
+            self._inference_network = self._inference_network._load(result_file_name)
+            if hogwild:
+                # The saved network (from rank 0) counts only the traces of rank 0
+                self._inference_network._total_train_traces = total_train_traces + trace_counter.value
+        finally:
+            shutil.rmtree(tmp_dir)
 
-        if self._inference_network is None:
-            print('Creating new inference network...')
-            valid_batch = new_batch_func(valid_size, discard_source=True)
-            if inference_network == InferenceNetwork.SIMPLE:
-                self._inference_network = InferenceNetworkSimple(model_name=self.name, observe_embedding=observe_embedding, observe_reshape=observe_reshape, observe_embedding_dim=observe_embedding_dim, valid_batch=valid_batch)
-            else:  # inference_network == InferenceNetwork.LSTM:
-                self._inference_network = InferenceNetworkLSTM(model_name=self.name, lstm_dim=lstm_dim, lstm_depth=lstm_depth, observe_embedding=observe_embedding, observe_reshape=observe_reshape, observe_embedding_dim=observe_embedding_dim, sample_embedding=sample_embedding, sample_embedding_dim=sample_embedding_dim, address_embedding_dim=address_embedding_dim, valid_batch=valid_batch)
-
-            self._inference_network.polymorph()
+    def _optimize_rank(self, rank, world_size, init_file_name, result_file_name, trace_counter, num_threads, optimize_kwargs):
+        util.set_random_seed(random.randrange(2 ** 30) + rank)  # The random state is inherited from the parent, each rank needs its own
+        torch.set_num_threads(num_threads)
+        if rank != 0:
+            sys.stdout = open(os.devnull, 'w')
+        if trace_counter is None:
+            torch.distributed.init_process_group('gloo', init_method='file://' + init_file_name, rank=rank, world_size=world_size)
+            self._inference_network.optimize(distributed=True, **optimize_kwargs)
+            torch.distributed.destroy_process_group()
         else:
-            print('Continuing to train existing inference network...')
-
-        self._inference_network.train()
-        self._inference_network.optimize(new_batch_func, training_observation, optimizer_type, num_traces, learning_rate, momentum, weight_decay, valid_interval, auto_save, auto_save_file_name)
+            if rank != 0:
+                # Validation and saving happen on rank 0 only
+                optimize_kwargs = dict(optimize_kwargs, valid_interval=float('inf'), auto_save=False)
+            self._inference_network.optimize(hogwild_trace_counter=trace_counter, **optimize_kwargs)
+        if rank == 0:
+            self._inference_network._save(result_file_name).result()
 
     def save_inference_network(self, file_name):
         if self._inference_network is None:
             raise RuntimeError('The model has no trained inference network.')
-        self._inference_network._save(file_name)
+        self._inference_network._save(file_name).result()
 
     def load_inference_network(self, file_name):
-        self._inference_network = InferenceNetworkSimple._load(file_name, util._cuda_enabled, util._cuda_device)
+        # Loads networks saved with save_inference_network or export_inference_network
+        if InferenceNetworkTorchScript._is_exported(file_name):
+            self._inference_network = InferenceNetworkTorchScript._load(file_name, util._cuda_enabled, util._cuda_device)
+        else:
+            self._inference_network = InferenceNetworkSimple._load(file_name, util._cuda_enabled, util._cuda_device)
+
+    def export_inference_network(self, file_name):
+        # Exports the inference network with TorchScript, for importance sampling in deployments that load it with load_inference_network
+        if self._inference_network is None:
+            raise RuntimeError('The model has no trained inference network.')
+        if isinstance(self._inference_network, InferenceNetworkTorchScript):
+            raise RuntimeError('The inference network is already exported.')
+        export_torchscript(self._inference_network, file_name).result()
+
+    def quantize_inference_network(self):
+        # Replaces the inference network with a copy whose LSTM and linear layers are dynamically quantized to int8, for faster importance sampling on CPU. Returns the original network
+        if self._inference_network is None:
+            raise RuntimeError('The model has no trained inference network.')
+        if isinstance(self._inference_network, InferenceNetworkTorchScript) or getattr(self._inference_network, '_quantized', False):
+            raise RuntimeError('Only a trained (not exported or already quantized) inference network can be quantized.')
+        ret = self._inference_network
+        self._inference_network = quantize_dynamic(ret)
+        return ret
+
+    def quantization_report(self, num_traces=1000, random_seed=123, *args, **kwargs):
+        # Runs importance sampling with the inference network and with a quantized copy of it, with the same random seed, and reports the effective sample sizes, log evidence estimates and time per trace of both
+        if self._inference_network is None:
+            raise RuntimeError('The model has no trained inference network.')
+        if isinstance(self._inference_network, InferenceNetworkTorchScript) or getattr(self._inference_network, '_quantized', False):
+            raise RuntimeError('Only a trained (not exported or already quantized) inference network can be quantized.')
+        inference_network = self._inference_network
+        results = {}
+        try:
+            for name, network in [('float', inference_network), ('quantized', quantize_dynamic(inference_network))]:
+                self._inference_network = network
+                util.set_random_seed(random_seed)
+                time_start = time.time()
+                posterior = self.posterior_traces(num_traces, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK, *args, **kwargs)
+                duration = time.time() - time_start
+                log_weights = util.to_variable(posterior._initial_log_weights).view(-1)
+                results[name + '_effective_sample_size'] = float(posterior.effective_sample_size)
+                results[name + '_log_evidence'] = float(util.log_sum_exp(log_weights) - math.log(num_traces))
+                results[name + '_log_weight_mean'] = float(log_weights.mean())
+                results[name + '_seconds_per_trace'] = duration / num_traces
+        finally:
+            self._inference_network = inference_network
+        results['log_evidence_difference'] = results['quantized_log_evidence'] - results['float_log_evidence']
+        results['log_weight_mean_difference'] = results['quantized_log_weight_mean'] - results['float_log_weight_mean']
+        results['speedup'] = results['float_seconds_per_trace'] / results['quantized_seconds_per_trace']
+        print('Quantization report, num_traces={:,}'.format(num_traces))
+        print('Network   | ESS          | Log evidence | Log weight mean | Sec/trace')
+        for name in ['float', 'quantized']:
+            print('{} | {:12,.2f} | {:+.5e} | {:+.8e} | {:.3e}'.format(name.ljust(9), results[name + '_effective_sample_size'], results[name + '_log_evidence'], results[name + '_log_weight_mean'], results[name + '_seconds_per_trace']))
+        print('Log evidence difference: {:+.5e}, log weight mean difference: {:+.5e}, speedup: {:.2f}x'.format(results['log_evidence_difference'], results['log_weight_mean_difference'], results['speedup']))
+        return results
 
     def trace_length_mean(self, num_traces=1000, *args, **kwargs):
         trace_lengths = self._traces(num_traces, trace_mode=TraceMode.PRIOR, map_func=lambda trace: trace.length, *args, **kwargs)
@@ -263,62 +616,223 @@ class Model(nn.Module):
         trace_length_dist = Empirical(trace_lengths)
         return trace_length_dist.max
 
-    def save_trace_cache(self, trace_cache_path, files=16, traces_per_file=512, prior_inflation=PriorInflation.DISABLED, *args, **kwargs):
+    def save_trace_cache(self, trace_cache_path, files=16, traces_per_file=512, prior_inflation=PriorInflation.DISABLED, group_by_trace_type=False, deduplicate_across_files=False, *args, **kwargs):
+        if deduplicate_across_files:
+            tensor_store_path = os.path.join(trace_cache_path, 'pyprob_tensors')
+            os.makedirs(tensor_store_path, exist_ok=True)
+        else:
+            tensor_store_path = None
         f = 0
         done = False
+        buckets = {}
+        futures = []
         while not done:
+            futures = [future for future in futures if not future.done()]
             traces = self._traces(traces_per_file, trace_mode=TraceMode.PRIOR, prior_inflation=prior_inflation, *args, **kwargs)
-            file_name = os.path.join(trace_cache_path, 'pyprob_traces_{}_{}'.format(traces_per_file, str(uuid.uuid4())))
-            self._save_traces(traces, file_name)
-            f += 1
-            if (files != -1) and (f >= files):
-                done = True
-
-    def use_trace_cache(self, trace_cache_path):
+            if not group_by_trace_type:
+                file_name = os.path.join(trace_cache_path, 'pyprob_traces_{}_{}'.format(traces_per_file, str(uuid.uuid4())))
+                futures.append(self._save_traces(traces, file_name, tensor_store_path=tensor_store_path))
+                f += 1
+                if (files != -1) and (f >= files):
+                    done = True
+            else:
+                # Each file holds traces of only one trace type (address sequence), so that training batches can be assembled from a single bucket
+                for trace in traces:
+                    buckets.setdefault(trace.trace_type(), []).append(trace)
+                flush = [(trace_type, traces_per_file) for trace_type, b in buckets.items() if len(b) >= traces_per_file]
+                if (len(flush) == 0) and (sum([len(b) for b in buckets.values()]) >= 4 * traces_per_file):
+                    # Bound the memory held by rare trace types by writing the largest bucket
+                    trace_type = max(buckets, key=lambda t: len(buckets[t]))
+                    flush = [(trace_type, len(buckets[trace_type]))]
+                for trace_type, length in flush:
+                    while (not done) and (len(buckets.get(trace_type, [])) >= length):
+                        futures.append(self._save_trace_type(buckets, trace_type, length, trace_cache_path, tensor_store_path))
+                        f += 1
+                        if (files != -1) and (f >= files):
+                            done = True
+        if group_by_trace_type:
+            # The partly filled buckets are written as well, one file each and not counted in files, so that no generated trace is dropped
+            for trace_type in list(buckets.keys()):
+                futures.append(self._save_trace_type(buckets, trace_type, len(buckets[trace_type]), trace_cache_path, tensor_store_path))
+        for future in futures:
+            future.result()
+
+    def _save_trace_type(self, buckets, trace_type, length, trace_cache_path, tensor_store_path):
+        # Writes the first length traces of a bucket, removing the bucket when it becomes empty
+        traces = buckets[trace_type][0:length]
+        buckets[trace_type][0:length] = []
+        if len(buckets[trace_type]) == 0:
+            del buckets[trace_type]
+        file_name = os.path.join(trace_cache_path, 'pyprob_traces_{}_{}_{}'.format(len(traces), trace_type, str(uuid.uuid4())))
+        return self._save_traces(traces, file_name, trace_type, tensor_store_path=tensor_store_path)
+
+    def use_trace_cache(self, trace_cache_path, claim_files=False, claim_lease_seconds=600):
+        # With claim_files=True, several trainer processes can share one trace cache: each file is claimed by atomically renaming it into the claimed/ subdirectory and, once read, moved into the consumed/ subdirectory, so that no two processes train on the same file
         self._trace_cache_path = trace_cache_path
+        self._trace_cache_num_loaded_files = 0
+        self._trace_cache_num_unreadable_files = 0
+        self._trace_cache_claim_files = claim_files
+        self._trace_cache_claim_lease_seconds = claim_lease_seconds
+        if claim_files:
+            os.makedirs(os.path.join(trace_cache_path, 'claimed'), exist_ok=True)
+            os.makedirs(os.path.join(trace_cache_path, 'consumed'), exist_ok=True)
         num_files = len(self._trace_cache_current_files())
         print('Monitoring trace cache (currently with {} files) at {}'.format(num_files, trace_cache_path))
 
     def _trace_cache_current_files(self):
         files = [name for name in os.listdir(self._trace_cache_path)]
         files = list(map(lambda f: os.path.join(self._trace_cache_path, f), files))
+        files = [f for f in files if os.path.isfile(f) and not os.path.basename(f).startswith('.')]  # Skip files still being written
         for discarded_file_name in self._trace_cache_discarded_file_names:
             if discarded_file_name in files:
                 files.remove(discarded_file_name)
         return files
 
-    def _save_traces(self, traces, file_name):
+    def _claim_trace_cache_file(self, current_files):
+        claimed_path = os.path.join(self._trace_cache_path, 'claimed')
+        current_files = list(current_files)
+        random.shuffle(current_files)
+        for current_file in current_files:
+            claimed_file = os.path.join(claimed_path, os.path.basename(current_file))
+            try:
+                # The modification time of a claimed file marks the start of its lease
+                os.utime(current_file, None)
+                os.rename(current_file, claimed_file)
+                return claimed_file
+            except OSError:  # The file was claimed by another process in the meantime
+                continue
+        return None
+
+    def _consume_trace_cache_file(self, claimed_file):
+        consumed_file = os.path.join(self._trace_cache_path, 'consumed', os.path.basename(claimed_file))
+        try:
+            os.rename(claimed_file, consumed_file)
+        except OSError:
+            print(colored('Warning: lease expired and file reclaimed before it was consumed: {}'.format(claimed_file), 'red', attrs=['bold']))
+
+    def reclaim_trace_cache_leases(self, lease_seconds=None):
+        # Returns the claimed files whose lease expired (e.g., abandoned by a crashed trainer) to the trace cache
+        if self._trace_cache_path is None:
+            raise RuntimeError('There is no trace cache assigned. Use use_trace_cache first.')
+        if lease_seconds is None:
+            lease_seconds = self._trace_cache_claim_lease_seconds
+        claimed_path = os.path.join(self._trace_cache_path, 'claimed')
+        if not os.path.isdir(claimed_path):
+            return 0
+        reclaimed = 0
+        now = time.time()
+        for name in os.listdir(claimed_path):
+            claimed_file = os.path.join(claimed_path, name)
+            try:
+                if now - os.path.getmtime(claimed_file) > lease_seconds:
+                    os.rename(claimed_file, os.path.join(self._trace_cache_path, name))
+                    reclaimed += 1
+            except OSError:  # Consumed or reclaimed by another process in the meantime
+                continue
+        if reclaimed > 0:
+            print('Reclaimed {} file(s) with expired leases in trace cache at {}'.format(reclaimed, self._trace_cache_path))
+        return reclaimed
+
+    @staticmethod
+    def _trace_types(traces):
+        # Returns trace_type -> [count, example_trace]
+        trace_types = OrderedDict()
+        for trace in traces:
+            trace_type = trace.trace_type()
+            if trace_type in trace_types:
+                trace_types[trace_type][0] += 1
+            else:
+                trace_types[trace_type] = [1, trace]
+        return trace_types
+
+    def _deduplicate_tensors(self, traces, tensor_store_path=None, tensor_store_min_elements=1024):
+        # Tensors with equal content (e.g., observations shared by many traces) are replaced with a single tensor, which torch.save stores only once
+        # With a tensor_store_path, large tensors that occur more than once (or that are already in the store) are moved to a content-addressed store shared by all files in the trace cache, and replaced with TensorReferences
+        keys = {}
+        canonical_tensors = {}
+        counts = {}
+
+        def canonicalize(tensor):
+            if id(tensor) not in keys:
+                keys[id(tensor)] = (util.tensor_content_hash(tensor), tensor)
+            key = keys[id(tensor)][0]
+            counts[key] = counts.get(key, 0) + 1
+            return canonical_tensors.setdefault(key, tensor)
+
+        for trace in traces:
+            trace.map_tensors(canonicalize)
+
+        stored_tensors = {}
+        if tensor_store_path is not None:
+            for key, tensor in canonical_tensors.items():
+                if tensor.nelement() < tensor_store_min_elements:
+                    continue
+                tensor_file_name = os.path.join(tensor_store_path, key)
+                if os.path.exists(tensor_file_name):
+                    stored_tensors[key] = tensor
+                elif counts[key] > 1:
+                    tmp_file_name = os.path.join(tensor_store_path, '.{}.{}.tmp'.format(key, str(uuid.uuid4())))
+                    torch.save(tensor.detach().cpu().clone(), tmp_file_name)
+                    os.replace(tmp_file_name, tensor_file_name)
+                    stored_tensors[key] = tensor
+            if len(stored_tensors) > 0:
+                references = dict([(id(tensor), TensorReference(key)) for key, tensor in stored_tensors.items()])
+                for trace in traces:
+                    trace.map_tensors(lambda tensor: references.get(id(tensor), tensor))
+        return stored_tensors
+
+    def _resolve_tensor_references(self, traces, file_name, tensor_store):
+        trace_cache_path = os.path.dirname(file_name) if self._trace_cache_path is None else self._trace_cache_path
+        tensor_store_path = os.path.join(trace_cache_path, tensor_store)
+
+        def resolve(value):
+            if isinstance(value, TensorReference):
+                if value.key not in self._trace_cache_tensors:
+                    # Tensors loaded from the store are kept and shared between all traces referring to them
+                    # The store holds plain tensors, loaded on the CPU and moved together with their traces
+                    self._trace_cache_tensors[value.key] = torch.load(os.path.join(tensor_store_path, value.key), map_location=lambda storage, loc: storage, weights_only=True)
+                return self._trace_cache_tensors[value.key]
+            return value
+
+        for trace in traces:
+            trace.map_tensors(resolve)
+
+    def _save_traces(self, traces, file_name, trace_type=None, tensor_store_path=None):
+        stored_tensors = self._deduplicate_tensors(traces, tensor_store_path)
+        tensor_store = os.path.basename(tensor_store_path) if len(stored_tensors) > 0 else None
+
         data = {}
         data['traces'] = traces
         data['length'] = len(traces)
+        data['trace_type'] = trace_type
+        data['tensor_store'] = tensor_store
         data['model_name'] = self.name
         data['pyprob_version'] = __version__
         data['torch_version'] = torch.__version__
 
-        def thread_save():
-            tmp_dir = tempfile.mkdtemp(suffix=str(uuid.uuid4()))
-            tmp_file_name = os.path.join(tmp_dir, 'pyprob_traces')
-            torch.save(data, tmp_file_name)
-            tar = tarfile.open(file_name, 'w:gz', compresslevel=2)
-            tar.add(tmp_file_name, arcname='pyprob_traces')
-            tar.close()
-            shutil.rmtree(tmp_dir)
-        t = Thread(target=thread_save)
-        t.start()
-        t.join()
+        # A small header with one example trace per trace type is stored as the first member of the archive, so that it can be read without decompressing the traces
+        header = {}
+        header['length'] = len(traces)
+        header['trace_types'] = self._trace_types(traces)
+        header['tensor_store'] = tensor_store
+        header['model_name'] = self.name
+        header['pyprob_version'] = __version__
+        header['torch_version'] = torch.__version__
+
+        future = util.save_tar_async(file_name, [('pyprob_traces_header', header), ('pyprob_traces', data)])
+
+        if len(stored_tensors) > 0:
+            # Put the tensors back in place of the references, as the traces can still be used after saving
+            for trace in traces:
+                trace.map_tensors(lambda value: stored_tensors[value.key] if isinstance(value, TensorReference) else value)
+        return future
 
     def _load_traces(self, file_name):
         try:
-            tar = tarfile.open(file_name, 'r:gz')
-            tmp_dir = tempfile.mkdtemp(suffix=str(uuid.uuid4()))
-            tmp_file = os.path.join(tmp_dir, 'pyprob_traces')
-            tar.extract('pyprob_traces', tmp_dir)
-            tar.close()
             if util._cuda_enabled:
-                data = torch.load(tmp_file)
+                data = util.load_tar(file_name, 'pyprob_traces')
             else:
-                data = torch.load(tmp_file, map_location=lambda storage, loc: storage)
-            shutil.rmtree(tmp_dir)
+                data = util.load_tar(file_name, 'pyprob_traces', map_location=lambda storage, loc: storage)
         except:
             print('Warning: cannot load traces from file, file potentially corrupt: {}'.format(file_name))
             return []
@@ -332,11 +846,68 @@ class Model(nn.Module):
             print(colored('Warning: different PyTorch versions (loaded traces: {}, current system: {})'.format(data['torch_version'], torch.__version__), 'red', attrs=['bold']))
 
         traces = data['traces']
+        if data.get('tensor_store') is not None:
+            self._resolve_tensor_references(traces, file_name, data['tensor_store'])
         if util._cuda_enabled:
             for trace in traces:
                 trace.cuda()
         return data['traces']
 
+    def _load_traces_header(self, file_name):
+        # Returns None for files without a header (saved by earlier versions) or files that cannot be read
+        try:
+            tar = tarfile.open(file_name, 'r:gz')
+            tarinfo = tar.next()  # Unlike tar.getmember, this does not scan the whole archive
+            if (tarinfo is None) or (tarinfo.name != 'pyprob_traces_header'):
+                tar.close()
+                return None
+            buffer = io.BytesIO(tar.extractfile(tarinfo).read())
+            tar.close()
+            # The header holds pickled example traces, which weights_only loading rejects
+            if util._cuda_enabled:
+                header = torch.load(buffer, weights_only=False)
+            else:
+                header = torch.load(buffer, map_location=lambda storage, loc: storage, weights_only=False)
+        except:
+            return None
+        example_traces = [example_trace for _, example_trace in header['trace_types'].values()]
+        if header.get('tensor_store') is not None:
+            self._resolve_tensor_references(example_traces, file_name, header['tensor_store'])
+        if util._cuda_enabled:
+            for example_trace in example_traces:
+                example_trace.cuda()
+        return header
+
+    def _trace_cache_file_trace_types(self, file_name):
+        header = self._load_traces_header(file_name)
+        if header is None:
+            return self._trace_types(self._load_traces(file_name))
+        else:
+            return header['trace_types']
+
+    def trace_cache_statistics(self, num_workers=8):
+        if self._trace_cache_path is None:
+            raise RuntimeError('There is no trace cache assigned. Use use_trace_cache first.')
+        files = self._trace_cache_current_files()
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            files_trace_types = list(executor.map(self._trace_cache_file_trace_types, files))
+
+        num_traces = 0
+        trace_types = OrderedDict()
+        addresses = OrderedDict()
+        for file_trace_types in files_trace_types:
+            for trace_type, (count, example_trace) in file_trace_types.items():
+                num_traces += count
+                if trace_type not in trace_types:
+                    trace_types[trace_type] = {'count': 0, 'length': example_trace.length, 'example_trace': example_trace}
+                trace_types[trace_type]['count'] += count
+                for sample in example_trace.samples:
+                    if sample.address not in addresses:
+                        addresses[sample.address] = {'count': 0, 'distribution': sample.distribution.name}
+                    addresses[sample.address]['count'] += count
+        print('Trace cache at {} has {:,} files, {:,} traces, {:,} trace types, {:,} controlled addresses'.format(self._trace_cache_path, len(files), num_traces, len(trace_types), len(addresses)))
+        return {'num_files': len(files), 'num_traces': num_traces, 'trace_types': trace_types, 'addresses': addresses}
+
     def save_analytics(self, file_name, detailed_traces=2):
         if self._inference_network is None:
             raise RuntimeError('Analytics is currently available only with a trained inference network. Use learn_inference_network first.')
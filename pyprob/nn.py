@@ -1,25 +1,184 @@
 import random
 import gc
 import sys
+import os
+import copy
+import tempfile
+import uuid
+import shutil
+import weakref
+import io
+import json
+import pickle
+import tarfile
+import functools
+import types
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn import Parameter
 import torch.optim as optim
+import torch.distributed as dist
 from termcolor import colored
-from threading import Thread
 import time
-import tempfile
-import uuid
-import shutil
-import os
-import tarfile
 from collections import OrderedDict
 
-from . import util, __version__, ObserveEmbedding, SampleEmbedding, Optimizer, TrainingObservation
+from . import util, __version__, ObserveEmbedding, SampleEmbedding, ProposalArchitecture, AddressEviction, Optimizer, TrainingObservation
 from .distributions import Categorical, Mixture, Normal, TruncatedNormal, Uniform, Poisson, Kumaraswamy
 
 
+_proposal_group_max_elements = 2 ** 24  # Maximum number of stacked weight elements in one grouped proposal evaluation
+_proposal_group_cache_size = 16  # Number of groups of proposal layers whose stacked weights are kept for evaluation without autograd
+_address_embedding_chunk_size = 1024  # Number of address embeddings allocated at a time
+
+
+class SampleColumns(object):
+    # The samples at one time step of a sub-batch as columns: the stacked sample values and the stacked parameters of the prior distributions used by the proposal layers
+    _prior_parameter_names = {'Normal': ['mean', 'stddev'], 'Uniform': ['mean', 'stddev', 'low', 'high'], 'Poisson': ['mean', 'stddev']}
+
+    def __init__(self, values, prior_parameters):
+        self.values = values
+        self.prior_parameters = prior_parameters
+
+    def __len__(self):
+        return self.values.size(0)
+
+    @staticmethod
+    def from_samples(samples):
+        values = torch.stack([s.value for s in samples])
+        names = SampleColumns._prior_parameter_names.get(samples[0].distribution.name, [])
+        return SampleColumns(values, {name: torch.stack([getattr(s.distribution, name) for s in samples]) for name in names})
+
+    @staticmethod
+    def cat(columns):
+        if len(columns) == 1:
+            return columns[0]
+        return SampleColumns(torch.cat([c.values for c in columns]), {name: torch.cat([c.prior_parameters[name] for c in columns]) for name in columns[0].prior_parameters})
+
+    def cuda(self, device=None):
+        return SampleColumns(self.values.cuda(device), {k: v.cuda(device) for k, v in self.prior_parameters.items()})
+
+    def cpu(self):
+        return SampleColumns(self.values.cpu(), {k: v.cpu() for k, v in self.prior_parameters.items()})
+
+
+def _prior_parameter(samples, name, first=False):
+    # The stacked parameter of the prior distributions of samples, given as a list of samples or as SampleColumns; with first=True, the first element of the parameter of each sample
+    if isinstance(samples, SampleColumns):
+        ret = samples.prior_parameters[name]
+        return ret[:, 0] if first else ret
+    if first:
+        return torch.stack([getattr(s.distribution, name)[0] for s in samples])
+    return torch.stack([getattr(s.distribution, name) for s in samples])
+
+
+def _concat_samples(samples):
+    # Concatenates the samples of several proposal layers, given as lists of samples or as SampleColumns
+    if isinstance(samples[0], SampleColumns):
+        return SampleColumns.cat(samples)
+    return [s for layer_samples in samples for s in layer_samples]
+
+
+def _sample_stacked(name, parameters):
+    # Draws one value per row of the stacked parameters of observe distributions
+    if name == 'Normal':
+        mean, stddev = parameters
+        return mean + stddev * torch.randn_like(mean)
+    elif name == 'Uniform':
+        low, high = parameters
+        return low + torch.rand_like(low) * (high - low)
+    elif name == 'Categorical':
+        probs, = parameters
+        return torch.multinomial(probs, 1).view(-1).float()
+    else:  # name == 'Poisson'
+        rate, = parameters
+        return torch.poisson(rate)
+
+
+class ObserveColumns(object):
+    # The observes of the traces of a sub-batch, packed for the whole sub-batch at once: the parameters of the observe distributions are stacked once, each observe is sampled with one vectorized call, and the samples are written into a preallocated tensor with the layout of util.pack_observes_to_variable
+    # Sub-batches with differing observes, unsupported observe distributions, or no observes are packed trace by trace with Trace.pack_observes
+    _distribution_parameter_names = {'Normal': ['_mean', '_stddev'], 'Uniform': ['_low', '_high'], 'Categorical': ['_probs'], 'Poisson': ['_rate']}
+
+    def __init__(self, traces):
+        self.traces = traces
+        self.distributions = None
+        self._layout = None
+        self._means = None
+        example_samples = traces[0].samples_observed
+        addresses = [s.address for s in example_samples]
+        if (len(addresses) == 0) or any([[s.address for s in trace.samples_observed] != addresses for trace in traces]):
+            return
+        distributions = []
+        for i, sample in enumerate(example_samples):
+            name = sample.distribution.name
+            if (name not in self._distribution_parameter_names) or ((name == 'Uniform') and (sample.distribution._low.dim() != 1)):
+                return
+            try:
+                # Distribution.sample()[0] as in Trace.pack_observes only depends on the first row of the parameters
+                # The parameters can have different shapes that broadcast (e.g., Normal(mean, 2.0) with a vector mean), so each row is reshaped (or a single element expanded) to the shape of the sample; Categorical probabilities keep their category dimension
+                if name == 'Categorical':
+                    shape = sample.distribution._probs[0].size()
+                else:
+                    shape = sample.distribution.sample()[0].size()
+                parameters = []
+                for parameter_name in self._distribution_parameter_names[name]:
+                    rows = [getattr(trace.samples_observed[i].distribution, parameter_name)[0] for trace in traces]
+                    if any([row.nelement() not in (1, shape.numel()) for row in rows]):
+                        return
+                    parameters.append(torch.stack([row.view(shape) if row.nelement() == shape.numel() else row.view(()).expand(shape) for row in rows]))
+            except (AttributeError, RuntimeError):
+                return
+            distributions.append((name, parameters))
+        self.distributions = distributions
+
+    def _pack_traces(self, training_observation):
+        return torch.stack([trace.pack_observes(training_observation) for trace in self.traces])
+
+    def pack(self, training_observation=TrainingObservation.OBSERVE_DIST_SAMPLE):
+        if self.distributions is None:
+            return self._pack_traces(training_observation)
+        if training_observation == TrainingObservation.OBSERVE_DIST_MEAN:
+            # Deterministic, packed once
+            if self._means is None:
+                self._means = self._pack_traces(training_observation)
+            return self._means
+
+        observes = [_sample_stacked(name, parameters) for name, parameters in self.distributions]
+        length = len(self.traces)
+        if self._layout is None:
+            # Observes of the same shape are stacked, otherwise flattened and concatenated
+            shapes = [o.size()[1:] for o in observes]
+            if all([shape == shapes[0] for shape in shapes]):
+                self._layout = (length, len(observes)) + tuple(shapes[0])
+            else:
+                offsets = [0]
+                for o in observes:
+                    offsets.append(offsets[-1] + o[0].nelement())
+                self._layout = list(zip(offsets[:-1], offsets[1:]))
+        if isinstance(self._layout, tuple):
+            ret = observes[0].new_empty(self._layout)
+            for i, o in enumerate(observes):
+                ret[:, i] = o
+        else:
+            ret = observes[0].new_empty(length, self._layout[-1][1])
+            for (start, end), o in zip(self._layout, observes):
+                ret[:, start:end] = o.view(length, -1)
+        return util.to_variable(ret)
+
+    def cuda(self, device=None):
+        if self.distributions is not None:
+            self.distributions = [(name, [p.cuda(device) for p in parameters]) for name, parameters in self.distributions]
+        self._means = None
+        return self
+
+    def cpu(self):
+        if self.distributions is not None:
+            self.distributions = [(name, [p.cpu() for p in parameters]) for name, parameters in self.distributions]
+        self._means = None
+        return self
+
+
 class Batch(object):
     def __init__(self, traces, sort=True):
         self.batch = traces
@@ -39,11 +198,23 @@ class Batch(object):
         self.sub_batches = []
         for _, t in sb.items():
             self.sub_batches.append(t)
+        self._build_columns()
         if sort:
             # Sort the batch in descreasing trace length
             self.batch = sorted(self.batch, reverse=True, key=lambda t: t.length)
         self.traces_lengths = [t.length for t in self.batch]
 
+    def _build_columns(self):
+        # Sample values, prior parameters, and observe distribution parameters are stacked once here instead of in every loss evaluation, sub_batches_columns[i][time_step] and sub_batches_observes[i] belong to sub_batches[i]
+        self.sub_batches_columns = [[SampleColumns.from_samples([trace.samples[time_step] for trace in sub_batch]) for time_step in range(sub_batch[0].length)] for sub_batch in self.sub_batches]
+        self.sub_batches_observes = [ObserveColumns(sub_batch) for sub_batch in self.sub_batches]
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'sub_batches_observes' not in state:
+            # Batches pickled before columns were kept
+            self._build_columns()
+
     def __getitem__(self, key):
         return self.batch[key]
 
@@ -53,10 +224,14 @@ class Batch(object):
     def cuda(self, device):
         for trace in self.batch:
             trace.cuda(device)
+        self.sub_batches_columns = [[c.cuda(device) for c in columns] for columns in self.sub_batches_columns]
+        self.sub_batches_observes = [o.cuda(device) for o in self.sub_batches_observes]
 
     def cpu(self):
         for trace in self.batch:
             trace.cpu()
+        self.sub_batches_columns = [[c.cpu() for c in columns] for columns in self.sub_batches_columns]
+        self.sub_batches_observes = [o.cpu() for o in self.sub_batches_observes]
 
     def sort_by_observes_length(self):
         return Batch(sorted(self.batch, reverse=True, key=lambda x: x._inference_network_training_observes_variable.nelement()), False)
@@ -85,7 +260,7 @@ class ObserveEmbeddingFC(nn.Module):
 class ObserveEmbeddingConvNet2D5C(nn.Module):
     def __init__(self, input_example_non_batch, output_dim, reshape=None):
         super().__init__()
-        self._reshape = reshape
+        self._reshape = None if reshape is None else list(reshape)
         if self._reshape is not None:
             input_example_non_batch = input_example_non_batch.view(self._reshape)
             self._reshape.insert(0, -1)  # For correct handling of the batch dimension in self.forward
@@ -133,7 +308,7 @@ class ObserveEmbeddingConvNet2D5C(nn.Module):
 class ObserveEmbeddingConvNet3D4C(nn.Module):
     def __init__(self, input_example_non_batch, output_dim, reshape=None):
         super().__init__()
-        self._reshape = reshape
+        self._reshape = None if reshape is None else list(reshape)
         if self._reshape is not None:
             input_example_non_batch = input_example_non_batch.view(self._reshape)
             self._reshape.insert(0, -1)  # For correct handling of the batch dimension in self.forward
@@ -213,7 +388,11 @@ class ProposalCategorical(nn.Module):
     def forward(self, x, samples):
         x = F.relu(self._lin1(x))
         x = self._drop1(x)
-        x = F.softmax(self._lin2(x), dim=1) + util._epsilon
+        x = self._lin2(x)
+        return self._forward_head(x, samples)
+
+    def _forward_head(self, x, samples):
+        x = F.softmax(x, dim=1) + util._epsilon
         return Categorical(probs=x)
 
 
@@ -229,11 +408,14 @@ class ProposalNormal(nn.Module):
     def forward(self, x, samples):
         x = F.relu(self._lin1(x))
         x = self._lin2(x)
+        return self._forward_head(x, samples)
+
+    def _forward_head(self, x, samples):
         means = x[:, 0:self._output_dim]
         stddevs = x[:, self._output_dim:2*self._output_dim]
         stddevs = nn.Softplus()(stddevs)
-        prior_means = torch.stack([s.distribution.mean for s in samples])
-        prior_stddevs = torch.stack([s.distribution.stddev for s in samples])
+        prior_means = _prior_parameter(samples, 'mean')
+        prior_stddevs = _prior_parameter(samples, 'stddev')
         means = prior_means + (means * prior_stddevs)
         stddevs = stddevs * prior_stddevs
         return Normal(means, stddevs)
@@ -251,10 +433,13 @@ class ProposalUniform(nn.Module):
     def forward(self, x, samples):
         x = F.relu(self._lin1(x))
         x = self._lin2(x)
+        return self._forward_head(x, samples)
+
+    def _forward_head(self, x, samples):
         # prior_means = util.to_variable(torch.stack([s.distribution.mean[0] for s in samples]))
-        prior_stddevs = util.to_variable(torch.stack([s.distribution.stddev[0] for s in samples]))
-        prior_lows = util.to_variable(torch.stack([s.distribution.low for s in samples]))
-        prior_highs = util.to_variable(torch.stack([s.distribution.high for s in samples]))
+        prior_stddevs = util.to_variable(_prior_parameter(samples, 'stddev', first=True))
+        prior_lows = util.to_variable(_prior_parameter(samples, 'low'))
+        prior_highs = util.to_variable(_prior_parameter(samples, 'high'))
         means = x[:, 0].unsqueeze(1)
         means = prior_lows + F.sigmoid(means) * (prior_highs - prior_lows)
         stddevs = x[:, 1].unsqueeze(1)
@@ -274,15 +459,18 @@ class ProposalUniformMixture(nn.Module):
     def forward(self, x, samples):
         x = F.relu(self._lin1(x))
         x = self._lin2(x)
+        return self._forward_head(x, samples)
+
+    def _forward_head(self, x, samples):
         means = x[:, 0:self._mixture_components]
         stddevs = x[:, self._mixture_components:2*self._mixture_components]
         coeffs = x[:, 2*self._mixture_components:3*self._mixture_components]
         stddevs = F.softplus(stddevs)
         coeffs = F.softmax(coeffs, dim=1)
-        prior_means = util.to_variable(torch.stack([s.distribution.mean[0] for s in samples]))
-        prior_stddevs = util.to_variable(torch.stack([s.distribution.stddev[0] for s in samples]))
-        prior_lows = util.to_variable(torch.stack([s.distribution.low[0] for s in samples]))
-        prior_highs = util.to_variable(torch.stack([s.distribution.high[0] for s in samples]))
+        prior_means = util.to_variable(_prior_parameter(samples, 'mean', first=True))
+        prior_stddevs = util.to_variable(_prior_parameter(samples, 'stddev', first=True))
+        prior_lows = util.to_variable(_prior_parameter(samples, 'low', first=True))
+        prior_highs = util.to_variable(_prior_parameter(samples, 'high', first=True))
         prior_means = prior_means.expand_as(means)
         prior_stddevs = prior_stddevs.expand_as(means)
 
@@ -304,6 +492,9 @@ class ProposalUniformKumaraswamyMixture(nn.Module):
     def forward(self, x, samples):
         x = F.relu(self._lin1(x))
         x = self._lin2(x)
+        return self._forward_head(x, samples)
+
+    def _forward_head(self, x, samples):
         shape1s = x[:, 0:self._mixture_components]
         shape1s = 2. + F.relu(shape1s)
         shape2s = x[:, self._mixture_components:2*self._mixture_components]
@@ -312,8 +503,8 @@ class ProposalUniformKumaraswamyMixture(nn.Module):
         coeffs = F.softmax(coeffs, dim=1)
         # prior_means = util.to_variable(torch.stack([s.distribution.mean[0] for s in samples]))
         # prior_stddevs = util.to_variable(torch.stack([s.distribution.stddev[0] for s in samples]))
-        prior_lows = util.to_variable(torch.stack([s.distribution.low for s in samples]))
-        prior_highs = util.to_variable(torch.stack([s.distribution.high for s in samples]))
+        prior_lows = util.to_variable(_prior_parameter(samples, 'low'))
+        prior_highs = util.to_variable(_prior_parameter(samples, 'high'))
         # means = prior_means + (means * prior_stddevs)
         # stddevs = stddevs * prior_stddevs
         # return TruncatedNormal(means, stddevs, prior_lows, prior_highs)
@@ -334,14 +525,17 @@ class ProposalUniformKumaraswamy(nn.Module):
     def forward(self, x, samples):
         x = F.relu(self._lin1(x))
         x = self._lin2(x)
+        return self._forward_head(x, samples)
+
+    def _forward_head(self, x, samples):
         shape1s = x[:, 0].unsqueeze(1)
         shape1s = 2. + F.relu(shape1s)
         shape2s = x[:, 1].unsqueeze(1)
         shape2s = 1. + F.relu(shape2s)
         # prior_means = util.to_variable(torch.stack([s.distribution.mean[0] for s in samples]))
         # prior_stddevs = util.to_variable(torch.stack([s.distribution.stddev[0] for s in samples]))
-        prior_lows = util.to_variable(torch.stack([s.distribution.low for s in samples]))
-        prior_highs = util.to_variable(torch.stack([s.distribution.high for s in samples]))
+        prior_lows = util.to_variable(_prior_parameter(samples, 'low'))
+        prior_highs = util.to_variable(_prior_parameter(samples, 'high'))
         # means = prior_means + (means * prior_stddevs)
         # stddevs = stddevs * prior_stddevs
         # return TruncatedNormal(means, stddevs, prior_lows, prior_highs)
@@ -363,18 +557,255 @@ class ProposalPoisson(nn.Module):
     def forward(self, x, samples):
         x = F.relu(self._lin1(x))
         x = self._lin2(x)
+        return self._forward_head(x, samples)
+
+    def _forward_head(self, x, samples):
         means = x[:, 0].unsqueeze(1)
         stddevs = x[:, 1].unsqueeze(1)
         stddevs = F.softplus(stddevs)
-        prior_means = util.to_variable(torch.stack([s.distribution.mean[0] for s in samples]))
-        prior_stddevs = util.to_variable(torch.stack([s.distribution.stddev[0] for s in samples]))
+        prior_means = util.to_variable(_prior_parameter(samples, 'mean', first=True))
+        prior_stddevs = util.to_variable(_prior_parameter(samples, 'stddev', first=True))
         means = prior_means + (means * prior_stddevs)
         stddevs = stddevs * prior_stddevs
         return TruncatedNormal(means, stddevs, 0, 40)
 
 
+class ProposalFiLM(nn.Module):
+    # Feature-wise linear modulation of proposal layer inputs by address embeddings, for proposal layers shared by addresses (ProposalArchitecture.SHARED_TRUNK)
+    def __init__(self, address_embedding_dim, input_dim):
+        super().__init__()
+        self._lin = nn.Linear(address_embedding_dim, 2 * input_dim)
+        # Starts as the identity for all addresses
+        nn.init.zeros_(self._lin.weight)
+        nn.init.zeros_(self._lin.bias)
+
+    def forward(self, x, address_embeddings):
+        scales, shifts = self._lin(address_embeddings).chunk(2, dim=1)
+        return x * (1 + scales) + shifts
+
+
+_proposal_layer_classes = {c.__name__: c for c in [ProposalCategorical, ProposalNormal, ProposalUniform, ProposalUniformMixture, ProposalUniformKumaraswamyMixture, ProposalUniformKumaraswamy, ProposalPoisson]}
+
+
+def _proposal_layer_spec(input_dim, distribution):
+    # The class and constructor arguments of the proposal layer for a distribution, kept in checkpoints so that layers can be recreated before loading their parameters
+    if isinstance(distribution, Categorical):
+        return {'class': 'ProposalCategorical', 'args': {'input_dim': input_dim, 'output_dim': distribution.length_categories}}
+    elif isinstance(distribution, Normal):
+        return {'class': 'ProposalNormal', 'args': {'input_dim': input_dim, 'output_dim': distribution.length_variates}}
+    elif isinstance(distribution, Uniform):
+        return {'class': 'ProposalUniformKumaraswamyMixture', 'args': {'input_dim': input_dim}}
+    elif isinstance(distribution, Poisson):
+        return {'class': 'ProposalPoisson', 'args': {'input_dim': input_dim}}
+    else:
+        raise ValueError('Unsupported distribution: {}'.format(distribution.name))
+
+
+def _proposal_layer_spec_of(proposal_layer):
+    # The specification of an existing proposal layer, for networks saved before specifications were kept
+    args = {'input_dim': proposal_layer._lin1.in_features}
+    if isinstance(proposal_layer, ProposalCategorical):
+        args['output_dim'] = proposal_layer._lin2.out_features
+    elif isinstance(proposal_layer, ProposalNormal):
+        args['output_dim'] = proposal_layer._output_dim
+    elif hasattr(proposal_layer, '_mixture_components'):
+        args['mixture_components'] = proposal_layer._mixture_components
+    return {'class': type(proposal_layer).__name__, 'args': args}
+
+
+def _proposal_layer_from_spec(spec):
+    return _proposal_layer_classes[spec['class']](**spec['args'])
+
+
+def _proposal_group_key(proposal_layer):
+    return type(proposal_layer), proposal_layer._lin1.weight.size(), proposal_layer._lin2.weight.size()
+
+
+_proposal_group_cache = OrderedDict()
+
+
+def _proposal_layers_stacked(layers):
+    # The stacked (transposed) weights and biases of proposal layers
+    # Without autograd (e.g., during inference), they are cached and reused until the parameters change, which is detected through the version counters that in-place updates such as optimizer steps increment
+    parameters = [p for layer in layers for p in (layer._lin1.weight, layer._lin1.bias, layer._lin2.weight, layer._lin2.bias)]
+    if not torch.is_grad_enabled():
+        key = tuple([id(layer) for layer in layers])
+        versions = tuple([(p.data_ptr(), p._version) for p in parameters])
+        entry = _proposal_group_cache.get(key)
+        if (entry is not None) and (entry[1] == versions):
+            _proposal_group_cache.move_to_end(key)
+            return entry[2]
+    stacked = (torch.stack(parameters[0::4]).transpose(1, 2), torch.stack(parameters[1::4]).unsqueeze(1), torch.stack(parameters[2::4]).transpose(1, 2), torch.stack(parameters[3::4]).unsqueeze(1))
+    if not torch.is_grad_enabled():
+        # The layers are kept referenced by the entry, so that their ids are not reused while cached
+        _proposal_group_cache[key] = (layers, versions, stacked)
+        while len(_proposal_group_cache) > _proposal_group_cache_size:
+            _proposal_group_cache.popitem(last=False)
+    return stacked
+
+
+def proposal_layers_forward_grouped(proposal_layers, inputs, samples):
+    # Evaluates proposal layers of the same type and shape with batched matrix multiplications instead of separate small ones per layer, the weights are stacked in chunks of bounded size
+    # Returns a single proposal distribution over the concatenated inputs
+    example_layer = proposal_layers[0]
+    chunk_size = max(1, _proposal_group_max_elements // (example_layer._lin1.weight.nelement() + example_layer._lin2.weight.nelement()))
+    outputs = []
+    for i in range(0, len(proposal_layers), chunk_size):
+        layers = proposal_layers[i:i + chunk_size]
+        x = inputs[i:i + chunk_size]
+        lengths = [xi.size(0) for xi in x]
+        x = nn.utils.rnn.pad_sequence(x, batch_first=True)
+        weights1, biases1, weights2, biases2 = _proposal_layers_stacked(tuple(layers))
+        x = F.relu(torch.baddbmm(biases1, x, weights1))
+        if hasattr(example_layer, '_drop1'):
+            x = example_layer._drop1(x)
+        x = torch.baddbmm(biases2, x, weights2)
+        outputs.extend([x[j, :lengths[j]] for j in range(len(layers))])
+    return example_layer._forward_head(torch.cat(outputs), _concat_samples(samples))
+
+
+def quantize_dynamic(network):
+    # Returns a copy of an inference network with its LSTM and linear layers dynamically quantized to int8, for importance sampling on CPU
+    # Weights are stored as int8 and activations are quantized on the fly, which reduces the memory traffic of large LSTM and proposal layers. The copy cannot be trained
+    memo = {} if network._on_cuda else {id(network._valid_batch): network._valid_batch}  # The validation batch is shared with the copy
+    ret = copy.deepcopy(network, memo)
+    if ret._on_cuda:
+        ret.cpu()
+    ret.eval()
+    # Layers are replaced in place within their parent modules, so the _proposal_layers and _sample_embedding_layers dictionaries keep pointing to the (now quantized) layers
+    torch.quantization.quantize_dynamic(ret, {nn.LSTM, nn.Linear}, dtype=torch.qint8, inplace=True)
+    ret._quantized = True
+    return ret
+
+
+def add_new_parameter_groups(optimizer, param_groups):
+    # Adds the parameters of param_groups that are not yet in an optimizer, keeping them in their groups (e.g., one group per address) and keeping the state (e.g., Adam moment estimates) of the existing parameters
+    existing = set([p for group in optimizer.param_groups for p in group['params']])
+    for group in param_groups:
+        params = [p for p in group['params'] if p not in existing]
+        if len(params) > 0:
+            optimizer.add_param_group(dict(group, params=params))
+
+
+def reset_parameter_rows(optimizer, param, rows):
+    # Resets the optimizer state (e.g., Adam moment estimates, SGD momentum) of rows of a parameter, for rows that are given to new entries (e.g., address embeddings)
+    for value in optimizer.state.get(param, {}).values():
+        if torch.is_tensor(value) and (value.size() == param.size()):
+            value[rows] = 0
+
+
+def remove_missing_parameters(optimizer, module):
+    # Removes from an optimizer the parameters, and their state, that are no longer in module (e.g., layers that were evicted)
+    params = set(module.parameters())
+    for group in optimizer.param_groups:
+        for p in group['params']:
+            if p not in params:
+                optimizer.state.pop(p, None)
+        group['params'] = [p for p in group['params'] if p in params]
+    optimizer.param_groups[:] = [group for group in optimizer.param_groups if len(group['params']) > 0]
+
+
+def distributed_sum(value):
+    t = torch.tensor([value], dtype=torch.float64)
+    dist.all_reduce(t)
+    return float(t[0])
+
+
+def distributed_broadcast(value, src=0):
+    t = torch.tensor([value], dtype=torch.float64)
+    dist.broadcast(t, src)
+    return float(t[0])
+
+
+def distributed_polymorph(network, batch):
+    # Layers for the addresses discovered by any rank are created on all ranks in the same order, so that parameters line up across ranks, and are initialized from rank 0
+    new_traces = [sub_batch[0] for sub_batch in batch.sub_batches if any(sample.address not in network._proposal_layers for sample in sub_batch[0].samples)]
+    all_new_traces = [None] * dist.get_world_size()
+    dist.all_gather_object(all_new_traces, new_traces)
+    new_traces = [trace for rank_new_traces in all_new_traces for trace in rank_new_traces]
+    layers_changed = False
+    if len(new_traces) > 0:
+        # The traces of this rank are counted once, by the polymorph of the whole batch below
+        layers_changed = network.polymorph(Batch(new_traces, sort=False), count_stats=False)
+        if layers_changed:
+            for p in network.parameters():
+                dist.broadcast(p.data, 0)
+    network.polymorph(batch)  # Updates address and trace statistics, all the layers exist at this point
+    return layers_changed
+
+
+class DistributedOptimizer(object):
+    # Wraps an optimizer for synchronous data-parallel training, gradients are averaged over all ranks before each step
+    def __init__(self, optimizer, module):
+        self.optimizer = optimizer
+        self.module = module
+        for p in self.module.parameters():
+            dist.broadcast(p.data, 0)
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    @property
+    def state(self):
+        return self.optimizer.state
+
+    def add_param_group(self, param_group):
+        self.optimizer.add_param_group(param_group)
+
+    def zero_grad(self):
+        self.optimizer.zero_grad()
+
+    def step(self):
+        params = list(self.module.parameters())
+        for p in params:
+            if p.grad is None:
+                p.grad = torch.zeros_like(p)  # Parameters not used by the batch of this rank
+        grads = torch.cat([p.grad.data.view(-1) for p in params])
+        dist.all_reduce(grads)
+        grads /= dist.get_world_size()
+        offset = 0
+        for p in params:
+            p.grad.data.copy_(grads[offset:offset + p.nelement()].view_as(p))
+            offset += p.nelement()
+        self.optimizer.step()
+
+
+class SparseStepOptimizer(object):
+    # Wraps an optimizer to step only the parameter groups that received gradients; with the parameters of each address in their own group, the cost of a step depends on the addresses in a batch rather than on the size of the network
+    # Gradients are set to None instead of zero, so that the groups of addresses that are not in a batch keep None gradients and their parameters and optimizer state are not updated
+    def __init__(self, optimizer):
+        self.optimizer = optimizer
+        self._stepped_groups = list(optimizer.param_groups)
+
+    @property
+    def param_groups(self):
+        return self.optimizer.param_groups
+
+    @property
+    def state(self):
+        return self.optimizer.state
+
+    def add_param_group(self, param_group):
+        self.optimizer.add_param_group(param_group)
+
+    def zero_grad(self):
+        for group in self._stepped_groups:
+            for p in group['params']:
+                p.grad = None
+
+    def step(self):
+        param_groups = self.optimizer.param_groups
+        self._stepped_groups = [group for group in param_groups if any([p.grad is not None for p in group['params']])]
+        self.optimizer.param_groups = self._stepped_groups
+        try:
+            self.optimizer.step()
+        finally:
+            self.optimizer.param_groups = param_groups
+
+
 class InferenceNetworkSimple(nn.Module):
-    def __init__(self, model_name='Unnamed model', observe_embedding=ObserveEmbedding.FULLY_CONNECTED, observe_reshape=None, observe_embedding_dim=512, valid_batch=None):
+    def __init__(self, model_name='Unnamed model', observe_embedding=ObserveEmbedding.FULLY_CONNECTED, observe_reshape=None, observe_embedding_dim=512, valid_batch=None, example_observes=None):
         super().__init__()
         self._model_name = model_name
         self._observe_embedding = observe_embedding
@@ -401,8 +832,10 @@ class InferenceNetworkSimple(nn.Module):
         self._modified = util.get_time_str()
         self._updates = 0
         self._pyprob_version = __version__
-        self._torch_version = torch.__version__
+        self._torch_version = str(torch.__version__)
         self._optimizer_type = ''
+        self._quantized = False
+        self._valid_batch_file_name = None
 
         self._state_new_trace = True
         self._state_observes = None
@@ -411,7 +844,9 @@ class InferenceNetworkSimple(nn.Module):
         self._address_stats = OrderedDict()
         self._trace_stats = OrderedDict()
 
-        example_observes = self._valid_batch[0].pack_observes()  # To do: we need to check all the observes in the batch, to be more intelligent
+        if example_observes is None:
+            example_observes = self._valid_batch[0].pack_observes()  # To do: we need to check all the observes in the batch, to be more intelligent
+        self._observe_example_size = list(example_observes.size())
         if self._observe_embedding == ObserveEmbedding.FULLY_CONNECTED:
             self._observe_embedding_layer = ObserveEmbeddingFC(example_observes, self._observe_embedding_dim)
         elif self._observe_embedding == ObserveEmbedding.CONVNET_2D_5C:
@@ -424,31 +859,36 @@ class InferenceNetworkSimple(nn.Module):
             raise ValueError('Unknown observation embedding: {}'.format(self._observe_embedding))
         # self._sample_embedding_layers = {}
         self._proposal_layers = {}
+        self._layer_specs = OrderedDict()
 
     def cuda(self, device=None):
         self._on_cuda = True
         self._cuda_device = device
         super().cuda(device)
-        self._valid_batch.cuda(device)
+        if self._valid_batch is not None:
+            self._valid_batch.cuda(device)
         return self
 
     def cpu(self):
         self._on_cuda = False
         super().cpu()
-        self._valid_batch.cpu()
+        if self._valid_batch is not None:
+            self._valid_batch.cpu()
         return self
 
-    def _update_stats(self, batch):
+    def _update_stats(self, batch, count=True):
+        # With count=False, addresses and trace types are registered (with ids) without counting the traces of batch
         for sub_batch in batch.sub_batches:
             example_trace = sub_batch[0]
+            num_traces = len(sub_batch) if count else 0
             # Update address stats
             for sample in example_trace._samples_all:
                 address = sample.address
                 if address not in self._address_stats:
                     address_id = 'A' + str(len(self._address_stats) + 1)
-                    self._address_stats[address] = [len(sub_batch), address_id, sample.distribution.name, sample.control, sample.replace, sample.observed]
+                    self._address_stats[address] = [num_traces, address_id, sample.distribution.name, sample.control, sample.replace, sample.observed]
                 else:
-                    self._address_stats[address][0] += len(sub_batch)
+                    self._address_stats[address][0] += num_traces
             # Update trace stats
             trace_str = example_trace.addresses()
             if trace_str not in self._trace_stats:
@@ -470,18 +910,31 @@ class InferenceNetworkSimple(nn.Module):
                     elif sample.observed:
                         samples_controlled_observed.append(sample)
                 trace_addresses = [self._address_stats[sample.address][1] for sample in samples_controlled_observed]
-                self._trace_stats[trace_str] = [len(sub_batch), trace_id, len(example_trace._samples_all),  len(example_trace.samples), trace_addresses]
+                self._trace_stats[trace_str] = [num_traces, trace_id, len(example_trace._samples_all),  len(example_trace.samples), trace_addresses]
             else:
-                self._trace_stats[trace_str][0] += len(sub_batch)
-
-    def polymorph(self, batch=None):
+                self._trace_stats[trace_str][0] += num_traces
+
+    def _add_layers(self, address, spec):
+        self._layer_specs[address] = spec
+        proposal_layer = _proposal_layer_from_spec(spec['proposal'])
+        self._proposal_layers[address] = proposal_layer
+        self.add_module('proposal_layer({})'.format(address), proposal_layer)
+
+    def _parameter_groups(self):
+        # Optimizer parameter groups, one for the parameters of each address and one for the others
+        address_params = [list(proposal_layer.parameters()) for proposal_layer in self._proposal_layers.values()]
+        grouped = set([p for params in address_params for p in params])
+        return [{'params': [p for p in self.parameters() if p not in grouped]}] + [{'params': params} for params in address_params]
+
+    def polymorph(self, batch=None, count_stats=True):
+        # With count_stats=False, the layers for batch are created without counting its traces in the address and trace statistics (e.g., for batches of example traces)
         if batch is None:
             if self._valid_batch is None:
                 return
             else:
                 batch = self._valid_batch
 
-        self._update_stats(batch)
+        self._update_stats(batch, count_stats)
 
         layers_changed = False
         for sub_batch in batch.sub_batches:
@@ -493,20 +946,7 @@ class InferenceNetworkSimple(nn.Module):
 
                 if address not in self._proposal_layers:
                     print('New layers for address ({}): {}'.format(self._address_stats[address][1], util.truncate_str(address)))
-
-                    if isinstance(distribution, Categorical):
-                        proposal_layer = ProposalCategorical(self._observe_embedding_dim, distribution.length_categories)
-                    elif isinstance(distribution, Normal):
-                        proposal_layer = ProposalNormal(self._observe_embedding_dim, distribution.length_variates)
-                    elif isinstance(distribution, Uniform):
-                        proposal_layer = ProposalUniformKumaraswamyMixture(self._observe_embedding_dim)
-                    elif isinstance(distribution, Poisson):
-                        proposal_layer = ProposalPoisson(self._observe_embedding_dim)
-                    else:
-                        raise ValueError('Unsupported distribution: {}'.format(distribution.name))
-
-                    self._proposal_layers[address] = proposal_layer
-                    self.add_module('proposal_layer({})'.format(address), proposal_layer)
+                    self._add_layers(address, {'proposal': _proposal_layer_spec(self._observe_embedding_dim, distribution)})
                     layers_changed = True
 
         if layers_changed:
@@ -517,15 +957,18 @@ class InferenceNetworkSimple(nn.Module):
             self._history_num_params.append(num_params)
             self._history_num_params_trace.append(self._total_train_traces)
 
-        if self._on_cuda:
-            self.cuda(self._cuda_device)
+            if self._on_cuda:
+                self.cuda(self._cuda_device)
 
         return layers_changed
 
     def new_trace(self, observes=None):
         self._state_new_trace = True
+        # The observation embedding is reused while the observation does not change (e.g., for all the particles of a posterior query)
+        if (self._state_observes is None) or ((observes is not self._state_observes) and not ((observes.size() == self._state_observes.size()) and torch.equal(observes, self._state_observes))):
+            with torch.no_grad():
+                self._state_observes_embedding = self._observe_embedding_layer.forward(observes)
         self._state_observes = observes
-        self._state_observes_embedding = self._observe_embedding_layer.forward(observes)
 
     def forward_one_time_step(self, previous_sample, current_sample):
         if self._state_observes is None:
@@ -545,12 +988,24 @@ class InferenceNetworkSimple(nn.Module):
             print('Warning: no proposal could be made, prior will be used')
             return current_distribution
 
-    def loss(self, batch, optimizer=None, training_observation=TrainingObservation.OBSERVE_DIST_SAMPLE):
+    def can_propose(self, previous_sample, current_sample):
+        if current_sample.address not in self._proposal_layers:
+            print('Warning: no proposal layer for: {}'.format(current_sample.address))
+            return False
+        return True
+
+    def forward_time_steps(self, hidden_states, previous_samples, current_samples):
+        # Batched forward_one_time_step for particles running in lockstep, returns the proposal inputs and the new hidden states (this network has none)
+        return self._state_observes_embedding.expand(len(current_samples), -1), hidden_states
+
+    def loss(self, batch, optimizer=None, training_observation=TrainingObservation.OBSERVE_DIST_SAMPLE, pack_sub_batches=False):
+        # With pack_sub_batches=True, one optimizer step is taken for the whole batch instead of one per sub-batch
         gc.collect()
 
         batch_loss = 0
-        for sub_batch in batch.sub_batches:
-            obs = torch.stack([trace.pack_observes(training_observation) for trace in sub_batch])
+        batch_log_prob = 0
+        for sub_batch, sub_batch_columns, sub_batch_observes in zip(batch.sub_batches, batch.sub_batches_columns, batch.sub_batches_observes):
+            obs = sub_batch_observes.pack(training_observation)
             obs_emb = self._observe_embedding_layer(obs)
 
             sub_batch_length = len(sub_batch)
@@ -561,8 +1016,8 @@ class InferenceNetworkSimple(nn.Module):
                 current_sample = example_trace.samples[time_step]
                 current_address = current_sample.address
 
-                current_samples = [trace.samples[time_step] for trace in sub_batch]
-                current_samples_values = torch.stack([s.value for s in current_samples])
+                current_samples = sub_batch_columns[time_step]
+                current_samples_values = current_samples.values
                 proposal_distribution = self._proposal_layers[current_address](obs_emb, current_samples)
                 l = proposal_distribution.log_prob(current_samples_values)
                 if util.has_nan_or_inf(l):
@@ -579,18 +1034,26 @@ class InferenceNetworkSimple(nn.Module):
                 log_prob += util.safe_torch_sum(l)
 
             sub_batch_loss = -log_prob / sub_batch_length
-            batch_loss += float(sub_batch_loss * sub_batch_length)
+            batch_loss += float(sub_batch_loss.detach()) * sub_batch_length
 
-            if optimizer is not None:
+            if pack_sub_batches:
+                batch_log_prob += log_prob
+            elif optimizer is not None:
                 optimizer.zero_grad()
                 sub_batch_loss.backward()
                 optimizer.step()
 
+        if pack_sub_batches and (optimizer is not None):
+            optimizer.zero_grad()
+            (-batch_log_prob / batch.length).backward()
+            optimizer.step()
+
         return True, batch_loss / batch.length
 
-    def optimize(self, new_batch_func, training_observation, optimizer_type, num_traces, learning_rate, momentum, weight_decay, valid_interval, auto_save, auto_save_file_name):
+    def optimize(self, new_batch_func, training_observation, optimizer_type, num_traces, learning_rate, momentum, weight_decay, valid_interval, auto_save, auto_save_file_name, pack_sub_batches=False, status_func=None, distributed=False, hogwild_trace_counter=None):
         self._trained_on = 'CUDA' if util._cuda_enabled else 'CPU'
         self._optimizer_type = optimizer_type
+        self._state_observes = None  # The cached observation embedding becomes stale with training
         prev_total_train_seconds = self._total_train_seconds
         time_start = time.time()
         time_loss_min = time.time()
@@ -599,22 +1062,57 @@ class InferenceNetworkSimple(nn.Module):
         trace = 0
         last_validation_trace = -valid_interval + 1
         stop = False
-        print('Train. time | Trace     | Init. loss| Min. loss | Curr. loss| T.since min | Traces/sec')
+        optimizer = None
+        skipped_traces = 0
+        # status_func, if given, returns a string with extra information (e.g., the state of the trace producers) that is shown at the end of the progress line
+        print('Train. time | Trace     | Init. loss| Min. loss | Curr. loss| T.since min | Traces/sec' + (' | Status' if status_func is not None else ''))
         max_print_line_len = 0
 
         while not stop:
             iteration += 1
             batch = new_batch_func()
-            layers_changed = self.polymorph(batch)
+            if distributed:
+                layers_changed = distributed_polymorph(self, batch)
+                batch_length = int(distributed_sum(batch.length))
+            elif hogwild_trace_counter is not None:
+                # The layers are in shared memory and cannot change, traces of types with unknown addresses are skipped
+                # Skipped traces count towards num_traces, so that training ends even if no batch can be used
+                traces = [trace for sub_batch in batch.sub_batches if all(sample.address in self._proposal_layers for sample in sub_batch[0].samples) for trace in sub_batch]
+                if len(traces) < batch.length:
+                    skipped_traces += batch.length - len(traces)
+                    with hogwild_trace_counter.get_lock():
+                        hogwild_trace_counter.value += batch.length - len(traces)
+                        hogwild_traces = hogwild_trace_counter.value
+                    if (num_traces != -1) and (hogwild_traces >= num_traces):
+                        stop = True
+                if len(traces) == 0:
+                    continue
+                batch = Batch(traces)
+                layers_changed = False
+                batch_length = batch.length
+            else:
+                layers_changed = self.polymorph(batch)
+                batch_length = batch.length
 
-            if iteration == 1 or layers_changed:
+            if optimizer is None:
                 if optimizer_type == Optimizer.ADAM:
-                    optimizer = optim.Adam(self.parameters(), lr=learning_rate, weight_decay=weight_decay)
+                    optimizer = optim.Adam(self._parameter_groups(), lr=learning_rate, weight_decay=weight_decay)
                 else:  # optimizer_type == Optimizer.SGD:
-                    optimizer = optim.SGD(self.parameters(), lr=learning_rate, momentum=momentum, nesterov=True, weight_decay=weight_decay)
-            success, loss = self.loss(batch, optimizer, training_observation)
+                    optimizer = optim.SGD(self._parameter_groups(), lr=learning_rate, momentum=momentum, nesterov=True, weight_decay=weight_decay)
+                if distributed:
+                    optimizer = DistributedOptimizer(optimizer, self)
+                else:
+                    optimizer = SparseStepOptimizer(optimizer)
+            elif layers_changed:
+                add_new_parameter_groups(optimizer, self._parameter_groups())
+            # In distributed training, all ranks need to take the same optimizer steps, so there is one step per batch
+            success, loss = self.loss(batch, optimizer, training_observation, pack_sub_batches or distributed)
             if not success:
                 print(colored('Cannot compute loss, skipping batch. Loss: {}'.format(loss), 'red', attrs=['bold']))
+                if distributed:
+                    # Take part in the gradient all-reduce with zero gradients
+                    optimizer.zero_grad()
+                    optimizer.step()
             else:
                 if self._loss_initial is None:
                     self._loss_initial = loss
@@ -644,22 +1142,30 @@ class InferenceNetworkSimple(nn.Module):
 
                 self._loss_previous = loss
                 self._total_train_iterations += 1
-                trace += batch.length
-                self._total_train_traces += batch.length
+                trace += batch_length
+                self._total_train_traces += batch_length
                 total_training_traces_str = '{:9}'.format('{:,}'.format(self._total_train_traces))
                 self._total_train_seconds = prev_total_train_seconds + (time.time() - time_start)
                 total_training_seconds_str = util.days_hours_mins_secs_str(self._total_train_seconds)
-                traces_per_second_str = '{:,.1f}'.format(int(batch.length / (time.time() - time_last_batch)))
+                traces_per_second_str = '{:,.1f}'.format(int(batch_length / (time.time() - time_last_batch)))
                 time_last_batch = time.time()
+                if hogwild_trace_counter is not None:
+                    # All the processes stop when the traces they trained on add up to num_traces
+                    with hogwild_trace_counter.get_lock():
+                        hogwild_trace_counter.value += batch_length
+                        hogwild_traces = hogwild_trace_counter.value
                 if num_traces != -1:
-                    if trace >= num_traces:
+                    if hogwild_trace_counter is not None:
+                        if hogwild_traces >= num_traces:
+                            stop = True
+                    elif trace >= num_traces:
                         stop = True
 
                 self._history_train_loss.append(loss)
                 self._history_train_loss_trace.append(self._total_train_traces)
-                if trace - last_validation_trace > valid_interval:
+                if (trace - last_validation_trace > valid_interval) and ((not distributed) or (dist.get_rank() == 0)):
                     print('\rComputing validation loss...', end='\r')
-                    _, valid_loss = self.loss(self._valid_batch)
+                    _, valid_loss = self.loss(self._valid_batch, pack_sub_batches=pack_sub_batches)
                     self._history_valid_loss.append(valid_loss)
                     self._history_valid_loss_trace.append(self._total_train_traces)
                     last_validation_trace = trace - 1
@@ -669,71 +1175,28 @@ class InferenceNetworkSimple(nn.Module):
                         self._save(file_name)
 
                 print_line = '{} | {} | {} | {} | {} | {} | {}'.format(total_training_seconds_str, total_training_traces_str, loss_initial_str, loss_min_str, loss_str, time_since_loss_min_str, traces_per_second_str)
+                if status_func is not None:
+                    print_line += ' | ' + status_func()
                 max_print_line_len = max(len(print_line), max_print_line_len)
                 print(print_line.ljust(max_print_line_len), end='\r')
                 sys.stdout.flush()
+            if distributed:
+                # Rank 0 decides when all ranks stop
+                stop = bool(distributed_broadcast(stop))
         print()
+        if skipped_traces > 0:
+            print(colored('Warning: skipped {:,} traces with addresses unknown to the inference network, use a trace cache with pre_allocate_layers to create their layers before training'.format(skipped_traces), 'red', attrs=['bold']))
 
     def _save(self, file_name):
-        self._modified = util.get_time_str()
-        self._updates += 1
-
-        data = {}
-        data['pyprob_version'] = __version__
-        data['torch_version'] = torch.__version__
-        data['inference_network'] = self
-
-        def thread_save():
-            tmp_dir = tempfile.mkdtemp(suffix=str(uuid.uuid4()))
-            tmp_file_name = os.path.join(tmp_dir, 'pyprob_inference_network')
-            torch.save(data, tmp_file_name)
-            tar = tarfile.open(file_name, 'w:gz', compresslevel=2)
-            tar.add(tmp_file_name, arcname='pyprob_inference_network')
-            tar.close()
-            shutil.rmtree(tmp_dir)
-        t = Thread(target=thread_save)
-        t.start()
-        t.join()
+        return save_checkpoint(self, file_name)
 
     @staticmethod
     def _load(file_name, cuda=False, device=None):
-        try:
-            tar = tarfile.open(file_name, 'r:gz')
-            tmp_dir = tempfile.mkdtemp(suffix=str(uuid.uuid4()))
-            tmp_file = os.path.join(tmp_dir, 'pyprob_inference_network')
-            tar.extract('pyprob_inference_network', tmp_dir)
-            tar.close()
-            if cuda:
-                data = torch.load(tmp_file)
-            else:
-                data = torch.load(tmp_file, map_location=lambda storage, loc: storage)
-                shutil.rmtree(tmp_dir)
-        except:
-            raise RuntimeError('Cannot load inference network.')
-
-        if data['pyprob_version'] != __version__:
-            print(colored('Warning: different pyprob versions (loaded network: {}, current system: {})'.format(data['pyprob_version'], __version__), 'red', attrs=['bold']))
-        if data['torch_version'] != torch.__version__:
-            print(colored('Warning: different PyTorch versions (loaded network: {}, current system: {})'.format(data['torch_version'], torch.__version__), 'red', attrs=['bold']))
-
-        ret = data['inference_network']
-        if cuda:
-            if ret._on_cuda:
-                if ret._cuda_device != device:
-                    print(colored('Warning: loading CUDA (device {}) network to CUDA (device {})'.format(ret._cuda_device, device), 'red', attrs=['bold']))
-                    ret.cuda(device)
-            else:
-                print(colored('Warning: loading CPU network to CUDA (device {})'.format(device), 'red', attrs=['bold']))
-                ret.cuda(device)
-        else:
-            if ret._on_cuda:
-                print(colored('Warning: loading CUDA (device {}) network to CPU'.format(ret._cuda_device), 'red', attrs=['bold']))
-                ret.cpu()
-        return ret
+        return load_checkpoint(file_name, cuda, device)
 
 
 class InferenceNetworkLSTM(nn.Module):
-    def __init__(self, model_name='Unnamed model', lstm_dim=512, lstm_depth=2, observe_embedding=ObserveEmbedding.FULLY_CONNECTED, observe_reshape=None, observe_embedding_dim=512, sample_embedding=SampleEmbedding.FULLY_CONNECTED, sample_embedding_dim=32, address_embedding_dim=256, valid_batch=None):
+    def __init__(self, model_name='Unnamed model', lstm_dim=512, lstm_depth=2, observe_embedding=ObserveEmbedding.FULLY_CONNECTED, observe_reshape=None, observe_embedding_dim=512, sample_embedding=SampleEmbedding.FULLY_CONNECTED, sample_embedding_dim=32, address_embedding_dim=256, proposal_architecture=ProposalArchitecture.PER_ADDRESS, max_addresses=None, address_eviction=AddressEviction.LEAST_RECENTLY_USED, address_spill_path=None, valid_batch=None, example_observes=None):
         super().__init__()
         self._model_name = model_name
         self._lstm_dim = lstm_dim
@@ -744,6 +1207,10 @@ class InferenceNetworkLSTM(nn.Module):
         self._sample_embedding = sample_embedding
         self._sample_embedding_dim = sample_embedding_dim
         self._address_embedding_dim = address_embedding_dim
+        self._proposal_architecture = proposal_architecture
+        self._max_addresses = max_addresses
+        self._address_eviction = address_eviction
+        self._address_spill_path = address_spill_path
         self._distribution_type_embedding_dim = 4  # Needs to match the number of distribution types in pyprob (except Emprical)
         self._valid_batch = valid_batch
         self._on_cuda = util._cuda_enabled
@@ -766,8 +1233,10 @@ class InferenceNetworkLSTM(nn.Module):
         self._modified = util.get_time_str()
         self._updates = 0
         self._pyprob_version = __version__
-        self._torch_version = torch.__version__
+        self._torch_version = str(torch.__version__)
         self._optimizer_type = ''
+        self._quantized = False
+        self._valid_batch_file_name = None
 
         self._state_new_trace = True
         self._state_observes = None
@@ -777,7 +1246,9 @@ class InferenceNetworkLSTM(nn.Module):
         self._address_stats = OrderedDict()
         self._trace_stats = OrderedDict()
 
-        self._address_embeddings = {}
+        self._address_ids = {}
+        self._address_embedding_chunks = nn.ParameterList()
+        self._address_embedding_rows_new = []
         self._distribution_type_embeddings = {}
 
         self._address_embedding_empty = util.to_variable(torch.zeros(self._address_embedding_dim))
@@ -785,7 +1256,9 @@ class InferenceNetworkLSTM(nn.Module):
 
         self._lstm_input_dim = self._observe_embedding_dim + self._sample_embedding_dim + 2 * (self._address_embedding_dim + self._distribution_type_embedding_dim)
         self._lstm = nn.LSTM(self._lstm_input_dim, self._lstm_dim, self._lstm_depth)
-        example_observes = self._valid_batch[0].pack_observes()  # To do: we need to check all the observes in the batch, to be more intelligent
+        if example_observes is None:
+            example_observes = self._valid_batch[0].pack_observes()  # To do: we need to check all the observes in the batch, to be more intelligent
+        self._observe_example_size = list(example_observes.size())
         if self._observe_embedding == ObserveEmbedding.FULLY_CONNECTED:
             self._observe_embedding_layer = ObserveEmbeddingFC(example_observes, self._observe_embedding_dim)
         elif self._observe_embedding == ObserveEmbedding.CONVNET_2D_5C:
@@ -798,6 +1271,19 @@ class InferenceNetworkLSTM(nn.Module):
             raise ValueError('Unknown observation embedding: {}'.format(self._observe_embedding))
         self._sample_embedding_layers = {}
         self._proposal_layers = {}
+        self._layer_specs = OrderedDict()
+        self._shared_proposal_layers = {}
+        if self._proposal_architecture == ProposalArchitecture.SHARED_TRUNK:
+            self._proposal_film = ProposalFiLM(self._address_embedding_dim, self._lstm_dim)
+        elif self._proposal_architecture == ProposalArchitecture.PER_ADDRESS:
+            self._proposal_film = None
+        else:
+            raise ValueError('Unknown proposal architecture: {}'.format(self._proposal_architecture))
+        # With max_addresses, the layers of at most max_addresses addresses are kept in memory and the others are spilled to files in address_spill_path
+        # Spill files belong to this network only: they are deleted when their layers are restored, and checkpoints store copies of the evicted layers. Without address_spill_path, they are in a temporary directory that is removed with the network (or at exit)
+        self._address_last_used = {}
+        self._evicted_addresses = {}
+        self._address_spill_dir = None
 
     def cuda(self, device=None):
         self._on_cuda = True
@@ -805,11 +1291,10 @@ class InferenceNetworkLSTM(nn.Module):
         super().cuda(device)
         self._address_embedding_empty = self._address_embedding_empty.cuda(device)
         self._distribution_type_embedding_empty = self._distribution_type_embedding_empty.cuda(device)
-        for k, t in self._address_embeddings.items():
-            self._address_embeddings[k] = t.cuda(device)
         for k, t in self._distribution_type_embeddings.items():
             self._distribution_type_embeddings[k] = t.cuda(device)
-        self._valid_batch.cuda(device)
+        if self._valid_batch is not None:
+            self._valid_batch.cuda(device)
         return self
 
     def cpu(self):
@@ -817,24 +1302,25 @@ class InferenceNetworkLSTM(nn.Module):
         super().cpu()
         self._address_embedding_empty = self._address_embedding_empty.cpu()
         self._distribution_type_embedding_empty = self._distribution_type_embedding_empty.cpu()
-        for k, t in self._address_embeddings.items():
-            self._address_embeddings[k] = t.cpu()
         for k, t in self._distribution_type_embeddings.items():
             self._distribution_type_embeddings[k] = t.cpu()
-        self._valid_batch.cpu()
+        if self._valid_batch is not None:
+            self._valid_batch.cpu()
         return self
 
-    def _update_stats(self, batch):
+    def _update_stats(self, batch, count=True):
+        # With count=False, addresses and trace types are registered (with ids) without counting the traces of batch
         for sub_batch in batch.sub_batches:
             example_trace = sub_batch[0]
+            num_traces = len(sub_batch) if count else 0
             # Update address stats
             for sample in example_trace._samples_all:
                 address = sample.address
                 if address not in self._address_stats:
                     address_id = 'A' + str(len(self._address_stats) + 1)
-                    self._address_stats[address] = [len(sub_batch), address_id, sample.distribution.name, sample.control, sample.replace, sample.observed]
+                    self._address_stats[address] = [num_traces, address_id, sample.distribution.name, sample.control, sample.replace, sample.observed]
                 else:
-                    self._address_stats[address][0] += len(sub_batch)
+                    self._address_stats[address][0] += num_traces
             # Update trace stats
             trace_str = example_trace.addresses()
             if trace_str not in self._trace_stats:
@@ -856,17 +1342,70 @@ class InferenceNetworkLSTM(nn.Module):
                     elif sample.observed:
                         samples_controlled_observed.append(sample)
                 trace_addresses = [self._address_stats[sample.address][1] for sample in samples_controlled_observed]
-                self._trace_stats[trace_str] = [len(sub_batch), trace_id, len(example_trace._samples_all),  len(example_trace.samples), trace_addresses]
+                self._trace_stats[trace_str] = [num_traces, trace_id, len(example_trace._samples_all),  len(example_trace.samples), trace_addresses]
             else:
-                self._trace_stats[trace_str][0] += len(sub_batch)
+                self._trace_stats[trace_str][0] += num_traces
 
     def _add_address(self, address):
-        if address not in self._address_embeddings:
-            t = Parameter(util.Tensor(self._address_embedding_dim).normal_())
-            self._address_embeddings[address] = t
-            self.register_parameter('address_embedding_' + address, t)
+        # Address embeddings are rows of a table that grows in chunks of _address_embedding_chunk_size rows, so that most new addresses do not add new parameters
+        if address not in self._address_ids:
+            address_id = len(self._address_ids)
+            chunk, row = divmod(address_id, _address_embedding_chunk_size)
+            if chunk == len(self._address_embedding_chunks):
+                self._address_embedding_chunks.append(Parameter(util.Tensor(_address_embedding_chunk_size, self._address_embedding_dim).normal_()))
+            else:
+                self._address_embedding_chunks[chunk].data[row].normal_()
+                self._address_embedding_rows_new.append((chunk, row))  # The optimizer state of the row is reset by optimize
+            self._address_ids[address] = address_id
             print('New layers for address ({}): {}'.format(self._address_stats[address][1], util.truncate_str(address)))
 
+    def _address_embeddings(self, addresses):
+        # Looks up the embeddings of a list of addresses with one gather per chunk of the table
+        chunks, rows = zip(*[divmod(self._address_ids[address], _address_embedding_chunk_size) for address in addresses])
+        device = self._address_embedding_chunks[0].device
+        if all([chunk == chunks[0] for chunk in chunks]):
+            return self._address_embedding_chunks[chunks[0]].index_select(0, torch.tensor(rows, dtype=torch.long, device=device))
+        # Addresses in several chunks: the rows gathered from each chunk are put back in the order of addresses
+        embeddings = []
+        positions = []
+        for chunk in sorted(set(chunks)):
+            chunk_positions = [i for i in range(len(chunks)) if chunks[i] == chunk]
+            embeddings.append(self._address_embedding_chunks[chunk].index_select(0, torch.tensor([rows[i] for i in chunk_positions], dtype=torch.long, device=device)))
+            positions += chunk_positions
+        return torch.cat(embeddings).index_select(0, torch.tensor(positions, dtype=torch.long, device=device).argsort())
+
+    def __setstate__(self, state):
+        super().__setstate__(state)
+        if '_proposal_architecture' not in state:
+            # Networks saved before shared proposal layers
+            self._proposal_architecture = ProposalArchitecture.PER_ADDRESS
+            self._proposal_film = None
+            self._shared_proposal_layers = {}
+        if '_max_addresses' not in state:
+            # Networks saved before address eviction
+            self._max_addresses = None
+            self._address_eviction = AddressEviction.LEAST_RECENTLY_USED
+            self._address_spill_path = None
+            self._address_last_used = {}
+            self._evicted_addresses = {}
+        if '_address_spill_dir' not in state:
+            self._address_spill_dir = None
+        if '_address_embedding_rows_new' not in state:
+            self._address_embedding_rows_new = []
+        if '_address_embeddings' in state:
+            # Networks saved with one parameter per address embedding
+            address_embeddings = self.__dict__.pop('_address_embeddings')
+            self._address_ids = {}
+            self._address_embedding_chunks = nn.ParameterList()
+            for address, t in address_embeddings.items():
+                address_id = len(self._address_ids)
+                chunk, row = divmod(address_id, _address_embedding_chunk_size)
+                if chunk == len(self._address_embedding_chunks):
+                    self._address_embedding_chunks.append(Parameter(t.data.new_zeros(_address_embedding_chunk_size, self._address_embedding_dim).normal_()))
+                self._address_embedding_chunks[chunk].data[row] = t.data
+                self._address_ids[address] = address_id
+                del self._parameters['address_embedding_' + address]
+
     def _add_distribution_type(self, distribution_type):
         if distribution_type not in self._distribution_type_embeddings:
             print('New distribution type: {}'.format(distribution_type))
@@ -878,14 +1417,96 @@ class InferenceNetworkLSTM(nn.Module):
                 print('Warning: overflow (collision) in distribution type embeddings. Allowed: {}; Encountered: {}'.format(self._distribution_type_embedding_dim, i + 1))
                 self._distribution_type_embeddings[distribution_type] = random.choice(list(self._distribution_type_embeddings.values()))
 
-    def polymorph(self, batch=None):
+    def _add_layers(self, address, spec):
+        self._layer_specs[address] = spec
+        sample_embedding_layer = SampleEmbeddingFC(**spec['sample_embedding'])
+        self._sample_embedding_layers[address] = sample_embedding_layer
+        self.add_module('sample_embedding_layer({})'.format(address), sample_embedding_layer)
+        if self._proposal_architecture == ProposalArchitecture.SHARED_TRUNK:
+            # One proposal layer for each distinct layer specification (distribution type and shape)
+            key = spec['proposal']['class'] + ''.join(['_{}'.format(spec['proposal']['args'][name]) for name in sorted(spec['proposal']['args'])])
+            if key not in self._shared_proposal_layers:
+                proposal_layer = _proposal_layer_from_spec(spec['proposal'])
+                self._shared_proposal_layers[key] = proposal_layer
+                self.add_module('shared_proposal_layer({})'.format(key), proposal_layer)
+            self._proposal_layers[address] = self._shared_proposal_layers[key]
+        else:
+            proposal_layer = _proposal_layer_from_spec(spec['proposal'])
+            self._proposal_layers[address] = proposal_layer
+            self.add_module('proposal_layer({})'.format(address), proposal_layer)
+
+    def _parameter_groups(self):
+        # Optimizer parameter groups, one for the parameters of each address and one for the others (including shared proposal layers)
+        address_params = []
+        for address, sample_embedding_layer in self._sample_embedding_layers.items():
+            params = list(sample_embedding_layer.parameters())
+            if self._proposal_architecture == ProposalArchitecture.PER_ADDRESS:
+                params += list(self._proposal_layers[address].parameters())
+            address_params.append(params)
+        grouped = set([p for params in address_params for p in params])
+        return [{'params': [p for p in self.parameters() if p not in grouped]}] + [{'params': params} for params in address_params]
+
+    def _evict_addresses(self, batch):
+        # Evicts addresses until at most _max_addresses have layers in memory; addresses in batch and in the validation batch are kept
+        resident = [address for address in self._layer_specs if address not in self._evicted_addresses]
+        num_evict = len(resident) - self._max_addresses
+        if num_evict <= 0:
+            return
+        keep = set()
+        for b in [batch, self._valid_batch]:
+            if b is not None:
+                for sub_batch in b.sub_batches:
+                    keep.update([sample.address for sample in sub_batch[0].samples])
+        if self._address_eviction == AddressEviction.LEAST_RECENTLY_USED:
+            score = lambda address: self._address_last_used.get(address, 0)
+        else:  # self._address_eviction == AddressEviction.LEAST_FREQUENTLY_USED
+            score = lambda address: self._address_stats[address][0]
+        candidates = sorted([address for address in resident if address not in keep], key=score)
+        for address in candidates[:num_evict]:
+            self._evict_address(address)
+
+    def _spill_file_name(self):
+        if self._address_spill_dir is None:
+            if self._address_spill_path is None:
+                self._address_spill_dir = tempfile.mkdtemp(prefix='pyprob_spill_')
+                weakref.finalize(self, shutil.rmtree, self._address_spill_dir, ignore_errors=True)
+            else:
+                self._address_spill_dir = self._address_spill_path
+        return os.path.join(self._address_spill_dir, str(uuid.uuid4()))
+
+    def _evict_address(self, address):
+        file_name = self._spill_file_name()
+        data = {}
+        data['sample_embedding'] = {k: v.cpu() for k, v in self._sample_embedding_layers.pop(address).state_dict().items()}
+        del self._modules['sample_embedding_layer({})'.format(address)]
+        proposal_layer = self._proposal_layers.pop(address)
+        if self._proposal_architecture == ProposalArchitecture.PER_ADDRESS:
+            data['proposal'] = {k: v.cpu() for k, v in proposal_layer.state_dict().items()}
+            del self._modules['proposal_layer({})'.format(address)]
+        torch.save(data, file_name)
+        self._evicted_addresses[address] = file_name
+        print('Evicted layers for address ({}): {}'.format(self._address_stats[address][1], util.truncate_str(address)))
+
+    def _restore_address(self, address):
+        file_name = self._evicted_addresses.pop(address)
+        data = torch.load(file_name, map_location=lambda storage, loc: storage, weights_only=True)
+        os.remove(file_name)
+        # The layers are restored as new parameters, which start with fresh optimizer state
+        self._add_layers(address, self._layer_specs[address])
+        self._sample_embedding_layers[address].load_state_dict(data['sample_embedding'])
+        if 'proposal' in data:
+            self._proposal_layers[address].load_state_dict(data['proposal'])
+        print('Restored layers for address ({}): {}'.format(self._address_stats[address][1], util.truncate_str(address)))
+
+    def polymorph(self, batch=None, count_stats=True):
+        # With count_stats=False, the layers for batch are created without counting its traces in the address and trace statistics (e.g., for batches of example traces)
         if batch is None:
             if self._valid_batch is None:
                 return
             else:
                 batch = self._valid_batch
 
-        self._update_stats(batch)
+        self._update_stats(batch, count_stats)
 
         layers_changed = False
         for sub_batch in batch.sub_batches:
@@ -898,33 +1519,26 @@ class InferenceNetworkLSTM(nn.Module):
                 # Update the dictionaries for address and distribution type embeddings
                 self._add_address(address)
                 self._add_distribution_type(distribution.name)
+                self._address_last_used[address] = self._total_train_traces
 
-                if address not in self._sample_embedding_layers:
-                    if self._sample_embedding == SampleEmbedding.FULLY_CONNECTED:
-                        if isinstance(distribution, Categorical):
-                            sample_embedding_layer = SampleEmbeddingFC(sample.value.nelement(), self._sample_embedding_dim, input_is_one_hot_index=True, input_one_hot_dim=distribution.length_categories)
-                        else:
-                            sample_embedding_layer = SampleEmbeddingFC(sample.value.nelement(), self._sample_embedding_dim)
-                    else:
+                if address in self._evicted_addresses:
+                    self._restore_address(address)
+                    layers_changed = True
+                elif address not in self._sample_embedding_layers:
+                    if self._sample_embedding != SampleEmbedding.FULLY_CONNECTED:
                         raise ValueError('Unkown sample embedding: {}'.format(self._sample_embedding))
-
+                    spec = {}
                     if isinstance(distribution, Categorical):
-                        proposal_layer = ProposalCategorical(self._lstm_dim, distribution.length_categories)
-                    elif isinstance(distribution, Normal):
-                        proposal_layer = ProposalNormal(self._lstm_dim, distribution.length_variates)
-                    elif isinstance(distribution, Uniform):
-                        proposal_layer = ProposalUniformKumaraswamyMixture(self._lstm_dim)
-                    elif isinstance(distribution, Poisson):
-                        proposal_layer = ProposalPoisson(self._lstm_dim)
+                        spec['sample_embedding'] = {'input_dim': sample.value.nelement(), 'output_dim': self._sample_embedding_dim, 'input_is_one_hot_index': True, 'input_one_hot_dim': distribution.length_categories}
                     else:
-                        raise ValueError('Unsupported distribution: {}'.format(distribution.name))
-
-                    self._sample_embedding_layers[address] = sample_embedding_layer
-                    self._proposal_layers[address] = proposal_layer
-                    self.add_module('sample_embedding_layer({})'.format(address), sample_embedding_layer)
-                    self.add_module('proposal_layer({})'.format(address), proposal_layer)
+                        spec['sample_embedding'] = {'input_dim': sample.value.nelement(), 'output_dim': self._sample_embedding_dim}
+                    spec['proposal'] = _proposal_layer_spec(self._lstm_dim, distribution)
+                    self._add_layers(address, spec)
                     layers_changed = True
 
+        if layers_changed and (self._max_addresses is not None):
+            self._evict_addresses(batch)
+
         if layers_changed:
             num_params = 0
             for p in self.parameters():
@@ -933,15 +1547,18 @@ class InferenceNetworkLSTM(nn.Module):
             self._history_num_params.append(num_params)
             self._history_num_params_trace.append(self._total_train_traces)
 
-        if self._on_cuda:
-            self.cuda(self._cuda_device)
+            if self._on_cuda:
+                self.cuda(self._cuda_device)
 
         return layers_changed
 
     def new_trace(self, observes=None):
         self._state_new_trace = True
+        # The observation embedding is reused while the observation does not change (e.g., for all the particles of a posterior query)
+        if (self._state_observes is None) or ((observes is not self._state_observes) and not ((observes.size() == self._state_observes.size()) and torch.equal(observes, self._state_observes))):
+            with torch.no_grad():
+                self._state_observes_embedding = self._observe_embedding_layer.forward(observes)
         self._state_observes = observes
-        self._state_observes_embedding = self._observe_embedding_layer.forward(observes)
 
     def forward_one_time_step(self, previous_sample, current_sample):
         if self._state_observes is None:
@@ -967,8 +1584,8 @@ class InferenceNetworkLSTM(nn.Module):
             else:
                 print('Warning: no sample embedding layer for: {}'.format(prev_address))
                 success = False
-            if prev_address in self._address_embeddings:
-                prev_addres_embedding = self._address_embeddings[prev_address]
+            if prev_address in self._address_ids:
+                prev_addres_embedding = self._address_embeddings([prev_address])[0]
             else:
                 print('Warning: unknown address (previous): {}'.format(prev_address))
                 success = False
@@ -984,8 +1601,8 @@ class InferenceNetworkLSTM(nn.Module):
         if current_address not in self._proposal_layers:
             print('Warning: no proposal layer for: {}'.format(current_address))
             success = False
-        if current_address in self._address_embeddings:
-            current_addres_embedding = self._address_embeddings[current_address]
+        if current_address in self._address_ids:
+            current_addres_embedding = self._address_embeddings([current_address])[0]
         else:
             print('Warning: unknown address (current): {}'.format(current_address))
             success = False
@@ -1005,88 +1622,170 @@ class InferenceNetworkLSTM(nn.Module):
             t = torch.cat(t).unsqueeze(0)
             lstm_input = t.unsqueeze(0)
             lstm_output, self._state_lstm_hidden_state = self._lstm(lstm_input, self._state_lstm_hidden_state)
-            proposal_input = lstm_output[0]
+            proposal_input = self._proposal_input(lstm_output[0], [current_address])
             proposal_distribution = self._proposal_layers[current_address](proposal_input, [current_sample])
             return proposal_distribution
         else:
             print('Warning: no proposal could be made, prior will be used')
             return current_distribution
 
-    def loss(self, batch, optimizer=None, training_observation=TrainingObservation.OBSERVE_DIST_SAMPLE):
+    def can_propose(self, previous_sample, current_sample):
+        success = True
+        if previous_sample is not None:
+            if previous_sample.address not in self._sample_embedding_layers:
+                print('Warning: no sample embedding layer for: {}'.format(previous_sample.address))
+                success = False
+            if previous_sample.address not in self._address_ids:
+                print('Warning: unknown address (previous): {}'.format(previous_sample.address))
+                success = False
+            if previous_sample.distribution.name not in self._distribution_type_embeddings:
+                print('Warning: unkown distribution type (previous): {}'.format(previous_sample.distribution.name))
+                success = False
+        if current_sample.address not in self._proposal_layers:
+            print('Warning: no proposal layer for: {}'.format(current_sample.address))
+            success = False
+        if current_sample.address not in self._address_ids:
+            print('Warning: unknown address (current): {}'.format(current_sample.address))
+            success = False
+        if current_sample.distribution.name not in self._distribution_type_embeddings:
+            print('Warning: unkown distribution type (current): {}'.format(current_sample.distribution.name))
+            success = False
+        return success
+
+    def forward_time_steps(self, hidden_states, previous_samples, current_samples):
+        # Batched forward_one_time_step for particles running in lockstep, one LSTM step for all the particles
+        # hidden_states and previous_samples have None for the particles at the start of a trace
+        # Returns the proposal inputs and the new hidden states
+        if self._state_observes is None:
+            raise RuntimeError('Cannot run the inference network without observations. Call new_trace and supply observations.')
+        n = len(current_samples)
+
+        prev_sample_embedding = [util.to_variable(torch.zeros(self._sample_embedding_dim))] * n
+        prev_embeddings = [torch.cat([self._distribution_type_embedding_empty, self._address_embedding_empty])] * n
+        prev_indices = OrderedDict()
+        for i, prev_sample in enumerate(previous_samples):
+            if prev_sample is not None:
+                prev_indices.setdefault(prev_sample.address, []).append(i)
+        for prev_address, indices in prev_indices.items():
+            prev_distribution_type_embedding = self._distribution_type_embeddings[previous_samples[indices[0]].distribution.name]
+            prev_addres_embedding = self._address_embeddings([prev_address])[0]
+            embeddings = self._sample_embedding_layers[prev_address](torch.stack([previous_samples[i].value.float() for i in indices]))
+            for j, i in enumerate(indices):
+                prev_sample_embedding[i] = embeddings[j]
+                prev_embeddings[i] = torch.cat([prev_distribution_type_embedding, prev_addres_embedding])
+        current_embeddings = torch.cat([torch.stack([self._distribution_type_embeddings[s.distribution.name] for s in current_samples]), self._address_embeddings([s.address for s in current_samples])], dim=1)
+
+        lstm_input = torch.cat([self._state_observes_embedding.expand(n, -1),
+                                torch.stack(prev_sample_embedding),
+                                torch.stack(prev_embeddings),
+                                current_embeddings], dim=1).unsqueeze(0)
+        hidden_state_empty = util.to_variable(torch.zeros(self._lstm_depth, 1, self._lstm_dim))
+        h = torch.cat([hidden_state_empty if hidden_state is None else hidden_state[0] for hidden_state in hidden_states], dim=1)
+        c = torch.cat([hidden_state_empty if hidden_state is None else hidden_state[1] for hidden_state in hidden_states], dim=1)
+        lstm_output, (h, c) = self._lstm(lstm_input, (h, c))
+        return self._proposal_input(lstm_output[0], [s.address for s in current_samples]), [(h[:, i:i + 1], c[:, i:i + 1]) for i in range(n)]
+
+    def _lstm_input(self, sub_batch, sub_batch_columns, sub_batch_observes, training_observation):
+        obs = sub_batch_observes.pack(training_observation)
+        obs_emb = self._observe_embedding_layer(obs)
+
+        sub_batch_length = len(sub_batch)
+        example_trace = sub_batch[0]
+        example_samples = example_trace.samples
+        length = example_trace.length
+
+        # The LSTM input for the whole sequence is assembled with one concatenation: the observation embedding is broadcast over time, address and distribution type embeddings are broadcast over the sub-batch
+        current_embeddings = torch.cat([torch.stack([self._distribution_type_embeddings[s.distribution.name] for s in example_samples]), self._address_embeddings([s.address for s in example_samples])], dim=1)
+        prev_embeddings = torch.cat([torch.cat([self._distribution_type_embedding_empty, self._address_embedding_empty]).unsqueeze(0), current_embeddings[:-1]])
+
+        prev_sample_embedding = [util.to_variable(torch.zeros(sub_batch_length, self._sample_embedding_dim))]
+        for time_step in range(1, length):
+            prev_sample_embedding.append(self._sample_embedding_layers[example_samples[time_step - 1].address](sub_batch_columns[time_step - 1].values.float()))
+        prev_sample_embedding = torch.stack(prev_sample_embedding)
+
+        lstm_input = torch.cat([obs_emb.unsqueeze(0).expand(length, -1, -1),
+                                prev_sample_embedding,
+                                prev_embeddings.unsqueeze(1).expand(-1, sub_batch_length, -1),
+                                current_embeddings.unsqueeze(1).expand(-1, sub_batch_length, -1)], dim=2)
+        return lstm_input
+
+    def _proposal_input(self, x, addresses):
+        # Proposal layers shared by addresses receive inputs modulated by the address embeddings
+        if self._proposal_film is None:
+            return x
+        return self._proposal_film(x, self._address_embeddings(addresses))
+
+    def _proposal_log_prob(self, proposal_distribution, samples_values):
+        l = proposal_distribution.log_prob(samples_values)
+        if util.has_nan_or_inf(l):
+            print(colored('Warning: NaN, -Inf, or Inf encountered in proposal log_prob.', 'red', attrs=['bold']))
+            print('proposal_distribution', proposal_distribution)
+            print('current_samples_values', samples_values)
+            print('log_prob', l)
+            print('Fixing -Inf')
+            l = util.replace_negative_inf(l)
+            print('log_prob', l)
+            if util.has_nan_or_inf(l):
+                print(colored('Nan or Inf present in proposal log_prob.', 'red', attrs=['bold']))
+                return None
+        return l
+
+    def _proposals_log_prob(self, proposal_inputs):
+        # proposal_inputs maps addresses to lists of proposal inputs and sample columns; the proposal layers of addresses with the same layer type and shape are evaluated together
+        groups = OrderedDict()
+        for address, (inputs, columns) in proposal_inputs.items():
+            proposal_layer = self._proposal_layers[address]
+            columns = SampleColumns.cat(columns)
+            key = _proposal_group_key(proposal_layer) + (columns.values.size()[1:],)
+            groups.setdefault(key, []).append((proposal_layer, self._proposal_input(torch.cat(inputs), [address]), columns))
+
+        log_prob = 0
+        for group in groups.values():
+            proposal_layers, inputs, columns = zip(*group)
+            if len(group) == 1:
+                proposal_distribution = proposal_layers[0](inputs[0], columns[0])
+            elif all([proposal_layer is proposal_layers[0] for proposal_layer in proposal_layers]):
+                # Addresses sharing a proposal layer
+                proposal_distribution = proposal_layers[0](torch.cat(inputs), _concat_samples(columns))
+            else:
+                proposal_distribution = proposal_layers_forward_grouped(proposal_layers, inputs, columns)
+            l = self._proposal_log_prob(proposal_distribution, torch.cat([c.values for c in columns]))
+            if l is None:
+                return None
+            log_prob += util.safe_torch_sum(l)
+        return log_prob
+
+    def loss(self, batch, optimizer=None, training_observation=TrainingObservation.OBSERVE_DIST_SAMPLE, pack_sub_batches=False):
         gc.collect()
 
-        batch_loss = 0
-        for sub_batch in batch.sub_batches:
-            obs = torch.stack([trace.pack_observes(training_observation) for trace in sub_batch])
-            obs_emb = self._observe_embedding_layer(obs)
+        if pack_sub_batches:
+            return self._loss_packed(batch, optimizer, training_observation)
 
+        batch_loss = 0
+        for sub_batch, sub_batch_columns, sub_batch_observes in zip(batch.sub_batches, batch.sub_batches_columns, batch.sub_batches_observes):
             sub_batch_length = len(sub_batch)
             example_trace = sub_batch[0]
 
-            lstm_input = []
-            for time_step in range(example_trace.length):
-                current_sample = example_trace.samples[time_step]
-                current_address = current_sample.address
-                current_distribution = current_sample.distribution
-                current_addres_embedding = self._address_embeddings[current_address]
-                current_distribution_type_embedding = self._distribution_type_embeddings[current_distribution.name]
-
-                if time_step == 0:
-                    prev_sample_embedding = util.to_variable(torch.zeros(sub_batch_length, self._sample_embedding_dim))
-                    prev_addres_embedding = self._address_embedding_empty
-                    prev_distribution_type_embedding = self._distribution_type_embedding_empty
-                else:
-                    prev_sample = example_trace.samples[time_step - 1]
-                    prev_address = prev_sample.address
-                    prev_distribution = prev_sample.distribution
-                    smp = torch.stack([trace.samples[time_step - 1].value.float() for trace in sub_batch])
-                    prev_sample_embedding = self._sample_embedding_layers[prev_address](smp)
-                    prev_addres_embedding = self._address_embeddings[prev_address]
-                    prev_distribution_type_embedding = self._distribution_type_embeddings[prev_distribution.name]
-
-                lstm_input_time_step = []
-                for b in range(sub_batch_length):
-                    t = torch.cat([obs_emb[b],
-                                   prev_sample_embedding[b],
-                                   prev_distribution_type_embedding,
-                                   prev_addres_embedding,
-                                   current_distribution_type_embedding,
-                                   current_addres_embedding])
-                    lstm_input_time_step.append(t)
-                lstm_input.append(torch.stack(lstm_input_time_step))
-
-            lstm_input = torch.stack(lstm_input)
+            lstm_input = self._lstm_input(sub_batch, sub_batch_columns, sub_batch_observes, training_observation)
 
             h0 = util.to_variable(torch.zeros(self._lstm_depth, sub_batch_length, self._lstm_dim))
             c0 = util.to_variable(torch.zeros(self._lstm_depth, sub_batch_length, self._lstm_dim))
             lstm_output, _ = self._lstm(lstm_input, (h0, c0))
 
-            log_prob = 0
+            proposal_inputs = OrderedDict()
             for time_step in range(example_trace.length):
-                current_sample = example_trace.samples[time_step]
-                current_address = current_sample.address
-
-                proposal_input = lstm_output[time_step]
-
-                current_samples = [trace.samples[time_step] for trace in sub_batch]
-                current_samples_values = torch.stack([s.value for s in current_samples])
-                proposal_distribution = self._proposal_layers[current_address](proposal_input, current_samples)
-                l = proposal_distribution.log_prob(current_samples_values)
-                if util.has_nan_or_inf(l):
-                    print(colored('Warning: NaN, -Inf, or Inf encountered in proposal log_prob.', 'red', attrs=['bold']))
-                    print('proposal_distribution', proposal_distribution)
-                    print('current_samples_values', current_samples_values)
-                    print('log_prob', l)
-                    print('Fixing -Inf')
-                    l = util.replace_negative_inf(l)
-                    print('log_prob', l)
-                    if util.has_nan_or_inf(l):
-                        print(colored('Nan or Inf present in proposal log_prob.', 'red', attrs=['bold']))
-                        return False, 0
-                log_prob += util.safe_torch_sum(l)
+                current_address = example_trace.samples[time_step].address
+                if current_address not in proposal_inputs:
+                    proposal_inputs[current_address] = ([], [])
+                inputs, columns = proposal_inputs[current_address]
+                inputs.append(lstm_output[time_step])
+                columns.append(sub_batch_columns[time_step])
+            log_prob = self._proposals_log_prob(proposal_inputs)
+            if log_prob is None:
+                return False, 0
 
             sub_batch_loss = -log_prob / sub_batch_length
-            batch_loss += float(sub_batch_loss * sub_batch_length)
+            batch_loss += float(sub_batch_loss.detach()) * sub_batch_length
 
             if optimizer is not None:
                 optimizer.zero_grad()
@@ -1095,9 +1794,52 @@ class InferenceNetworkLSTM(nn.Module):
 
         return True, batch_loss / batch.length
 
-    def optimize(self, new_batch_func, training_observation, optimizer_type, num_traces, learning_rate, momentum, weight_decay, valid_interval, auto_save, auto_save_file_name):
+    def _loss_packed(self, batch, optimizer=None, training_observation=TrainingObservation.OBSERVE_DIST_SAMPLE):
+        # All the sub-batches go through a single packed LSTM call, proposal layers are evaluated once over all the time steps where their addresses occur, and one optimizer step is taken for the whole batch
+        sub_batches = sorted(zip(batch.sub_batches, batch.sub_batches_columns, batch.sub_batches_observes), reverse=True, key=lambda sub_batch: sub_batch[0][0].length)
+        max_length = sub_batches[0][0][0].length
+        lstm_inputs = []
+        lengths = []
+        for sub_batch, sub_batch_columns, sub_batch_observes in sub_batches:
+            lstm_input = self._lstm_input(sub_batch, sub_batch_columns, sub_batch_observes, training_observation)
+            lstm_inputs.append(F.pad(lstm_input, (0, 0, 0, 0, 0, max_length - len(sub_batch_columns))))
+            lengths += [len(sub_batch_columns)] * len(sub_batch)
+        lstm_input = nn.utils.rnn.pack_padded_sequence(torch.cat(lstm_inputs, dim=1), lengths)
+
+        h0 = util.to_variable(torch.zeros(self._lstm_depth, batch.length, self._lstm_dim))
+        c0 = util.to_variable(torch.zeros(self._lstm_depth, batch.length, self._lstm_dim))
+        lstm_output, _ = self._lstm(lstm_input, (h0, c0))
+        lstm_output, _ = nn.utils.rnn.pad_packed_sequence(lstm_output)
+
+        # Gather the LSTM outputs and sample columns of each address across sub-batches; padded time steps are never gathered
+        proposal_inputs = OrderedDict()
+        offset = 0
+        for sub_batch, sub_batch_columns, _ in sub_batches:
+            sub_batch_length = len(sub_batch)
+            for time_step, sample in enumerate(sub_batch[0].samples):
+                if sample.address not in proposal_inputs:
+                    proposal_inputs[sample.address] = ([], [])
+                inputs, columns = proposal_inputs[sample.address]
+                inputs.append(lstm_output[time_step, offset:offset + sub_batch_length])
+                columns.append(sub_batch_columns[time_step])
+            offset += sub_batch_length
+
+        log_prob = self._proposals_log_prob(proposal_inputs)
+        if log_prob is None:
+            return False, 0
+
+        batch_loss = -log_prob / batch.length
+        if optimizer is not None:
+            optimizer.zero_grad()
+            batch_loss.backward()
+            optimizer.step()
+
+        return True, float(batch_loss)
+
+    def optimize(self, new_batch_func, training_observation, optimizer_type, num_traces, learning_rate, momentum, weight_decay, valid_interval, auto_save, auto_save_file_name, pack_sub_batches=False, status_func=None, distributed=False):
         self._trained_on = 'CUDA' if util._cuda_enabled else 'CPU'
         self._optimizer_type = optimizer_type
+        self._state_observes = None  # The cached observation embedding becomes stale with training
         prev_total_train_seconds = self._total_train_seconds
         time_start = time.time()
         time_loss_min = time.time()
@@ -1106,23 +1848,46 @@ class InferenceNetworkLSTM(nn.Module):
         trace = 0
         last_validation_trace = -valid_interval + 1
         stop = False
-        print('Train. time | Trace     | Init. loss| Min. loss | Curr. loss| T.since min | Traces/sec')
+        # status_func, if given, returns a string with extra information (e.g., the state of the trace producers) that is shown at the end of the progress line
+        print('Train. time | Trace     | Init. loss| Min. loss | Curr. loss| T.since min | Traces/sec' + (' | Status' if status_func is not None else ''))
         max_print_line_len = 0
 
         while not stop:
             iteration += 1
 
             batch = new_batch_func()
-            layers_changed = self.polymorph(batch)
+            if distributed:
+                layers_changed = distributed_polymorph(self, batch)
+                batch_length = int(distributed_sum(batch.length))
+            else:
+                layers_changed = self.polymorph(batch)
+                batch_length = batch.length
 
-            if iteration == 1 or layers_changed:
+            if iteration == 1:
                 if optimizer_type == Optimizer.ADAM:
-                    optimizer = optim.Adam(self.parameters(), lr=learning_rate, weight_decay=weight_decay)
+                    optimizer = optim.Adam(self._parameter_groups(), lr=learning_rate, weight_decay=weight_decay)
                 else:  # optimizer_type == Optimizer.SGD:
-                    optimizer = optim.SGD(self.parameters(), lr=learning_rate, momentum=momentum, nesterov=True, weight_decay=weight_decay)
-            success, loss = self.loss(batch, optimizer, training_observation)
+                    optimizer = optim.SGD(self._parameter_groups(), lr=learning_rate, momentum=momentum, nesterov=True, weight_decay=weight_decay)
+                if distributed:
+                    optimizer = DistributedOptimizer(optimizer, self)
+                else:
+                    optimizer = SparseStepOptimizer(optimizer)
+            elif layers_changed:
+                add_new_parameter_groups(optimizer, self._parameter_groups())
+                if self._max_addresses is not None:
+                    remove_missing_parameters(optimizer, self)
+            # Rows of the address embedding table that were not in use can have optimizer state, e.g., from weight decay
+            for chunk, row in self._address_embedding_rows_new:
+                reset_parameter_rows(optimizer, self._address_embedding_chunks[chunk], row)
+            self._address_embedding_rows_new = []
+            # In distributed training, all ranks need to take the same optimizer steps, so there is one step per batch
+            success, loss = self.loss(batch, optimizer, training_observation, pack_sub_batches or distributed)
             if not success:
                 print(colored('Cannot compute loss, skipping batch. Loss: {}'.format(loss), 'red', attrs=['bold']))
+                if distributed:
+                    # Take part in the gradient all-reduce with zero gradients
+                    optimizer.zero_grad()
+                    optimizer.step()
             else:
                 if self._loss_initial is None:
                     self._loss_initial = loss
@@ -1152,12 +1917,12 @@ class InferenceNetworkLSTM(nn.Module):
 
                 self._loss_previous = loss
                 self._total_train_iterations += 1
-                trace += batch.length
-                self._total_train_traces += batch.length
+                trace += batch_length
+                self._total_train_traces += batch_length
                 total_training_traces_str = '{:9}'.format('{:,}'.format(self._total_train_traces))
                 self._total_train_seconds = prev_total_train_seconds + (time.time() - time_start)
                 total_training_seconds_str = util.days_hours_mins_secs_str(self._total_train_seconds)
-                traces_per_second_str = '{:,.1f}'.format(int(batch.length / (time.time() - time_last_batch)))
+                traces_per_second_str = '{:,.1f}'.format(int(batch_length / (time.time() - time_last_batch)))
                 time_last_batch = time.time()
                 if num_traces != -1:
                     if trace >= num_traces:
@@ -1165,9 +1930,9 @@ class InferenceNetworkLSTM(nn.Module):
 
                 self._history_train_loss.append(loss)
                 self._history_train_loss_trace.append(self._total_train_traces)
-                if trace - last_validation_trace > valid_interval:
+                if (trace - last_validation_trace > valid_interval) and ((not distributed) or (dist.get_rank() == 0)):
                     print('\rComputing validation loss...', end='\r')
-                    _, valid_loss = self.loss(self._valid_batch)
+                    _, valid_loss = self.loss(self._valid_batch, pack_sub_batches=pack_sub_batches)
                     self._history_valid_loss.append(valid_loss)
                     self._history_valid_loss_trace.append(self._total_train_traces)
                     last_validation_trace = trace - 1
@@ -1177,64 +1942,426 @@ class InferenceNetworkLSTM(nn.Module):
                         self._save(file_name)
 
                 print_line = '{} | {} | {} | {} | {} | {} | {}'.format(total_training_seconds_str, total_training_traces_str, loss_initial_str, loss_min_str, loss_str, time_since_loss_min_str, traces_per_second_str)
+                if status_func is not None:
+                    print_line += ' | ' + status_func()
                 max_print_line_len = max(len(print_line), max_print_line_len)
                 print(print_line.ljust(max_print_line_len), end='\r')
                 sys.stdout.flush()
+            if distributed:
+                # Rank 0 decides when all ranks stop
+                stop = bool(distributed_broadcast(stop))
         print()
 
     def _save(self, file_name):
-        self._modified = util.get_time_str()
-        self._updates += 1
-
-        data = {}
-        data['pyprob_version'] = __version__
-        data['torch_version'] = torch.__version__
-        data['inference_network'] = self
-
-        def thread_save():
-            tmp_dir = tempfile.mkdtemp(suffix=str(uuid.uuid4()))
-            tmp_file_name = os.path.join(tmp_dir, 'pyprob_inference_network')
-            torch.save(data, tmp_file_name)
-            tar = tarfile.open(file_name, 'w:gz', compresslevel=2)
-            tar.add(tmp_file_name, arcname='pyprob_inference_network')
-            tar.close()
-            shutil.rmtree(tmp_dir)
-        t = Thread(target=thread_save)
-        t.start()
-        t.join()
+        return save_checkpoint(self, file_name)
 
     @staticmethod
     def _load(file_name, cuda=False, device=None):
+        return load_checkpoint(file_name, cuda, device)
+
+
+_checkpoint_header_name = 'pyprob_checkpoint_header'
+_checkpoint_state_name = 'pyprob_checkpoint_state'
+_checkpoint_evicted_name = 'pyprob_checkpoint_evicted_{}'
+_checkpoint_format_version = 1
+_checkpoint_valid_batch_suffix = '_valid'
+_checkpoint_config_names = {'InferenceNetworkSimple': ['model_name', 'observe_embedding', 'observe_reshape', 'observe_embedding_dim'],
+                            'InferenceNetworkLSTM': ['model_name', 'lstm_dim', 'lstm_depth', 'observe_embedding', 'observe_reshape', 'observe_embedding_dim', 'sample_embedding', 'sample_embedding_dim', 'address_embedding_dim', 'proposal_architecture', 'max_addresses', 'address_eviction', 'address_spill_path']}
+_checkpoint_config_enums = {'observe_embedding': ObserveEmbedding, 'sample_embedding': SampleEmbedding, 'proposal_architecture': ProposalArchitecture, 'address_eviction': AddressEviction}
+_checkpoint_attribute_names = ['_on_cuda', '_cuda_device', '_trained_on', '_total_train_seconds', '_total_train_traces', '_total_train_iterations', '_loss_initial', '_loss_min', '_loss_max', '_loss_previous', '_history_train_loss', '_history_train_loss_trace', '_history_valid_loss', '_history_valid_loss_trace', '_history_num_params', '_history_num_params_trace', '_created', '_modified', '_updates', '_pyprob_version', '_torch_version', '_optimizer_type', '_address_stats', '_trace_stats', '_distribution_type_embeddings', '_address_last_used']
+_checkpoint_attribute_enums = {'_optimizer_type': Optimizer}
+
+
+def save_checkpoint(network, file_name):
+    # Saves an InferenceNetworkSimple or InferenceNetworkLSTM as an uncompressed tar with a JSON header (configuration, address registry and layer specifications) and a member with the state_dict and training statistics. Returns a future
+    # The validation batch is written to a separate file (file_name + '_valid') only when it has not been saved there before, so that repeated saves (e.g., auto_save) write only the parameters
+    if network._quantized:
+        raise RuntimeError('Cannot save a quantized inference network, save the network it was created from instead.')
+    network._modified = util.get_time_str()
+    network._updates += 1
+
+    valid_batch_file_name = None
+    if network._valid_batch is not None:
+        valid_batch_file_name = os.path.abspath(file_name + _checkpoint_valid_batch_suffix)
+        if (network._valid_batch_file_name != valid_batch_file_name) or (not os.path.exists(valid_batch_file_name)):
+            # Saves are written in order by a single writer thread, so the validation batch is on disk when the returned future completes
+            util.save_tar_async(valid_batch_file_name, [('pyprob_valid_batch', network._valid_batch)])
+            network._valid_batch_file_name = valid_batch_file_name
+
+    network_name = type(network).__name__
+    config = OrderedDict()
+    for name in _checkpoint_config_names[network_name]:
+        value = getattr(network, '_' + name)
+        config[name] = value.name if name in _checkpoint_config_enums else value
+    header = OrderedDict()
+    header['format'] = 'pyprob_checkpoint'
+    header['format_version'] = _checkpoint_format_version
+    header['pyprob_version'] = __version__
+    header['torch_version'] = torch.__version__
+    header['network'] = network_name
+    header['config'] = config
+    header['observe_example_size'] = network._observe_example_size
+    header['valid_batch_file_name'] = None if valid_batch_file_name is None else os.path.basename(valid_batch_file_name)
+    header['modified'] = network._modified
+    header['total_train_traces'] = network._total_train_traces
+    if isinstance(network, InferenceNetworkLSTM):
+        header['addresses'] = sorted(network._address_ids, key=network._address_ids.get)
+    header['layers'] = [[address, spec] for address, spec in network._layer_specs.items()]
+    # The layers of evicted addresses are copied from their spill files, which the network deletes when it restores them
+    evicted = []
+    for i, (address, spill_file_name) in enumerate(getattr(network, '_evicted_addresses', {}).items()):
+        with open(spill_file_name, 'rb') as spill_file:
+            evicted.append((address, _checkpoint_evicted_name.format(i), spill_file.read()))
+    header['evicted'] = [[address, name] for address, name, _ in evicted]
+
+    # The state holds only tensors and plain values, so that it can be loaded with weights_only=True
+    state = {}
+    state['state_dict'] = network.state_dict()
+    state['attributes'] = {}
+    for name in _checkpoint_attribute_names:
+        if hasattr(network, name):
+            value = getattr(network, name)
+            state['attributes'][name] = value.name if isinstance(value, _checkpoint_attribute_enums.get(name, ())) else value
+    return util.save_tar_async(file_name, [(_checkpoint_header_name, json.dumps(header).encode('utf-8')), (_checkpoint_state_name, state)] + [(name, data) for _, name, data in evicted], compresslevel=None)
+
+
+def _network_from_checkpoint(file_name, header, state, members):
+    config = dict(header['config'])
+    for name, enum_class in _checkpoint_config_enums.items():
+        if name in config:
+            config[name] = enum_class[config[name]]
+    network_class = InferenceNetworkLSTM if header['network'] == 'InferenceNetworkLSTM' else InferenceNetworkSimple
+    ret = network_class(example_observes=torch.zeros(header['observe_example_size']), **config)
+    if isinstance(ret, InferenceNetworkLSTM):
+        for address in header['addresses']:
+            address_id = len(ret._address_ids)
+            if address_id % _address_embedding_chunk_size == 0:
+                ret._address_embedding_chunks.append(Parameter(torch.zeros(_address_embedding_chunk_size, ret._address_embedding_dim)))
+            ret._address_ids[address] = address_id
+    if 'evicted' in header:
+        evicted_addresses = OrderedDict([(address, members[name]) for address, name in header['evicted']])
+    else:
+        # Checkpoints that referred to the spill files of the saving network
+        evicted_addresses = state['attributes'].pop('_evicted_addresses', {})
+        for address, spill_file_name in evicted_addresses.items():
+            with open(spill_file_name, 'rb') as spill_file:
+                evicted_addresses[address] = spill_file.read()
+    for address, spec in header['layers']:
+        if address in evicted_addresses:
+            ret._layer_specs[address] = spec
+        else:
+            ret._add_layers(address, spec)
+    ret.cpu()
+    ret.load_state_dict(state['state_dict'])
+    for name, value in state['attributes'].items():
+        if (name in _checkpoint_attribute_enums) and (value != ''):
+            value = _checkpoint_attribute_enums[name][value]
+        setattr(ret, name, value)
+    # The loaded network gets its own spill files for the evicted layers
+    for address, data in evicted_addresses.items():
+        spill_file_name = ret._spill_file_name()
+        with open(spill_file_name, 'wb') as spill_file:
+            spill_file.write(data)
+        ret._evicted_addresses[address] = spill_file_name
+
+    if header['valid_batch_file_name'] is not None:
+        valid_batch_file_name = os.path.join(os.path.dirname(os.path.abspath(file_name)), header['valid_batch_file_name'])
+        if os.path.exists(valid_batch_file_name):
+            ret._valid_batch = util.load_tar(valid_batch_file_name, 'pyprob_valid_batch', map_location=lambda storage, loc: storage)
+            ret._valid_batch_file_name = valid_batch_file_name
+        else:
+            print(colored('Warning: validation batch not found ({}), a new one will be generated when training continues'.format(valid_batch_file_name), 'red', attrs=['bold']))
+    return ret
+
+
+def load_checkpoint(file_name, cuda=False, device=None):
+    # Loads a network saved with save_checkpoint, or pickled as a whole by earlier versions
+    try:
+        member_names = util.tar_member_names(file_name)
+    except (OSError, tarfile.TarError) as e:
+        raise RuntimeError('Cannot load inference network.') from e
+    if _checkpoint_header_name in member_names:
+        try:
+            members = util.load_tar_members(file_name)
+            header = json.loads(members[_checkpoint_header_name].decode('utf-8'))
+        except (OSError, tarfile.TarError, KeyError, ValueError) as e:
+            raise RuntimeError('Cannot load inference network.') from e
+        if header['format_version'] > _checkpoint_format_version:
+            raise RuntimeError('Cannot load inference network saved with a newer checkpoint format (version {}) than supported (version {}).'.format(header['format_version'], _checkpoint_format_version))
+        try:
+            state = torch.load(io.BytesIO(members[_checkpoint_state_name]), map_location=lambda storage, loc: storage, weights_only=True)
+            pyprob_version, torch_version = header['pyprob_version'], header['torch_version']
+            ret = _network_from_checkpoint(file_name, header, state, members)
+        except (OSError, EOFError, KeyError, ValueError, RuntimeError, pickle.UnpicklingError) as e:
+            raise RuntimeError('Cannot load inference network.') from e
+    else:
         try:
-            tar = tarfile.open(file_name, 'r:gz')
-            tmp_dir = tempfile.mkdtemp(suffix=str(uuid.uuid4()))
-            tmp_file = os.path.join(tmp_dir, 'pyprob_inference_network')
-            tar.extract('pyprob_inference_network', tmp_dir)
-            tar.close()
-            if cuda:
-                data = torch.load(tmp_file)
+            data = util.load_tar(file_name, 'pyprob_inference_network', map_location=lambda storage, loc: storage)
+            pyprob_version, torch_version = data['pyprob_version'], data['torch_version']
+            ret = data['inference_network']
+            if not hasattr(ret, '_layer_specs'):
+                ret._layer_specs = OrderedDict()
+                for address, proposal_layer in ret._proposal_layers.items():
+                    spec = {}
+                    if isinstance(ret, InferenceNetworkLSTM):
+                        sample_embedding_layer = ret._sample_embedding_layers[address]
+                        spec['sample_embedding'] = {'input_dim': sample_embedding_layer._input_dim, 'output_dim': sample_embedding_layer._lin2.out_features, 'input_is_one_hot_index': sample_embedding_layer._input_is_one_hot_index, 'input_one_hot_dim': sample_embedding_layer._input_one_hot_dim}
+                    spec['proposal'] = _proposal_layer_spec_of(proposal_layer)
+                    ret._layer_specs[address] = spec
+                ret._observe_example_size = list(ret._valid_batch[0].pack_observes().size())
+            for name, value in [('_quantized', False), ('_valid_batch_file_name', None)]:
+                if not hasattr(ret, name):
+                    setattr(ret, name, value)
+        except (OSError, EOFError, KeyError, AttributeError, ImportError, RuntimeError, tarfile.TarError, pickle.UnpicklingError) as e:
+            raise RuntimeError('Cannot load inference network.') from e
+
+    if pyprob_version != __version__:
+        print(colored('Warning: different pyprob versions (loaded network: {}, current system: {})'.format(pyprob_version, __version__), 'red', attrs=['bold']))
+    if torch_version != torch.__version__:
+        print(colored('Warning: different PyTorch versions (loaded network: {}, current system: {})'.format(torch_version, torch.__version__), 'red', attrs=['bold']))
+
+    # The network is loaded to CPU, and moved to CUDA if requested
+    if cuda:
+        if ret._on_cuda:
+            if ret._cuda_device != device:
+                print(colored('Warning: loading CUDA (device {}) network to CUDA (device {})'.format(ret._cuda_device, device), 'red', attrs=['bold']))
+        else:
+            print(colored('Warning: loading CPU network to CUDA (device {})'.format(device), 'red', attrs=['bold']))
+        ret.cuda(device)
+    else:
+        if ret._on_cuda:
+            print(colored('Warning: loading CUDA (device {}) network to CPU'.format(ret._cuda_device), 'red', attrs=['bold']))
+        ret.cpu()
+    return ret
+
+
+_torchscript_header_name = 'pyprob_torchscript_header'
+_torchscript_format_version = 1
+
+
+def _torchscript_bytes(module, example_inputs):
+    # Traces a CPU copy of module, so that the network being exported is not modified
+    module = copy.deepcopy(module).cpu().eval()
+    with torch.no_grad():
+        traced = torch.jit.trace(module, example_inputs)
+    buffer = io.BytesIO()
+    torch.jit.save(traced, buffer)
+    return buffer.getvalue()
+
+
+def _proposal_trunk(proposal_layer):
+    # The part of a proposal layer before _forward_head, as evaluated in eval mode
+    return nn.Sequential(proposal_layer._lin1, nn.ReLU(), proposal_layer._lin2)
+
+
+def _proposal_head_config(proposal_layer):
+    # The attributes used by _forward_head
+    return {name: getattr(proposal_layer, name) for name in ['_output_dim', '_mixture_components'] if hasattr(proposal_layer, name)}
+
+
+def export_torchscript(network, file_name):
+    # Saves an InferenceNetworkSimple or InferenceNetworkLSTM for inference only, in a format that does not depend on the pickled Python classes of the network. Returns a future
+    # The file is an uncompressed tar with a JSON header (network configuration and address table), a tensor file with the frozen address and distribution type embeddings, and TorchScript modules for the observation embedding, the LSTM, and the sample embedding and proposal layers of each address
+    # The final transformation of proposal layer outputs into distributions depends on the prior at each address and is done in Python by the _forward_head of the proposal layer classes when loading with InferenceNetworkTorchScript
+    is_lstm = isinstance(network, InferenceNetworkLSTM)
+    addresses = list(network._proposal_layers.keys())
+    if is_lstm and (len(network._evicted_addresses) > 0):
+        print(colored('Warning: the layers of {:,} evicted addresses are not exported, the prior will be used at these addresses'.format(len(network._evicted_addresses)), 'red', attrs=['bold']))
+    header = OrderedDict()
+    header['format'] = 'pyprob_torchscript'
+    header['format_version'] = _torchscript_format_version
+    header['pyprob_version'] = __version__
+    header['torch_version'] = torch.__version__
+    header['network'] = type(network).__name__
+    header['model_name'] = network._model_name
+    header['created'] = util.get_time_str()
+    header['total_train_seconds'] = network._total_train_seconds
+    header['total_train_traces'] = network._total_train_traces
+    header['total_train_iterations'] = network._total_train_iterations
+    if is_lstm:
+        header['lstm_dim'] = network._lstm_dim
+        header['lstm_depth'] = network._lstm_depth
+        header['sample_embedding_dim'] = network._sample_embedding_dim
+    header['addresses'] = []
+
+    members = []
+    example_observes = torch.zeros([1] + network._observe_example_size)
+    members.append(('observe_embedding', _torchscript_bytes(network._observe_embedding_layer, example_observes)))
+    if is_lstm:
+        embeddings = {}
+        embeddings['address_embeddings'] = network._address_embeddings(addresses).detach().cpu()
+        embeddings['address_embedding_empty'] = network._address_embedding_empty.detach().cpu()
+        embeddings['distribution_type_embeddings'] = {name: t.detach().cpu() for name, t in network._distribution_type_embeddings.items()}
+        embeddings['distribution_type_embedding_empty'] = network._distribution_type_embedding_empty.detach().cpu()
+        members.append(('embeddings', embeddings))
+        example_lstm_input = torch.zeros(1, 1, network._lstm_input_dim)
+        example_hidden_state = (torch.zeros(network._lstm_depth, 1, network._lstm_dim), torch.zeros(network._lstm_depth, 1, network._lstm_dim))
+        members.append(('lstm', _torchscript_bytes(network._lstm, (example_lstm_input, example_hidden_state))))
+        header['proposal_film'] = network._proposal_film is not None
+        if network._proposal_film is not None:
+            members.append(('proposal_film', _torchscript_bytes(network._proposal_film, (torch.zeros(1, network._lstm_dim), torch.zeros(1, network._address_embedding_dim)))))
+    proposal_indices = {}  # Proposal layers shared by addresses are exported once
+    for i, address in enumerate(addresses):
+        proposal_layer = network._proposal_layers[address]
+        if id(proposal_layer) not in proposal_indices:
+            proposal_indices[id(proposal_layer)] = len(proposal_indices)
+            members.append(('proposal_{}'.format(proposal_indices[id(proposal_layer)]), _torchscript_bytes(_proposal_trunk(proposal_layer), torch.zeros(1, proposal_layer._lin1.in_features))))
+        entry = OrderedDict()
+        entry['address'] = address
+        entry['proposal'] = type(proposal_layer).__name__
+        entry['proposal_head'] = _proposal_head_config(proposal_layer)
+        entry['proposal_index'] = proposal_indices[id(proposal_layer)]
+        if is_lstm:
+            sample_embedding_layer = network._sample_embedding_layers[address]
+            entry['sample_embedding_one_hot_dim'] = sample_embedding_layer._input_one_hot_dim if sample_embedding_layer._input_is_one_hot_index else None
+            sample_embedding_core = nn.Sequential(sample_embedding_layer._lin1, nn.ReLU(), sample_embedding_layer._lin2, nn.ReLU())
+            members.append(('sample_embedding_{}'.format(i), _torchscript_bytes(sample_embedding_core, torch.zeros(1, sample_embedding_layer._lin1.in_features))))
+        header['addresses'].append(entry)
+    members.insert(0, (_torchscript_header_name, json.dumps(header).encode('utf-8')))
+    return util.save_tar_async(file_name, members, compresslevel=None)
+
+
+class InferenceNetworkTorchScript(nn.Module):
+    # An inference network loaded from a file written by export_torchscript, for importance sampling only (it cannot be trained or polymorphed)
+    # A module, so that it can take the place of a trained network in Model._inference_network; the loaded ScriptModules are its submodules
+    def __init__(self, header, members, device='cpu'):
+        super().__init__()
+        self._script_modules = nn.ModuleList()
+        self._header = header
+        self._model_name = header['model_name']
+        self._total_train_seconds = header['total_train_seconds']
+        self._total_train_traces = header['total_train_traces']
+        self._total_train_iterations = header['total_train_iterations']
+        self._is_lstm = header['network'] == 'InferenceNetworkLSTM'
+        self._device = device
+
+        self._state_new_trace = True
+        self._state_observes = None
+        self._state_observes_embedding = None
+        self._state_lstm_hidden_state = None
+
+        self._observe_embedding_layer = self._load_module(members['observe_embedding'])
+        self._address_ids = {}
+        self._proposal_trunks = {}
+        self._proposal_heads = {}
+        self._sample_embedding_layers = {}
+        self._sample_embedding_one_hot_dims = {}
+        proposal_trunks = {}
+        for i, entry in enumerate(header['addresses']):
+            address = entry['address']
+            self._address_ids[address] = i
+            proposal_index = entry.get('proposal_index', i)
+            if proposal_index not in proposal_trunks:
+                proposal_trunks[proposal_index] = self._load_module(members['proposal_{}'.format(proposal_index)])
+            self._proposal_trunks[address] = proposal_trunks[proposal_index]
+            self._proposal_heads[address] = functools.partial(_proposal_layer_classes[entry['proposal']]._forward_head, types.SimpleNamespace(**entry['proposal_head']))
+            if self._is_lstm:
+                self._sample_embedding_layers[address] = self._load_module(members['sample_embedding_{}'.format(i)])
+                self._sample_embedding_one_hot_dims[address] = entry['sample_embedding_one_hot_dim']
+        if self._is_lstm:
+            self._lstm_dim = header['lstm_dim']
+            self._lstm_depth = header['lstm_depth']
+            self._sample_embedding_dim = header['sample_embedding_dim']
+            self._lstm = self._load_module(members['lstm'])
+            self._proposal_film = self._load_module(members['proposal_film']) if header.get('proposal_film', False) else None
+            embeddings = torch.load(io.BytesIO(members['embeddings']), map_location=lambda storage, loc: storage, weights_only=True)
+            self._address_embeddings = embeddings['address_embeddings'].to(device)
+            self._address_embedding_empty = embeddings['address_embedding_empty'].to(device)
+            self._distribution_type_embeddings = {name: t.to(device) for name, t in embeddings['distribution_type_embeddings'].items()}
+            self._distribution_type_embedding_empty = embeddings['distribution_type_embedding_empty'].to(device)
+
+    def _load_module(self, buffer):
+        module = torch.jit.load(io.BytesIO(buffer), map_location=self._device)
+        self._script_modules.append(module)
+        return module
+
+    def new_trace(self, observes=None):
+        self._state_new_trace = True
+        if (self._state_observes is None) or ((observes is not self._state_observes) and not ((observes.size() == self._state_observes.size()) and torch.equal(observes, self._state_observes))):
+            with torch.no_grad():
+                self._state_observes_embedding = self._observe_embedding_layer(observes.to(self._device))
+        self._state_observes = observes
+
+    def can_propose(self, previous_sample, current_sample):
+        success = True
+        if self._is_lstm:
+            if previous_sample is not None:
+                if previous_sample.address not in self._address_ids:
+                    print('Warning: unknown address (previous): {}'.format(previous_sample.address))
+                    success = False
+                if previous_sample.distribution.name not in self._distribution_type_embeddings:
+                    print('Warning: unkown distribution type (previous): {}'.format(previous_sample.distribution.name))
+                    success = False
+            if current_sample.distribution.name not in self._distribution_type_embeddings:
+                print('Warning: unkown distribution type (current): {}'.format(current_sample.distribution.name))
+                success = False
+        if current_sample.address not in self._address_ids:
+            print('Warning: unknown address (current): {}'.format(current_sample.address))
+            success = False
+        return success
+
+    def _sample_embedding(self, sample):
+        value = sample.value.float().to(self._device).view(1, -1)
+        one_hot_dim = self._sample_embedding_one_hot_dims[sample.address]
+        if one_hot_dim is not None:
+            value = util.one_hot(one_hot_dim, int(value)).to(self._device).unsqueeze(0)
+        return self._sample_embedding_layers[sample.address](value)
+
+    def forward_one_time_step(self, previous_sample, current_sample):
+        if self._state_observes is None:
+            raise RuntimeError('Cannot run the inference network without observations. Call new_trace and supply observations.')
+        new_trace = self._state_new_trace
+        self._state_new_trace = False
+        if not self.can_propose(None if new_trace else previous_sample, current_sample):
+            print('Warning: no proposal could be made, prior will be used')
+            return current_sample.distribution
+
+        current_address = current_sample.address
+        if self._is_lstm:
+            if new_trace:
+                prev_sample_embedding = torch.zeros(1, self._sample_embedding_dim, device=self._device)
+                prev_embedding = torch.cat([self._distribution_type_embedding_empty, self._address_embedding_empty])
+                h0 = torch.zeros(self._lstm_depth, 1, self._lstm_dim, device=self._device)
+                c0 = torch.zeros(self._lstm_depth, 1, self._lstm_dim, device=self._device)
+                self._state_lstm_hidden_state = (h0, c0)
             else:
-                data = torch.load(tmp_file, map_location=lambda storage, loc: storage)
-                shutil.rmtree(tmp_dir)
-        except:
-            raise RuntimeError('Cannot load inference network.')
+                prev_sample_embedding = self._sample_embedding(previous_sample)
+                prev_embedding = torch.cat([self._distribution_type_embeddings[previous_sample.distribution.name], self._address_embeddings[self._address_ids[previous_sample.address]]])
+            current_embedding = torch.cat([self._distribution_type_embeddings[current_sample.distribution.name], self._address_embeddings[self._address_ids[current_address]]])
+            lstm_input = torch.cat([self._state_observes_embedding[0], prev_sample_embedding[0], prev_embedding, current_embedding]).view(1, 1, -1)
+            lstm_output, self._state_lstm_hidden_state = self._lstm(lstm_input, self._state_lstm_hidden_state)
+            proposal_input = lstm_output[0]
+            if self._proposal_film is not None:
+                proposal_input = self._proposal_film(proposal_input, self._address_embeddings[self._address_ids[current_address]].unsqueeze(0))
+        else:
+            proposal_input = self._state_observes_embedding
+        return self._proposal_heads[current_address](self._proposal_trunks[current_address](proposal_input), [current_sample])
 
-        if data['pyprob_version'] != __version__:
-            print(colored('Warning: different pyprob versions (loaded network: {}, current system: {})'.format(data['pyprob_version'], __version__), 'red', attrs=['bold']))
-        if data['torch_version'] != torch.__version__:
-            print(colored('Warning: different PyTorch versions (loaded network: {}, current system: {})'.format(data['torch_version'], torch.__version__), 'red', attrs=['bold']))
+    def _save(self, file_name):
+        raise RuntimeError('Cannot save an exported inference network, copy the exported file instead.')
+
+    @staticmethod
+    def _is_exported(file_name):
+        try:
+            return _torchscript_header_name in util.tar_member_names(file_name)
+        except:
+            return False
 
-        ret = data['inference_network']
+    @staticmethod
+    def _load(file_name, cuda=False, device=None):
+        try:
+            members = util.load_tar_members(file_name)
+            header = json.loads(members[_torchscript_header_name].decode('utf-8'))
+        except:
+            raise RuntimeError('Cannot load inference network.')
+        if header['format_version'] > _torchscript_format_version:
+            raise RuntimeError('Cannot load inference network exported with a newer format (version {}) than supported (version {}).'.format(header['format_version'], _torchscript_format_version))
+        if header['pyprob_version'] != __version__:
+            print(colored('Warning: different pyprob versions (loaded network: {}, current system: {})'.format(header['pyprob_version'], __version__), 'red', attrs=['bold']))
+        if header['torch_version'] != torch.__version__:
+            print(colored('Warning: different PyTorch versions (loaded network: {}, current system: {})'.format(header['torch_version'], torch.__version__), 'red', attrs=['bold']))
         if cuda:
-            if ret._on_cuda:
-                if ret._cuda_device != device:
-                    print(colored('Warning: loading CUDA (device {}) network to CUDA (device {})'.format(ret._cuda_device, device), 'red', attrs=['bold']))
-                    ret.cuda(device)
-            else:
-                print(colored('Warning: loading CPU network to CUDA (device {})'.format(device), 'red', attrs=['bold']))
-                ret.cuda(device)
+            device = 'cuda' if device is None else 'cuda:{}'.format(device)
         else:
-            if ret._on_cuda:
-                print(colored('Warning: loading CUDA (device {}) network to CPU'.format(ret._cuda_device), 'red', attrs=['bold']))
-                ret.cpu()
-        return ret
+            device = 'cpu'
+        return InferenceNetworkTorchScript(header, members, device)
@@ -17,10 +17,22 @@ _current_trace_root_function_name = None
 _current_trace_inference_network = None
 _current_trace_previous_sample = None
 _current_trace_replaced_sample_proposal_distributions = {}
+_current_trace_lockstep_particle = None
 _metropolis_hastings_trace = None
 _metropolis_hastings_site_address = None
 _metropolis_hastings_site_transition_log_prob = 0
 
+# The global variables describing the trace being recorded, these are switched when several traces are recorded concurrently (see lockstep.py)
+_trace_state_names = ['_trace_mode', '_inference_engine', '_prior_inflation', '_observation_importance_exponent', '_current_trace', '_current_trace_root_function_name', '_current_trace_inference_network', '_current_trace_previous_sample', '_current_trace_replaced_sample_proposal_distributions', '_current_trace_lockstep_particle']
+
+
+def get_trace_state():
+    return {name: globals()[name] for name in _trace_state_names}
+
+
+def set_trace_state(trace_state):
+    globals().update(trace_state)
+
 
 def extract_address(root_function_name):
     # tb = traceback.extract_stack()
@@ -94,6 +106,13 @@ def _sample_with_prior_inflation(distribution):
     return distribution.sample()
 
 
+def _propose(current_sample):
+    if _current_trace_lockstep_particle is None:
+        return _current_trace_inference_network.forward_one_time_step(_current_trace_previous_sample, current_sample)
+    else:
+        return _current_trace_lockstep_particle.propose(current_sample)
+
+
 def sample(distribution, control=True, replace=False, address=None):
     if _trace_mode == TraceMode.NONE:
         return _sample_with_prior_inflation(distribution)  # Forward sample
@@ -129,31 +148,31 @@ def sample(distribution, control=True, replace=False, address=None):
                 if control:
                     global _current_trace_previous_sample
                     global _current_trace_replaced_sample_proposal_distributions
-                    _current_trace_inference_network.eval()
                     current_sample = Sample(distribution, 0, address_base, address, instance, log_prob=0, control=control, replace=replace)
                     if replace:
                         if address not in _current_trace_replaced_sample_proposal_distributions:
-                            _current_trace_replaced_sample_proposal_distributions[address] = _current_trace_inference_network.forward_one_time_step(_current_trace_previous_sample, current_sample)
+                            _current_trace_replaced_sample_proposal_distributions[address] = _propose(current_sample)
                             update_previous_sample = True
                         proposal_distribution = _current_trace_replaced_sample_proposal_distributions[address]
                     else:
-                        proposal_distribution = _current_trace_inference_network.forward_one_time_step(_current_trace_previous_sample, current_sample)
+                        proposal_distribution = _propose(current_sample)
                         update_previous_sample = True
 
                     value = proposal_distribution.sample()[0]
                     log_prob = distribution.log_prob(value)
                     proposal_log_prob = proposal_distribution.log_prob(value)
-                    if util.has_nan_or_inf(log_prob):
-                        print(colored('Warning: prior log_prob has NaN, inf, or -inf.', 'red', attrs=['bold']))
-                        print('distribution', distribution)
-                        print('value', value)
-                        print('log_prob', log_prob)
-                    if util.has_nan_or_inf(proposal_log_prob):
-                        print(colored('Warning: proposal log_prob has NaN, inf, or -inf.', 'red', attrs=['bold']))
-                        print('distribution', proposal_distribution)
-                        print('value', value)
-                        print('log_prob', proposal_log_prob)
-                    _current_trace.log_importance_weight += log_prob - proposal_log_prob.item()
+                    if util._debug_mode:
+                        if util.has_nan_or_inf(log_prob):
+                            print(colored('Warning: prior log_prob has NaN, inf, or -inf.', 'red', attrs=['bold']))
+                            print('distribution', distribution)
+                            print('value', value)
+                            print('log_prob', log_prob)
+                        if util.has_nan_or_inf(proposal_log_prob):
+                            print(colored('Warning: proposal log_prob has NaN, inf, or -inf.', 'red', attrs=['bold']))
+                            print('distribution', proposal_distribution)
+                            print('value', value)
+                            print('log_prob', proposal_log_prob)
+                    _current_trace.log_importance_weight += util.safe_torch_sum(log_prob - proposal_log_prob)  # Summed to a scalar so that log_probs of differing shapes (e.g., [1] and [1, 1]) accumulate, converted to float once, in Trace.end
                 else:
                     value = distribution.sample()
                     log_prob = distribution.log_prob(value)
@@ -229,14 +248,14 @@ def observe(distribution, observation, address=None):
 
         log_prob = _observation_importance_exponent * distribution.log_prob(observation)
         if _inference_engine == InferenceEngine.IMPORTANCE_SAMPLING or _inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK:
-            _current_trace.log_importance_weight += log_prob.item()
+            _current_trace.log_importance_weight += util.safe_torch_sum(log_prob)
 
         current_sample = Sample(distribution=distribution, value=observation, address_base=address_base, address=address, instance=instance, log_prob=log_prob, observed=True)
         _current_trace.add_sample(current_sample)
     return
 
 
-def begin_trace(func, trace_mode=TraceMode.NONE, prior_inflation=PriorInflation.DISABLED, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, inference_network=None, metropolis_hastings_trace=None, observation_importance_exponent=1.):
+def begin_trace(func, trace_mode=TraceMode.NONE, prior_inflation=PriorInflation.DISABLED, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING, inference_network=None, metropolis_hastings_trace=None, observation_importance_exponent=1., lockstep_particle=None):
     global _trace_mode
     global _inference_engine
     global _prior_inflation
@@ -250,10 +269,12 @@ def begin_trace(func, trace_mode=TraceMode.NONE, prior_inflation=PriorInflation.
         global _current_trace_root_function_name
         global _current_trace_inference_network
         global _current_trace_replaced_sample_proposal_distributions
+        global _current_trace_lockstep_particle
         _current_trace = Trace()
         _current_trace_root_function_name = func.__code__.co_name
         _current_trace_inference_network = inference_network
         _current_trace_replaced_sample_proposal_distributions = {}
+        _current_trace_lockstep_particle = lockstep_particle
         if (_inference_engine == InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK) and (inference_network is None):
             raise ValueError('Cannot run trace with proposals without an inference network')
         if _inference_engine == InferenceEngine.LIGHTWEIGHT_METROPOLIS_HASTINGS or _inference_engine == InferenceEngine.RANDOM_WALK_METROPOLIS_HASTINGS:
@@ -274,6 +295,7 @@ def end_trace(result):
     global _current_trace
     global _current_trace_root_function_name
     global _current_trace_inference_network
+    global _current_trace_lockstep_particle
     _inference_engine = InferenceEngine.IMPORTANCE_SAMPLING
     _prior_inflation = PriorInflation.DISABLED
     if _trace_mode == TraceMode.NONE:
@@ -285,4 +307,5 @@ def end_trace(result):
         _current_trace = None
         _current_trace_root_function_name = None
         _current_trace_inference_network = None
+        _current_trace_lockstep_particle = None
         return ret
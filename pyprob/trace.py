@@ -1,4 +1,33 @@
+import hashlib
+import torch
+
 from . import util, TrainingObservation
+from .distributions import Distribution
+
+
+class TensorReference(object):
+    # Placeholder for a tensor kept in a content-addressed tensor store outside a trace cache file
+    def __init__(self, key):
+        self.key = key
+
+    def __repr__(self):
+        return 'TensorReference(key:{})'.format(self.key)
+
+
+def _map_tensors(obj, func, memo):
+    # Replaces each tensor (or TensorReference) held by obj and its nested distributions with func(tensor)
+    if id(obj) in memo:
+        return
+    memo.add(id(obj))
+    for key, value in list(vars(obj).items()):
+        if torch.is_tensor(value) or isinstance(value, TensorReference):
+            obj.__dict__[key] = func(value)
+        elif isinstance(value, (Distribution, torch.distributions.Distribution)):
+            _map_tensors(value, func, memo)
+        elif isinstance(value, (list, tuple)):
+            for v in value:
+                if isinstance(v, (Distribution, torch.distributions.Distribution)):
+                    _map_tensors(v, func, memo)
 
 
 class Sample(object):
@@ -29,6 +58,13 @@ class Sample(object):
             str(self.value)
         )
 
+    def map_tensors(self, func, memo=None):
+        if memo is None:
+            memo = set()
+        if torch.is_tensor(self.value) or isinstance(self.value, TensorReference):
+            self.value = func(self.value)
+        _map_tensors(self.distribution, func, memo)
+
     def cuda(self, device=None):
         if self.value is not None:
             self.value = self.value.cuda(device)
@@ -63,6 +99,10 @@ class Trace(object):
     def addresses(self):
         return '; '.join([sample.address for sample in self.samples])
 
+    def trace_type(self):
+        # Unlike hash(self.addresses()), this is stable across processes and can be used in file names
+        return hashlib.md5(self.addresses().encode('utf-8')).hexdigest()[:16]
+
     def end(self, result):
         self.result = result
         self.samples = []
@@ -83,6 +123,8 @@ class Trace(object):
         self.log_prob_observed = util.to_variable(sum([util.safe_torch_sum(s.log_prob) for s in self.samples_observed])).view(-1)
 
         self.log_prob = util.to_variable(sum([util.safe_torch_sum(s.log_prob) for s in self._samples_all if s.control or s.observed])).view(-1)
+        if torch.is_tensor(self.log_importance_weight):
+            self.log_importance_weight = float(util.safe_torch_sum(self.log_importance_weight))
         self.length = len(self.samples)
 
     def pack_observes(self, training_observation=TrainingObservation.OBSERVE_DIST_SAMPLE):
@@ -102,6 +144,12 @@ class Trace(object):
         self._samples_all_dict_address[sample.address] = sample
         self._samples_all_dict_address_base[sample.address_base] = sample
 
+    def map_tensors(self, func):
+        # Applies func to the values and distribution parameters of all samples
+        memo = set()
+        for sample in self._samples_all:
+            sample.map_tensors(func, memo)
+
     def cuda(self, device=None):
         for sample in self._samples_all:
             sample.cuda(device)
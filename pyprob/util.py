@@ -9,6 +9,14 @@ import time
 import math
 from termcolor import colored
 import enum
+import hashlib
+import io
+import os
+import uuid
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
 
 import matplotlib
 matplotlib.use('Agg') # Do not use X server
@@ -33,6 +41,16 @@ class SampleEmbedding(enum.Enum):
     FULLY_CONNECTED = 0
 
 
+class ProposalArchitecture(enum.Enum):
+    PER_ADDRESS = 0  # Each address has its own proposal layer
+    SHARED_TRUNK = 1  # Addresses with the same distribution type and shape share a proposal layer, with inputs modulated by the address embedding (FiLM), so that parameters grow only with the address embeddings (InferenceNetworkLSTM only)
+
+
+class AddressEviction(enum.Enum):
+    LEAST_RECENTLY_USED = 0  # Evicts the layers of the addresses last seen in training longest ago
+    LEAST_FREQUENTLY_USED = 1  # Evicts the layers of the addresses seen in the fewest training traces
+
+
 class TraceMode(enum.Enum):
     NONE = 0  # No trace recording, forward sample trace results only
     PRIOR = 1
@@ -108,6 +126,14 @@ def set_verbosity(v=2):
     verbosity = v
 
 
+_debug_mode = False  # Enables numerical checks in the inference hot path (e.g., NaN and Inf checks for every proposal)
+
+
+def set_debug_mode(enabled=True):
+    global _debug_mode
+    _debug_mode = enabled
+
+
 def to_variable(value, *args, **kwargs):
     ret = None
     if isinstance(value, Variable):
@@ -193,6 +219,103 @@ def pack_observes_to_variable(observes):
                 return to_variable(Tensor())
 
 
+def tensor_content_hash(tensor):
+    tensor = tensor.detach().cpu().contiguous()
+    h = hashlib.sha1('{}{}'.format(tensor.dtype, tuple(tensor.size())).encode('utf-8'))
+    h.update(tensor.numpy().tobytes())
+    return h.hexdigest()
+
+
+_save_max_pending = 4  # Saves waiting to be written; further saves block the caller
+_save_executor = None
+_save_semaphore = None
+_save_pid = None
+
+
+def _write_tar(file_name, members, compresslevel):
+    # The archive is written to a temporary file in the destination directory and atomically renamed, so that readers never see a partially written file
+    directory, base_name = os.path.split(os.path.abspath(file_name))
+    tmp_file_name = os.path.join(directory, '.{}.{}.tmp'.format(base_name, str(uuid.uuid4())))
+    try:
+        if compresslevel is None:
+            tar = tarfile.open(tmp_file_name, 'w')
+        else:
+            tar = tarfile.open(tmp_file_name, 'w:gz', compresslevel=compresslevel)
+        for arcname, buffer in members:
+            tarinfo = tarfile.TarInfo(arcname)
+            tarinfo.size = len(buffer)
+            tarinfo.mtime = time.time()
+            tar.addfile(tarinfo, io.BytesIO(buffer))
+        tar.close()
+        os.replace(tmp_file_name, file_name)
+    except:
+        if os.path.exists(tmp_file_name):
+            os.remove(tmp_file_name)
+        raise
+
+
+def _save_done(future):
+    _save_semaphore.release()
+    if future.exception() is not None:
+        print(colored('Warning: cannot save file: {}'.format(future.exception()), 'red', attrs=['bold']))
+
+
+def save_tar_async(file_name, members, compresslevel=2):
+    # members is a list of (arcname, obj) pairs. The objects are serialized with torch.save before returning, so they can be modified while compression and writing happen in the background; bytes objects are written as they are. Returns a future.
+    global _save_executor
+    global _save_semaphore
+    global _save_pid
+    if (_save_executor is None) or (_save_pid != os.getpid()):
+        # The writer thread does not survive a fork, forked processes get their own
+        _save_executor = ThreadPoolExecutor(max_workers=1)
+        _save_semaphore = threading.BoundedSemaphore(_save_max_pending)
+        _save_pid = os.getpid()
+    buffers = []
+    for arcname, obj in members:
+        if isinstance(obj, bytes):
+            buffers.append((arcname, obj))
+        else:
+            buffer = io.BytesIO()
+            torch.save(obj, buffer)
+            buffers.append((arcname, buffer.getvalue()))
+    _save_semaphore.acquire()
+    future = _save_executor.submit(_write_tar, file_name, buffers, compresslevel)
+    future.add_done_callback(_save_done)
+    return future
+
+
+def wait_saves():
+    # Waits for the saves of save_tar_async to be written and stops the writer thread, which is started again by the next save
+    # Called before forking, so that no thread holds a lock (e.g., of a file or of the allocator) in the forked process
+    global _save_executor
+    if (_save_executor is not None) and (_save_pid == os.getpid()):
+        _save_executor.shutdown(wait=True)
+    _save_executor = None
+
+
+def load_tar(file_name, arcname, map_location=None):
+    tar = tarfile.open(file_name, 'r:*')
+    buffer = io.BytesIO(tar.extractfile(arcname).read())
+    tar.close()
+    # The archives hold pickled pyprob objects (e.g., traces and distributions), which weights_only loading rejects
+    return torch.load(buffer, map_location=map_location, weights_only=False)
+
+
+def load_tar_members(file_name):
+    # Returns an OrderedDict of arcname: bytes for all the members of a tar file
+    ret = OrderedDict()
+    with tarfile.open(file_name, 'r:*') as tar:
+        for tarinfo in tar:
+            if tarinfo.isfile():
+                ret[tarinfo.name] = tar.extractfile(tarinfo).read()
+    return ret
+
+
+def tar_member_names(file_name):
+    with tarfile.open(file_name, 'r:*') as tar:
+        return tar.getnames()
+
+
 def one_hot(dim, i):
     t = Tensor(dim).zero_()
     t.narrow(0, i, 1).fill_(1)
@@ -243,6 +366,23 @@ def days_hours_mins_secs_str(total_seconds):
     return '{0}d:{1:02}:{2:02}:{3:02}'.format(int(d), int(h), int(m), int(s))
 
 
+def memory_resident():
+    # Resident memory of this process in bytes, None where /proc is not available
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def memory_physical():
+    # Physical memory of the machine in bytes, None where it cannot be determined
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (OSError, ValueError, AttributeError):
+        return None
+
+
 def get_time_str():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
@@ -219,6 +219,30 @@ class GaussianWithUnknownMeanTestCase(unittest.TestCase):
         self.assertAlmostEqual(posterior_stddev, posterior_stddev_correct, places=0)
         self.assertLess(kl_divergence, 0.25)
 
+    def test_inference_gum_posterior_inference_compilation_lockstep(self):
+        samples = inference_compilation_samples
+        training_traces = inference_compilation_training_traces
+        lockstep_particles = 64
+        observation = [8, 9]
+        posterior_mean_correct = 7.25
+        posterior_stddev_correct = math.sqrt(1/1.2)
+
+        self._model.learn_inference_network(observation=[1, 1], num_traces=training_traces, prior_inflation=pyprob.PriorInflation.ENABLED)
+
+        posterior = self._model.posterior_distribution(samples, inference_engine=pyprob.InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK, lockstep_particles=lockstep_particles, observation=observation)
+
+        posterior_mean = float(posterior.mean)
+        posterior_mean_unweighted = float(posterior.unweighted().mean)
+        posterior_stddev = float(posterior.stddev)
+        posterior_stddev_unweighted = float(posterior.unweighted().stddev)
+        kl_divergence = float(util.kl_divergence_normal(Normal(posterior_mean_correct, posterior_stddev_correct), Normal(posterior.mean, posterior_stddev)))
+
+        util.debug('training_traces', 'samples', 'lockstep_particles', 'posterior_mean_unweighted', 'posterior_mean', 'posterior_mean_correct', 'posterior_stddev_unweighted', 'posterior_stddev', 'posterior_stddev_correct', 'kl_divergence')
+
+        self.assertAlmostEqual(posterior_mean, posterior_mean_correct, places=0)
+        self.assertAlmostEqual(posterior_stddev, posterior_stddev_correct, places=0)
+        self.assertLess(kl_divergence, 0.25)
+
     def test_inference_gum_posterior_lightweight_metropolis_hastings(self):
         samples = random_walk_metropolis_hastings_samples
         observation = [8, 9]
@@ -4,10 +4,16 @@ import torch
 import uuid
 import tempfile
 import os
+import multiprocessing
+import copy
+import threading
 
 import pyprob
-from pyprob import util, Model, TraceMode, InferenceEngine
-from pyprob.distributions import Normal, Uniform
+from pyprob import util, Model, TraceMode, InferenceEngine, TrainingObservation, Optimizer
+from pyprob.distributions import Normal, Uniform, Categorical
+from pyprob.nn import Batch, InferenceNetworkSimple, InferenceNetworkLSTM
+from pyprob.lockstep import ProposalRow
+from pyprob.trace import TensorReference
 
 
 class ModelTestCase(unittest.TestCase):
@@ -83,6 +89,337 @@ class ModelTestCase(unittest.TestCase):
 
         self.assertTrue(True)
 
+    def test_model_train_export_load(self):
+        training_traces = 128
+        posterior_traces = 64
+        file_name = os.path.join(tempfile.mkdtemp(), str(uuid.uuid4()))
+
+        self._model._inference_network = None
+        self._model.learn_inference_network(observation=[1, 1], num_traces=training_traces)
+        pyprob.set_random_seed(123)
+        posterior_mean = float(self._model.posterior_distribution(posterior_traces, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK, observation=[1, 1]).mean)
+        self._model.export_inference_network(file_name)
+        self._model.load_inference_network(file_name)
+        pyprob.set_random_seed(123)
+        posterior_mean_exported = float(self._model.posterior_distribution(posterior_traces, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK, observation=[1, 1]).mean)
+        self._model._inference_network = None
+        os.remove(file_name)
+
+        util.debug('training_traces', 'posterior_traces', 'file_name', 'posterior_mean', 'posterior_mean_exported')
+
+        self.assertAlmostEqual(posterior_mean, posterior_mean_exported, places=3)
+
+    def test_model_train_quantize(self):
+        training_traces = 128
+        posterior_traces = 64
+
+        self._model._inference_network = None
+        self._model.learn_inference_network(observation=[1, 1], num_traces=training_traces)
+        report = self._model.quantization_report(posterior_traces, observation=[1, 1])
+        inference_network = self._model.quantize_inference_network()
+        quantized = self._model._inference_network._quantized
+        posterior_mean = float(self._model.posterior_distribution(posterior_traces, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK, observation=[1, 1]).mean)
+        self._model._inference_network = None
+        float_quantized = inference_network._quantized
+
+        util.debug('training_traces', 'posterior_traces', 'report', 'quantized', 'float_quantized', 'posterior_mean')
+
+        self.assertTrue(quantized)
+        self.assertFalse(float_quantized)
+        self.assertGreater(report['quantized_effective_sample_size'], 0)
+        self.assertTrue(math.isfinite(report['log_evidence_difference']))
+        self.assertTrue(math.isfinite(posterior_mean))
+
+    def test_model_train_distributed(self):
+        training_traces = 128
+        num_processes = 2
+
+        self._model.learn_inference_network(observation=[1, 1], num_traces=training_traces, num_processes=num_processes)
+        total_train_traces = self._model._inference_network._total_train_traces
+
+        util.debug('training_traces', 'num_processes', 'total_train_traces')
+
+        self.assertGreaterEqual(total_train_traces, training_traces)
+
+    def test_model_train_hogwild(self):
+        training_traces = 128
+        num_processes = 2
+
+        self._model._inference_network = None
+        self._model.learn_inference_network(inference_network=pyprob.InferenceNetwork.SIMPLE, observation=[1, 1], num_traces=training_traces, num_processes=num_processes, hogwild=True)
+        total_train_traces = self._model._inference_network._total_train_traces
+        self._model._inference_network = None
+
+        util.debug('training_traces', 'num_processes', 'total_train_traces')
+
+        self.assertGreaterEqual(total_train_traces, training_traces)
+
+    def test_model_train_hogwild_skipped_traces(self):
+        class Site(Model):
+            def __init__(self, site):
+                self.site = site
+                super().__init__('Site')
+
+            def forward(self, observation=[]):
+                x = pyprob.sample(Normal(0, 1), address='site{}'.format(self.site))
+                likelihood = Normal(x, 1)
+                for o in observation:
+                    pyprob.observe(likelihood, o)
+                return x
+
+        batch_size = 16
+        training_traces = 64
+        known, unknown = Site(0), Site(1)
+        inference_network = InferenceNetworkSimple(model_name=known.name, observe_embedding_dim=16, valid_batch=Batch(known._traces(batch_size, observation=[1, 1])))
+        inference_network.polymorph()
+        # The first batch only has traces with addresses that the network does not have layers for
+        batches = [Batch(unknown._traces(batch_size, observation=[1, 1]))]
+        trace_counter = multiprocessing.Value('l', 0)
+        inference_network.optimize(lambda: batches.pop(0) if len(batches) > 0 else Batch(known._traces(batch_size, observation=[1, 1])), TrainingObservation.OBSERVE_DIST_SAMPLE, Optimizer.ADAM, training_traces, 0.001, 0.9, 0, training_traces, False, None, hogwild_trace_counter=trace_counter)
+        total_train_traces = inference_network._total_train_traces
+        counted_traces = trace_counter.value
+
+        util.debug('batch_size', 'training_traces', 'total_train_traces', 'counted_traces')
+
+        self.assertEqual(total_train_traces, training_traces - batch_size)
+        self.assertEqual(counted_traces, training_traces)
+
+    def test_model_posterior_lockstep_exception(self):
+        class Failing(Model):
+            def __init__(self):
+                self.fail = False
+                self.num_calls = 0
+                super().__init__('Failing')
+
+            def forward(self, observation=[]):
+                x = pyprob.sample(Normal(0, 1))
+                self.num_calls += 1
+                if self.fail and (self.num_calls == 3):
+                    raise ValueError('Failing trace')
+                x = x + pyprob.sample(Normal(0, 1))
+                likelihood = Normal(x, 1)
+                for o in observation:
+                    pyprob.observe(likelihood, o)
+                return x
+
+        lockstep_particles = 8
+        model = Failing()
+        model._inference_network = InferenceNetworkLSTM(model_name=model.name, lstm_dim=16, observe_embedding_dim=16, sample_embedding_dim=4, address_embedding_dim=16, valid_batch=Batch(model._traces(16, observation=[1, 1])))
+        model._inference_network.polymorph()
+        model.fail = True
+        model.num_calls = 0
+        num_threads_before = threading.active_count()
+        with self.assertRaises(ValueError):
+            model.posterior_traces(16, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK, lockstep_particles=lockstep_particles, observation=[1, 1])
+        num_threads_after = threading.active_count()
+        model.fail = False
+        num_traces = len(model.posterior_traces(16, inference_engine=InferenceEngine.IMPORTANCE_SAMPLING_WITH_INFERENCE_NETWORK, lockstep_particles=lockstep_particles, observation=[1, 1]))
+
+        util.debug('lockstep_particles', 'num_threads_before', 'num_threads_after', 'num_traces')
+
+        self.assertEqual(num_threads_before, num_threads_after)
+        self.assertEqual(num_traces, 16)
+
+    def test_model_lockstep_ProposalRow_log_prob(self):
+        distribution = Normal(util.Tensor([[0], [1], [2]]), util.Tensor([[1], [1], [1]]))
+        row = ProposalRow(distribution, 1)
+        value = row.sample()[0]
+        log_prob = float(row.log_prob(value))
+        log_prob_correct = float(Normal(1, 1).log_prob(value))
+        log_prob_other = float(row.log_prob(util.Tensor([3])))
+        log_prob_other_correct = float(Normal(1, 1).log_prob(3))
+
+        util.debug('value', 'log_prob', 'log_prob_correct', 'log_prob_other', 'log_prob_other_correct')
+
+        self.assertAlmostEqual(log_prob, log_prob_correct, places=5)
+        self.assertAlmostEqual(log_prob_other, log_prob_other_correct, places=5)
+
+    def test_model_train_producers(self):
+        training_traces = 128
+        num_producers = 2
+
+        self._model.learn_inference_network(observation=[1, 1], num_traces=training_traces, num_producers=num_producers, producer_queue_size=2)
+        total_train_traces = self._model._inference_network._total_train_traces
+
+        util.debug('training_traces', 'num_producers', 'total_train_traces')
+
+        self.assertGreaterEqual(total_train_traces, training_traces)
+
+    def test_model_train_autotune(self):
+        training_traces = 128
+        autotune_batch_sizes = [8, 16]
+        autotune_num_threads = [1]
+        num_threads_initial = torch.get_num_threads()
+
+        self._model.learn_inference_network(observation=[1, 1], num_traces=training_traces, autotune=True, autotune_batch_sizes=autotune_batch_sizes, autotune_num_threads=autotune_num_threads, autotune_probe_seconds=0.1)
+        total_train_traces = self._model._inference_network._total_train_traces
+        num_threads = torch.get_num_threads()
+        torch.set_num_threads(num_threads_initial)
+
+        util.debug('training_traces', 'autotune_batch_sizes', 'autotune_num_threads', 'num_threads', 'total_train_traces')
+
+        self.assertEqual(num_threads, 1)
+        self.assertGreaterEqual(total_train_traces, training_traces)
+
+    def test_model_autotune_leaves_network(self):
+        autotune_batch_sizes = [8, 16]
+        num_batches = [0]
+
+        def new_batch_func(size=8, discard_source=False):
+            num_batches[0] += 1
+            return Batch(self._model._traces(size, observation=[1, 1]))
+
+        self._model._inference_network = InferenceNetworkLSTM(model_name=self._model.name, lstm_dim=16, observe_embedding_dim=16, sample_embedding_dim=4, address_embedding_dim=16, max_addresses=4, valid_batch=new_batch_func(16))
+        self._model._inference_network.polymorph()
+        state_dict = {k: v.clone() for k, v in self._model._inference_network.state_dict().items()}
+        address_stats = copy.deepcopy(self._model._inference_network._address_stats)
+        batch_size, num_threads, traces = self._model._autotune(new_batch_func, autotune_batch_sizes, [1], None, 0.1, TrainingObservation.OBSERVE_DIST_SAMPLE, Optimizer.ADAM, 0.001, 0.9, 0, False)
+        state_dict_after = self._model._inference_network.state_dict()
+        parameters_unchanged = (set(state_dict) == set(state_dict_after)) and all([torch.equal(state_dict[k], state_dict_after[k]) for k in state_dict])
+        address_stats_unchanged = address_stats == self._model._inference_network._address_stats
+        num_traces = len(traces)
+        self._model._inference_network = None
+
+        util.debug('batch_size', 'num_threads', 'num_batches', 'num_traces', 'parameters_unchanged', 'address_stats_unchanged')
+
+        self.assertIn(batch_size, autotune_batch_sizes)
+        self.assertEqual(num_batches[0], 2)  # The validation batch and the pool of traces for probing
+        self.assertEqual(num_traces, 2 * max(autotune_batch_sizes))
+        self.assertTrue(parameters_unchanged)
+        self.assertTrue(address_stats_unchanged)
+
+    def test_model_trace_cache_claim_files(self):
+        files = 4
+        traces_per_file = 8
+        trace_cache_path = tempfile.mkdtemp()
+
+        self._model.save_trace_cache(trace_cache_path, files=files, traces_per_file=traces_per_file, observation=[1, 1])
+        self._model.use_trace_cache(trace_cache_path, claim_files=True)
+        claimed_files = [self._model._claim_trace_cache_file(self._model._trace_cache_current_files()) for i in range(files)]
+        claimed_file_after_all_claimed = self._model._claim_trace_cache_file(self._model._trace_cache_current_files())
+        num_claimed_files = len(set(claimed_files))
+        num_reclaimed_files = self._model.reclaim_trace_cache_leases(lease_seconds=-1)
+        num_current_files = len(self._model._trace_cache_current_files())
+
+        util.debug('files', 'num_claimed_files', 'claimed_file_after_all_claimed', 'num_reclaimed_files', 'num_current_files')
+
+        self.assertEqual(num_claimed_files, files)
+        self.assertIsNone(claimed_file_after_all_claimed)
+        self.assertEqual(num_reclaimed_files, files)
+        self.assertEqual(num_current_files, files)
+
+    def test_model_trace_cache_unreadable_files(self):
+        files = 2
+        trace_cache_path = tempfile.mkdtemp()
+        for i in range(files):
+            with open(os.path.join(trace_cache_path, 'pyprob_traces_{}'.format(i)), 'wb') as f:
+                f.write(b'not a trace cache file')
+
+        self._model.use_trace_cache(trace_cache_path)
+        with self.assertRaises(RuntimeError):
+            self._model.learn_inference_network(observation=[1, 1], num_traces=8, use_trace_cache=True, batch_size=4, valid_size=4)
+        num_unreadable_files = self._model._trace_cache_num_unreadable_files
+
+        util.debug('files', 'num_unreadable_files')
+
+        self.assertEqual(num_unreadable_files, files)
+
+    def test_model_trace_cache_group_by_trace_type(self):
+        class TwoTraceTypes(Model):
+            def __init__(self):
+                super().__init__('Two trace types')
+
+            def forward(self, observation=[]):
+                x = pyprob.sample(Normal(0, 1))
+                if int(pyprob.sample(Categorical([0.8, 0.2]))) == 1:
+                    x = x + pyprob.sample(Normal(0, 1))
+                likelihood = Normal(x, 1)
+                for o in observation:
+                    pyprob.observe(likelihood, o)
+                return x
+
+        files = 4
+        traces_per_file = 8
+        trace_cache_path = tempfile.mkdtemp()
+        model = TwoTraceTypes()
+
+        model.save_trace_cache(trace_cache_path, files=files, traces_per_file=traces_per_file, group_by_trace_type=True, observation=[1, 1])
+        model.use_trace_cache(trace_cache_path)
+        trace_cache_files = model._trace_cache_current_files()
+        trace_types = [set([trace.trace_type() for trace in model._load_traces(f)]) for f in trace_cache_files]
+        traces_per_file_saved = [len(model._load_traces(f)) for f in trace_cache_files]
+        num_trace_types = len(set.union(*trace_types))
+        num_full_files = len([n for n in traces_per_file_saved if n == traces_per_file])
+        num_partial_files = len([n for n in traces_per_file_saved if n < traces_per_file])
+        num_traces = sum(traces_per_file_saved)
+
+        util.debug('files', 'traces_per_file', 'traces_per_file_saved', 'num_trace_types', 'num_full_files', 'num_partial_files', 'num_traces')
+
+        self.assertTrue(all(len(t) == 1 for t in trace_types))
+        self.assertEqual(num_trace_types, 2)
+        self.assertEqual(num_full_files, files)
+        self.assertLessEqual(num_partial_files, num_trace_types)
+        # Traces are generated traces_per_file at a time, and none is dropped
+        self.assertEqual(num_traces % traces_per_file, 0)
+
+    def test_model_trace_cache_statistics(self):
+        files = 2
+        traces_per_file = 8
+        trace_cache_path = tempfile.mkdtemp()
+
+        self._model.save_trace_cache(trace_cache_path, files=files, traces_per_file=traces_per_file, observation=[1, 1])
+        self._model.use_trace_cache(trace_cache_path)
+        statistics = self._model.trace_cache_statistics()
+        num_traces = statistics['num_traces']
+        num_traces_correct = files * traces_per_file
+        num_traces_in_trace_types = sum([t['count'] for t in statistics['trace_types'].values()])
+
+        util.debug('num_traces', 'num_traces_correct', 'num_traces_in_trace_types')
+
+        self.assertEqual(statistics['num_files'], files)
+        self.assertEqual(num_traces, num_traces_correct)
+        self.assertEqual(num_traces_in_trace_types, num_traces_correct)
+
+    def test_model_trace_cache_deduplicate_tensors(self):
+        trace_cache_path = tempfile.mkdtemp()
+        file_name = os.path.join(trace_cache_path, str(uuid.uuid4()))
+
+        traces = self._model._traces(8, observation=[1, 1])
+        self._model._save_traces(traces, file_name)
+        traces_loaded = self._model._load_traces(file_name)
+        observed_values = [s.value for trace in traces_loaded for s in trace.samples_observed]
+        observed_values_shared = all(v is observed_values[0] for v in observed_values)
+        observed_values_correct = all(float(v) == 1 for v in observed_values)
+
+        util.debug('observed_values_shared', 'observed_values_correct')
+
+        self.assertTrue(observed_values_shared)
+        self.assertTrue(observed_values_correct)
+
+    def test_model_trace_cache_tensor_store(self):
+        files = 2
+        traces_per_file = 4
+        trace_cache_path = tempfile.mkdtemp()
+        observation = torch.arange(1024).float()
+
+        self._model.save_trace_cache(trace_cache_path, files=files, traces_per_file=traces_per_file, deduplicate_across_files=True, observation=[observation])
+        self._model.use_trace_cache(trace_cache_path)
+        trace_cache_files = self._model._trace_cache_current_files()
+        num_stored_tensors = len(os.listdir(os.path.join(trace_cache_path, 'pyprob_tensors')))
+        # As written, the files refer to the store instead of holding the observation
+        observed_values_saved = [s.value for f in trace_cache_files for trace in util.load_tar(f, 'pyprob_traces')['traces'] for s in trace.samples_observed]
+        observed_values_referenced = all(isinstance(v, TensorReference) for v in observed_values_saved)
+        observed_values = [s.value for f in trace_cache_files for trace in self._model._load_traces(f) for s in trace.samples_observed]
+        observed_values_correct = all(torch.equal(v, observation) for v in observed_values)
+
+        util.debug('files', 'num_stored_tensors', 'observed_values_referenced', 'observed_values_correct')
+
+        self.assertEqual(len(trace_cache_files), files)
+        self.assertEqual(num_stored_tensors, 1)
+        self.assertEqual(len(observed_values), files * traces_per_file)
+        self.assertTrue(observed_values_referenced)
+        self.assertTrue(observed_values_correct)
+
     def test_model_lmh_posterior_with_initial_trace(self):
         num_traces = 256
 
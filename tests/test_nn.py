@@ -1,10 +1,55 @@
 import unittest
+import types
+import os
+import uuid
+import gc
+import math
+import tempfile
+from collections import OrderedDict
 import torch
 from torch.autograd import Variable
+from torch.nn import Parameter
 
 import pyprob
-from pyprob import util
-from pyprob.nn import ObserveEmbeddingConvNet2D5C, ObserveEmbeddingConvNet3D4C
+from pyprob import util, Model, TrainingObservation, ProposalArchitecture, AddressEviction, Optimizer
+from pyprob.distributions import Normal, Uniform, Categorical
+from pyprob.nn import ObserveEmbeddingConvNet2D5C, ObserveEmbeddingConvNet3D4C, Batch, InferenceNetworkLSTM, ProposalNormal, proposal_layers_forward_grouped, _proposal_layers_stacked, add_new_parameter_groups, remove_missing_parameters, reset_parameter_rows, save_checkpoint, load_checkpoint, SparseStepOptimizer, distributed_polymorph
+
+
+class Branching(Model):
+    def __init__(self, normal_step=False):
+        self.normal_step = normal_step
+        super().__init__('Branching')
+
+    def forward(self, observation=[]):
+        uniform = Uniform(-1, 1)
+        x = pyprob.sample(uniform)
+        while float(x) < 0:
+            x = pyprob.sample(uniform)
+        if self.normal_step:
+            x = x + pyprob.sample(Normal(x, 2))
+        likelihood = Normal(x, 1)
+        for o in observation:
+            pyprob.observe(likelihood, o)
+        return x
+
+
+class Sites(Model):
+    def __init__(self):
+        super().__init__('Sites')
+
+    def forward(self, observation=[], site=0):
+        x = pyprob.sample(Normal(site, 1), address='site{}'.format(site))
+        likelihood = Normal(x, 1)
+        for o in observation:
+            pyprob.observe(likelihood, o)
+        return x
+
+
+def small_inference_network_lstm(model, valid_batch, **kwargs):
+    inference_network = InferenceNetworkLSTM(model_name=model.name, lstm_dim=16, observe_embedding_dim=16, sample_embedding_dim=4, address_embedding_dim=16, valid_batch=valid_batch, **kwargs)
+    inference_network.polymorph()
+    return inference_network
 
 
 class NNTestCase(unittest.TestCase):
@@ -50,6 +95,427 @@ class NNTestCase(unittest.TestCase):
         self.assertEqual(output_batch_shape, output_batch_shape_correct)
         self.assertEqual(output_non_batch_shape, output_non_batch_shape_correct)
 
+    def test_InferenceNetworkLSTM_loss_pack_sub_batches(self):
+        batch_size = 64
+        model = Branching()
+        batch = Batch(model._traces(batch_size, observation=[1, 1]))
+        inference_network = small_inference_network_lstm(model, batch)
+        inference_network.eval()
+        num_sub_batches = len(batch.sub_batches)
+        _, loss = inference_network.loss(batch, training_observation=TrainingObservation.OBSERVE_DIST_MEAN)
+        _, loss_packed = inference_network.loss(batch, training_observation=TrainingObservation.OBSERVE_DIST_MEAN, pack_sub_batches=True)
+
+        util.debug('batch_size', 'num_sub_batches', 'loss', 'loss_packed')
+
+        self.assertAlmostEqual(loss, loss_packed, places=3)
+
+    def test_InferenceNetworkLSTM_save_load_checkpoint(self):
+        batch_size = 64
+        file_name = os.path.join(tempfile.mkdtemp(), str(uuid.uuid4()))
+        model = Branching()
+        batch = Batch(model._traces(batch_size, observation=[1, 1]))
+        inference_network = small_inference_network_lstm(model, batch)
+        inference_network.eval()
+        inference_network._optimizer_type = Optimizer.ADAM
+        _, loss = inference_network.loss(batch, training_observation=TrainingObservation.OBSERVE_DIST_MEAN)
+        save_checkpoint(inference_network, file_name).result()
+        loaded = load_checkpoint(file_name)
+        loaded.eval()
+        _, loss_loaded = loaded.loss(batch, training_observation=TrainingObservation.OBSERVE_DIST_MEAN)
+        valid_batch_length = loaded._valid_batch.length
+        optimizer_type_loaded = loaded._optimizer_type
+        os.remove(file_name + '_valid')
+        loaded_without_valid_batch = load_checkpoint(file_name)
+        os.remove(file_name)
+        num_addresses = len(inference_network._layer_specs)
+        num_addresses_loaded = len(loaded._layer_specs)
+
+        util.debug('batch_size', 'loss', 'loss_loaded', 'valid_batch_length', 'num_addresses', 'num_addresses_loaded', 'optimizer_type_loaded')
+
+        self.assertAlmostEqual(loss, loss_loaded, places=3)
+        self.assertEqual(valid_batch_length, batch_size)
+        self.assertEqual(optimizer_type_loaded, Optimizer.ADAM)
+        self.assertEqual(num_addresses, num_addresses_loaded)
+        self.assertIsNone(loaded_without_valid_batch._valid_batch)
+
+    def test_InferenceNetworkLSTM_shared_trunk(self):
+        batch_size = 64
+        model = Branching()
+        batch = Batch(model._traces(batch_size, observation=[1, 1]))
+        inference_network = small_inference_network_lstm(model, batch, proposal_architecture=ProposalArchitecture.SHARED_TRUNK)
+        optimizer = torch.optim.Adam(inference_network.parameters())
+        num_addresses = len(inference_network._proposal_layers)
+        num_proposal_layers = len(inference_network._shared_proposal_layers)
+        success, loss = inference_network.loss(batch, optimizer)
+        success_packed, loss_packed = inference_network.loss(batch, optimizer, pack_sub_batches=True)
+
+        util.debug('batch_size', 'num_addresses', 'num_proposal_layers', 'loss', 'loss_packed')
+
+        self.assertTrue(success)
+        self.assertTrue(success_packed)
+        self.assertGreater(num_addresses, 1)
+        self.assertEqual(num_proposal_layers, 1)
+
+    def test_InferenceNetworkLSTM_address_eviction(self):
+        batch_size = 8
+        max_addresses = 2
+        model = Sites()
+        batches = [Batch(model._traces(batch_size, observation=[1, 1], site=site)) for site in range(3)]
+        inference_network = small_inference_network_lstm(model, batches[0], max_addresses=max_addresses, address_eviction=AddressEviction.LEAST_RECENTLY_USED)
+        inference_network.polymorph(batches[1])
+        address_1 = batches[1][0].samples[0].address
+        weight_1 = inference_network._proposal_layers[address_1]._lin1.weight.data.clone()
+        inference_network._total_train_traces += batch_size
+        inference_network.polymorph(batches[2])
+        evicted_after_2 = list(inference_network._evicted_addresses)
+        inference_network._total_train_traces += batch_size
+        inference_network.polymorph(batches[1])
+        evicted_after_1 = list(inference_network._evicted_addresses)
+        weight_1_restored = inference_network._proposal_layers[address_1]._lin1.weight.data
+        num_resident = len(inference_network._proposal_layers)
+        success, loss = inference_network.loss(batches[1])
+
+        util.debug('batch_size', 'max_addresses', 'evicted_after_2', 'evicted_after_1', 'num_resident', 'loss')
+
+        self.assertEqual(evicted_after_2, [address_1])
+        self.assertEqual(evicted_after_1, [batches[2][0].samples[0].address])
+        self.assertTrue(torch.equal(weight_1, weight_1_restored))
+        self.assertEqual(num_resident, max_addresses)
+        self.assertTrue(success)
+
+    def test_InferenceNetworkLSTM_address_optimizer_state(self):
+        batch_size = 8
+        model = Sites()
+        batches = [Batch(model._traces(batch_size, observation=[1, 1], site=site)) for site in range(3)]
+        inference_network = small_inference_network_lstm(model, batches[0], max_addresses=2)
+        optimizer = torch.optim.Adam(inference_network._parameter_groups(), weight_decay=0.1)
+        inference_network.loss(batches[0], optimizer)
+        inference_network._address_embedding_rows_new = []
+        inference_network.polymorph(batches[1])
+        rows_new = list(inference_network._address_embedding_rows_new)
+        chunk, row = rows_new[0]
+        exp_avg = optimizer.state[inference_network._address_embedding_chunks[chunk]]['exp_avg']
+        # Weight decay gives optimizer state to the rows that were not in use
+        exp_avg_row_before = float(exp_avg[row].abs().sum())
+        reset_parameter_rows(optimizer, inference_network._address_embedding_chunks[chunk], row)
+        exp_avg_row_after = float(exp_avg[row].abs().sum())
+        exp_avg_row_0 = float(exp_avg[0].abs().sum())
+        # Restored layers are new parameters, without optimizer state
+        address_1 = batches[1][0].samples[0].address
+        add_new_parameter_groups(optimizer, inference_network._parameter_groups())
+        inference_network.loss(batches[1], optimizer)
+        inference_network._total_train_traces += batch_size
+        inference_network.polymorph(batches[2])
+        evicted = list(inference_network._evicted_addresses)
+        inference_network._total_train_traces += batch_size
+        inference_network.polymorph(batches[1])
+        add_new_parameter_groups(optimizer, inference_network._parameter_groups())
+        remove_missing_parameters(optimizer, inference_network)
+        restored_params_with_state = [p for p in inference_network._proposal_layers[address_1].parameters() if p in optimizer.state]
+
+        util.debug('batch_size', 'rows_new', 'exp_avg_row_before', 'exp_avg_row_after', 'exp_avg_row_0', 'evicted', 'restored_params_with_state')
+
+        self.assertEqual(rows_new, [(0, 1)])
+        self.assertGreater(exp_avg_row_before, 0)
+        self.assertEqual(exp_avg_row_after, 0)
+        self.assertGreater(exp_avg_row_0, 0)
+        self.assertEqual(evicted, [address_1])
+        self.assertEqual(restored_params_with_state, [])
+
+    def test_InferenceNetworkLSTM_address_eviction_checkpoint(self):
+        batch_size = 8
+        file_name = os.path.join(tempfile.mkdtemp(), str(uuid.uuid4()))
+        model = Sites()
+        batches = [Batch(model._traces(batch_size, observation=[1, 1], site=site)) for site in range(3)]
+        inference_network = small_inference_network_lstm(model, batches[0], max_addresses=2)
+        inference_network.polymorph(batches[1])
+        address_1 = batches[1][0].samples[0].address
+        weight_1 = inference_network._proposal_layers[address_1]._lin1.weight.data.clone()
+        inference_network._total_train_traces += batch_size
+        inference_network.polymorph(batches[2])
+        spill_dir = inference_network._address_spill_dir
+        save_checkpoint(inference_network, file_name).result()
+        # Restoring the layers in the saved network deletes its spill file, the checkpoint has its own copy
+        inference_network._total_train_traces += batch_size
+        inference_network.polymorph(batches[1])
+        loaded = load_checkpoint(file_name)
+        os.remove(file_name)
+        os.remove(file_name + '_valid')
+        evicted_loaded = list(loaded._evicted_addresses)
+        loaded._total_train_traces += batch_size
+        loaded.polymorph(batches[1])
+        weight_1_loaded = loaded._proposal_layers[address_1]._lin1.weight.data
+        spill_dir_exists = os.path.exists(spill_dir)
+        del inference_network
+        gc.collect()
+        spill_dir_exists_after_del = os.path.exists(spill_dir)
+
+        util.debug('batch_size', 'evicted_loaded', 'spill_dir', 'spill_dir_exists', 'spill_dir_exists_after_del')
+
+        self.assertEqual(evicted_loaded, [address_1])
+        self.assertTrue(torch.equal(weight_1, weight_1_loaded))
+        self.assertTrue(spill_dir_exists)
+        self.assertFalse(spill_dir_exists_after_del)
+
+    def test_distributed_polymorph_address_stats(self):
+        batch_size = 16
+        model = Branching()
+        valid_batch = Batch(model._traces(batch_size, observation=[1, 1]))
+        batch = Batch(model._traces(batch_size, observation=[1, 1]))
+        inference_network = InferenceNetworkLSTM(model_name=model.name, lstm_dim=16, observe_embedding_dim=16, sample_embedding_dim=4, address_embedding_dim=16, valid_batch=valid_batch)
+        torch.distributed.init_process_group('gloo', init_method='file://' + os.path.join(tempfile.mkdtemp(), 'pyprob_process_group'), rank=0, world_size=1)
+        try:
+            distributed_polymorph(inference_network, batch)
+        finally:
+            torch.distributed.destroy_process_group()
+        num_traces_stats = sum([trace_stats[0] for trace_stats in inference_network._trace_stats.values()])
+        num_layers = len(inference_network._proposal_layers)
+        num_addresses = len(set([sample.address for trace in batch for sample in trace.samples]))
+
+        util.debug('batch_size', 'num_traces_stats', 'num_layers', 'num_addresses')
+
+        self.assertEqual(num_traces_stats, batch_size)
+        self.assertEqual(num_layers, num_addresses)
+
+    def test_InferenceNetworkLSTM_address_embedding_chunks(self):
+        class ManyAddresses(Model):
+            def __init__(self, length):
+                self.length = length
+                super().__init__('Many addresses')
+
+            def forward(self, observation=[]):
+                x = 0
+                for i in range(self.length):
+                    x = x + pyprob.sample(Normal(0, 1), address='a{}'.format(i))
+                likelihood = Normal(x, 1)
+                for o in observation:
+                    pyprob.observe(likelihood, o)
+                return x
+
+        length = 1030
+        model = ManyAddresses(length)
+        batch = Batch(model._traces(2, observation=[1]))
+        inference_network = InferenceNetworkLSTM(model_name=model.name, lstm_dim=4, observe_embedding_dim=4, sample_embedding_dim=2, address_embedding_dim=4, valid_batch=batch)
+        inference_network.polymorph()
+        addresses = [sample.address for sample in batch[0].samples]
+        addresses = addresses[-3:] + addresses[:3]  # Across the two chunks, out of order
+        num_chunks = len(inference_network._address_embedding_chunks)
+        table = torch.cat(list(inference_network._address_embedding_chunks))
+        embeddings = inference_network._address_embeddings(addresses)
+        embeddings_correct = table[[inference_network._address_ids[address] for address in addresses]]
+        loss = inference_network.loss(batch)[1]
+
+        util.debug('length', 'num_chunks', 'loss')
+
+        self.assertEqual(num_chunks, 2)
+        self.assertTrue(torch.equal(embeddings, embeddings_correct))
+        self.assertTrue(math.isfinite(loss))
+
+    def test_InferenceNetworkLSTM_address_embeddings_migration(self):
+        model = Branching()
+        batch = Batch(model._traces(16, observation=[1, 1]))
+        inference_network = small_inference_network_lstm(model, batch)
+        addresses = list(inference_network._address_ids.keys())
+        embeddings = inference_network._address_embeddings(addresses).detach()
+        # The state of a network saved with one parameter per address embedding
+        state = dict(inference_network.__dict__)
+        state['_parameters'] = OrderedDict(state['_parameters'])
+        state['_modules'] = OrderedDict(state['_modules'])
+        del state['_modules']['_address_embedding_chunks']
+        del state['_address_ids']
+        state['_address_embeddings'] = OrderedDict()
+        for address, embedding in zip(addresses, embeddings):
+            state['_address_embeddings'][address] = Parameter(embedding.clone())
+            state['_parameters']['address_embedding_' + address] = state['_address_embeddings'][address]
+        inference_network_migrated = InferenceNetworkLSTM.__new__(InferenceNetworkLSTM)
+        inference_network_migrated.__setstate__(state)
+        embeddings_migrated = inference_network_migrated._address_embeddings(addresses)
+        num_address_parameters = len([name for name, _ in inference_network_migrated.named_parameters() if name.startswith('address_embedding_')])
+        loss = inference_network_migrated.loss(batch)[1]
+
+        util.debug('num_address_parameters', 'loss')
+
+        self.assertTrue(torch.equal(embeddings, embeddings_migrated))
+        self.assertEqual(num_address_parameters, 0)
+        self.assertTrue(math.isfinite(loss))
+
+    def test_InferenceNetworkLSTM_new_trace_observe_embedding_cache(self):
+        model = Branching()
+        batch = Batch(model._traces(16, observation=[1, 1]))
+        inference_network = small_inference_network_lstm(model, batch)
+        inference_network.eval()
+        inference_network.new_trace(util.Tensor([1, 1]).unsqueeze(0))
+        embedding = inference_network._state_observes_embedding
+        inference_network.new_trace(util.Tensor([1, 1]).unsqueeze(0))
+        embedding_equal_observes = inference_network._state_observes_embedding
+        inference_network.new_trace(util.Tensor([1, 2]).unsqueeze(0))
+        embedding_other_observes = inference_network._state_observes_embedding
+        inference_network.train()
+        inference_network.optimize(lambda: Batch(model._traces(16, observation=[1, 2])), TrainingObservation.OBSERVE_DIST_SAMPLE, Optimizer.ADAM, 16, 0.001, 0.9, 0, 16, False, None)
+        inference_network.eval()
+        inference_network.new_trace(util.Tensor([1, 2]).unsqueeze(0))
+        embedding_after_optimize = inference_network._state_observes_embedding
+
+        util.debug('embedding', 'embedding_equal_observes', 'embedding_other_observes', 'embedding_after_optimize')
+
+        self.assertIs(embedding_equal_observes, embedding)
+        self.assertIsNot(embedding_other_observes, embedding)
+        self.assertIsNot(embedding_after_optimize, embedding_other_observes)
+
+    def test_Batch_sub_batches_columns(self):
+        batch_size = 32
+        model = Branching(normal_step=True)
+        batch = Batch(model._traces(batch_size, observation=[1, 1]))
+        inference_network = small_inference_network_lstm(model, batch)
+        inference_network.eval()
+        log_probs = []
+        log_probs_columns = []
+        for sub_batch, sub_batch_columns in zip(batch.sub_batches, batch.sub_batches_columns):
+            for time_step, columns in enumerate(sub_batch_columns):
+                samples = [trace.samples[time_step] for trace in sub_batch]
+                values = torch.stack([sample.value for sample in samples])
+                proposal_layer = inference_network._proposal_layers[samples[0].address]
+                x = Variable(util.Tensor(len(sub_batch), 16).normal_())
+                log_probs.append(float(proposal_layer(x, samples).log_prob(values).sum()))
+                log_probs_columns.append(float(proposal_layer(x, columns).log_prob(columns.values).sum()))
+
+        util.debug('batch_size', 'log_probs', 'log_probs_columns')
+
+        for log_prob, log_prob_columns in zip(log_probs, log_probs_columns):
+            self.assertAlmostEqual(log_prob, log_prob_columns, places=3)
+
+    def test_Batch_sub_batches_observes(self):
+        class Observes(Model):
+            def __init__(self):
+                super().__init__('Observes')
+
+            def forward(self, observation=[]):
+                x = pyprob.sample(Normal(0, 1))
+                pyprob.observe(Normal(x, 1), observation[0])
+                pyprob.observe(Categorical([0.2, 0.8]), observation[1])
+                pyprob.observe(Normal(util.Tensor([0, 0, 0]), 1), observation[2])
+                return x
+
+        batch_size = 16
+        model = Observes()
+        batch = Batch(model._traces(batch_size, observation=[0, 1, [0, 0, 0]]))
+        sub_batch_observes = batch.sub_batches_observes[0]
+        vectorized = sub_batch_observes.distributions is not None
+        observes_shape = list(sub_batch_observes.pack(TrainingObservation.OBSERVE_DIST_SAMPLE).size())
+        observes_shape_correct = list(torch.stack([trace.pack_observes(TrainingObservation.OBSERVE_DIST_SAMPLE) for trace in batch.sub_batches[0]]).size())
+        observes_mean = sub_batch_observes.pack(TrainingObservation.OBSERVE_DIST_MEAN)
+        observes_mean_correct = torch.stack([trace.pack_observes(TrainingObservation.OBSERVE_DIST_MEAN) for trace in batch.sub_batches[0]])
+
+        util.debug('batch_size', 'vectorized', 'observes_shape', 'observes_shape_correct')
+
+        self.assertTrue(vectorized)
+        self.assertEqual(observes_shape, observes_shape_correct)
+        self.assertTrue(torch.allclose(observes_mean, observes_mean_correct, equal_nan=True))  # The mean of Categorical is NaN
+
+    def test_Batch_sub_batches_observes_broadcast(self):
+        class Broadcast(Model):
+            def __init__(self):
+                super().__init__('Broadcast')
+
+            def forward(self, observation=[]):
+                # Scalar and vector means with stddevs of other shapes, as in Normal(mu, 2.0) with mu drawn from Uniform(-1, 1)[0]
+                x = pyprob.sample(Uniform(-1, 1))[0]
+                pyprob.observe(Normal(x, 2.0), observation[0])
+                pyprob.observe(Normal(x, 1), observation[1])
+                pyprob.observe(Normal(util.Tensor([0, 0]) + x, 1), observation[2])
+                return x
+
+        batch_size = 16
+        model = Broadcast()
+        batch = Batch(model._traces(batch_size, observation=[0, 0, [0, 0]]))
+        sub_batch_observes = batch.sub_batches_observes[0]
+        vectorized = sub_batch_observes.distributions is not None
+        observes_shape = list(sub_batch_observes.pack(TrainingObservation.OBSERVE_DIST_SAMPLE).size())
+        observes_shape_correct = list(torch.stack([trace.pack_observes(TrainingObservation.OBSERVE_DIST_SAMPLE) for trace in batch.sub_batches[0]]).size())
+
+        util.debug('batch_size', 'vectorized', 'observes_shape', 'observes_shape_correct')
+
+        self.assertTrue(vectorized)
+        self.assertEqual(observes_shape, observes_shape_correct)
+
+    def test_proposal_layers_forward_grouped(self):
+        input_dim = 16
+        num_layers = 5
+        proposal_layers = [ProposalNormal(input_dim, 1) for i in range(num_layers)]
+        inputs = [Variable(util.Tensor(i + 1, input_dim).normal_()) for i in range(num_layers)]
+        samples = [[types.SimpleNamespace(distribution=Normal(util.Tensor([i]), util.Tensor([1])))] * (i + 1) for i in range(num_layers)]
+        values = torch.cat([Variable(util.Tensor(i + 1, 1).normal_()) for i in range(num_layers)])
+
+        log_prob = float(sum([proposal_layer(x, s).log_prob(v).sum() for proposal_layer, x, s, v in zip(proposal_layers, inputs, samples, torch.split(values, [i + 1 for i in range(num_layers)]))]))
+        log_prob_grouped = float(proposal_layers_forward_grouped(proposal_layers, inputs, samples).log_prob(values).sum())
+
+        util.debug('num_layers', 'log_prob', 'log_prob_grouped')
+
+        self.assertAlmostEqual(log_prob, log_prob_grouped, places=3)
+
+    def test_proposal_layers_forward_grouped_cache(self):
+        input_dim = 16
+        num_layers = 5
+        proposal_layers = tuple([ProposalNormal(input_dim, 1) for i in range(num_layers)])
+        with torch.no_grad():
+            stacked = _proposal_layers_stacked(proposal_layers)
+            stacked_reused = _proposal_layers_stacked(proposal_layers) is stacked
+            proposal_layers[2]._lin2.weight.add_(1)  # As in an optimizer step
+            stacked_updated = _proposal_layers_stacked(proposal_layers)
+        stacked_recomputed = stacked_updated is not stacked
+        stacked_correct = torch.equal(stacked_updated[2][2], proposal_layers[2]._lin2.weight.t())
+        stacked_with_grad_cached = _proposal_layers_stacked(proposal_layers) is stacked_updated
+
+        util.debug('num_layers', 'stacked_reused', 'stacked_recomputed', 'stacked_correct', 'stacked_with_grad_cached')
+
+        self.assertTrue(stacked_reused)
+        self.assertTrue(stacked_recomputed)
+        self.assertTrue(stacked_correct)
+        self.assertFalse(stacked_with_grad_cached)
+
+    def test_add_new_parameter_groups(self):
+        module = torch.nn.Sequential(torch.nn.Linear(4, 4))
+        optimizer = torch.optim.Adam(module.parameters())
+        module(Variable(util.Tensor(2, 4).normal_())).sum().backward()
+        optimizer.step()
+        state_size_before = len(optimizer.state)
+        module.add_module('new', torch.nn.Linear(4, 2))
+        add_new_parameter_groups(optimizer, [{'params': list(module.parameters())}])
+        add_new_parameter_groups(optimizer, [{'params': list(module.parameters())}])
+        state_size_after = len(optimizer.state)
+        num_param_groups = len(optimizer.param_groups)
+        num_params = sum([len(group['params']) for group in optimizer.param_groups])
+
+        util.debug('state_size_before', 'state_size_after', 'num_param_groups', 'num_params')
+
+        self.assertEqual(state_size_before, 2)
+        self.assertEqual(state_size_after, 2)
+        self.assertEqual(num_param_groups, 2)
+        self.assertEqual(num_params, 4)
+
+    def test_SparseStepOptimizer(self):
+        used = torch.nn.Linear(4, 4)
+        unused = torch.nn.Linear(4, 4)
+        optimizer = SparseStepOptimizer(torch.optim.Adam([{'params': used.parameters()}, {'params': unused.parameters()}]))
+        unused_weight = unused.weight.data.clone()
+        used_weight = used.weight.data.clone()
+        for i in range(2):
+            optimizer.zero_grad()
+            used(Variable(util.Tensor(2, 4).normal_())).sum().backward()
+            optimizer.step()
+        unused_weight_changed = not torch.equal(unused_weight, unused.weight.data)
+        used_weight_changed = not torch.equal(used_weight, used.weight.data)
+        state_size = len(optimizer.state)
+        optimizer.zero_grad()
+        used_grad_is_none = used.weight.grad is None
+
+        util.debug('unused_weight_changed', 'used_weight_changed', 'state_size', 'used_grad_is_none')
+
+        self.assertFalse(unused_weight_changed)
+        self.assertTrue(used_weight_changed)
+        self.assertEqual(state_size, 2)
+        self.assertTrue(used_grad_is_none)
+
 
 if __name__ == '__main__':
     pyprob.set_verbosity(1)
@@ -1,4 +1,8 @@
 import unittest
+import os
+import uuid
+import tempfile
+import torch
 from functools import reduce
 
 import pyprob
@@ -30,6 +34,24 @@ class UtilTestCase(unittest.TestCase):
         self.assertTrue(not all(sample == stochastic_samples[0] for sample in stochastic_samples))
         self.assertTrue(all(sample == deterministic_samples[0] for sample in deterministic_samples))
 
+    def test_save_tar_async_load(self):
+        file_dir = tempfile.mkdtemp()
+        file_name = os.path.join(file_dir, str(uuid.uuid4()))
+        value = torch.arange(10)
+        data = {'value': value}
+        future = util.save_tar_async(file_name, [('pyprob_test_header', {'length': 1}), ('pyprob_test', data)])
+        data['value'] = None  # Modifying the object after the call does not affect what is written
+        future.result()
+        header = util.load_tar(file_name, 'pyprob_test_header')
+        data_on_file = util.load_tar(file_name, 'pyprob_test')
+        files = os.listdir(file_dir)
+        os.remove(file_name)
+
+        util.debug('header', 'data_on_file', 'files')
+        self.assertEqual(header['length'], 1)
+        self.assertTrue(torch.equal(data_on_file['value'], value))
+        self.assertEqual(files, [os.path.basename(file_name)])
+
 
 if __name__ == '__main__':
     pyprob.set_verbosity(1)